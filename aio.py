@@ -0,0 +1,413 @@
+"""
+Ping and traceroute for asyncio programs. Every request goes out over
+one socket that the event loop watches with add_reader, and each reply
+resolves the future of the request it answers, so thousands of pings
+can be awaited at once without a thread each and without polling.
+"""
+
+import asyncio
+import math
+import socket
+import time
+import weakref
+
+import icmp
+import output
+import probe
+import rttstats
+import transport
+
+class AsyncPinger:
+	"""
+	This class sends echo requests for any number of concurrent pings
+	and traces over one socket. Requests are told apart by sequence
+	number, which is shared by every check, so up to 65536 of them may
+	be outstanding at once. Replies are read when the event loop finds
+	the socket readable, and requests that go unanswered are given up
+	on by a single timer set for the earliest deadline.
+	"""
+
+	def __init__( self, size=56, timeout=10, names=None, sock=None ):
+		"""
+		This function opens the socket, a raw socket if the process may
+		open one and otherwise an ICMP datagram socket that is told of
+		Time Exceeded errors, and starts watching it. It must be called
+		from a coroutine, as the pinger belongs to the running loop.
+		:param size:      The size of the data sent in each echo request.
+		:param timeout:   The number of seconds to wait for each reply.
+		:param names:     A resolver.ReverseResolver used to name the hops
+		                  of traces, or None to leave them unnamed.
+		:param sock:      The socket to use, from transport.openSocket, or
+		                  None to open one.
+		:raises PermissionError:   If neither kind of socket is allowed.
+		"""
+
+		self.size = size
+		self.names = names
+		self._loop = asyncio.get_running_loop()
+
+		if( sock is None ):
+			sock = transport.openSocket( errors=True )
+		sock.setblocking( False )
+		self._socket = sock
+
+		# Replies to many pings at once arrive in bursts, so give the
+		# kernel room to queue them
+		sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22 )
+		self._datagram = transport.isDatagram( sock )
+
+		# Have the kernel stamp when each reply arrives
+		transport.enableTimestamps( sock )
+
+		# Every request carries an identifier no other pinger or tracer
+		# uses, and the kernel drops the replies and errors meant for
+		# the others
+		self.ident = transport.identifier()
+		transport.attachFilter( sock, self.ident, self.ident )
+
+		# The ttl requests are sent with unless a trace asks otherwise,
+		# and the ttl the socket is set to now
+		self._defaultTtl = sock.getsockopt( socket.SOL_IP, socket.IP_TTL )
+		self._ttl = self._defaultTtl
+
+		# The requests waiting for a reply, and for each sequence number
+		# the future of its request and the check and address it was sent
+		# for. The checks are kept after the future is done, so that
+		# duplicate and late replies are counted against the right one.
+		self._ring = transport.BufferRing()
+		self._table = probe.InFlight( timeout )
+		self._futures = dict()
+		self._owners = [ None ] * 0x10000
+		self._sequence = 0
+
+		# The timer that gives up on unanswered requests, and its deadline
+		self._timer = None
+		self._timerAt = math.inf
+
+		# Each check is keyed by a number of its own, so that replies
+		# are only reordered with respect to those of the same check
+		self._checks = 0
+
+		self._loop.add_reader( sock, self._readable )
+
+	async def __aenter__( self ):
+		"""
+		This function lets the pinger be used in an async with statement.
+		:return:   The pinger.
+		"""
+
+		return self
+
+	async def __aexit__( self, kind, value, traceback ):
+		"""
+		This function closes the pinger at the end of an async with statement.
+		:return:   None
+		"""
+
+		self.close()
+
+	def close( self ):
+		"""
+		This function stops watching the socket and closes it, and gives
+		back its identifier. Requests still waiting for a reply are
+		treated as lost.
+		:return:   None
+		"""
+
+		if( self._socket.fileno() < 0 ):
+			return
+		self._loop.remove_reader( self._socket )
+		if( self._timer is not None ):
+			self._timer.cancel()
+		for future in self._futures.values():
+			if( not future.done() ):
+				future.set_result( None )
+		self._futures.clear()
+		self._socket.close()
+		transport.release( self.ident )
+
+	def closed( self ):
+		"""
+		This function tells whether the pinger has been closed.
+		:return:   True if it has, False otherwise.
+		"""
+
+		return self._socket.fileno() < 0
+
+	async def ping( self, destination, count=4, interval=1 ):
+		"""
+		This function pings a destination. Requests are sent every
+		interval seconds whether or not earlier ones have been answered.
+		:param destination:   The destination, either an IPv4 address or web URL.
+		:param count:         The number of requests to send.
+		:param interval:      The number of seconds between requests.
+		:return:              The output.Summary of the check.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		address = await self._resolve( destination )
+		check = self._check()
+
+		# The check is complete once every request is answered or lost
+		enter = time.perf_counter()
+		futures = list()
+		for k in range( count ):
+			if( k > 0 ):
+				await asyncio.sleep( interval )
+			futures.append( self._send( address, None, check ) )
+		await asyncio.gather( *futures )
+
+		return output.summarize( destination, address, check["sent"], check["stats"],
+		 check["counts"], ( time.perf_counter() - enter ) * 1000 )
+
+	async def trace( self, destination, probes=3, hops=30 ):
+		"""
+		This function traces the route to a destination. The probes of
+		each hop are sent at once, and the next hop is probed once they
+		have all been answered or lost, until the destination answers or
+		the largest number of hops is reached.
+		:param destination:   The destination, either an IPv4 address or web URL.
+		:param probes:        The number of probes sent to each hop.
+		:param hops:          The largest number of hops to trace.
+		:return:              A list of the output.Hop of every hop, in order.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		address = await self._resolve( destination )
+
+		route = list()
+		for ttl in range( 1, hops + 1 ):
+			answers = await asyncio.gather( *[ self._send( address, ttl, None )
+			 for k in range( probes ) ] )
+
+			# The hop is named by the last router that answered
+			sender = None
+			rtts = list()
+			for answer in answers:
+				if( answer is None ):
+					rtts.append( None )
+				else:
+					sender = answer[1]
+					rtts.append( answer[2] )
+
+			name = None
+			if( sender is not None and self.names is not None ):
+				name = self.names.lookup( sender )
+			route.append( output.Hop( ttl, sender, name, rtts ) )
+
+			if( sender == address ):
+				break
+		return route
+
+	async def _resolve( self, destination ):
+		"""
+		This function finds the IPv4 address of a destination without
+		blocking the loop.
+		:param destination:   The destination, either an IPv4 address or web URL.
+		:return:              The IPv4 address.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		try:
+			socket.inet_pton( socket.AF_INET, destination )
+			return destination
+		except OSError:
+			pass
+
+		infos = await self._loop.getaddrinfo( destination, None, family=socket.AF_INET,
+		 type=socket.SOCK_RAW )
+		return infos[0][4][0]
+
+	def _check( self ):
+		"""
+		This function creates the counters kept for one ping.
+		:return:   A dictionary of the check's key, number of requests
+		           sent, the rttstats.Accumulator of its replies, and
+		           counts of its duplicate, late and reordered replies.
+		"""
+
+		self._checks += 1
+		return { "key": self._checks, "sent": 0, "stats": rttstats.Accumulator(),
+		 "counts": { "duplicates": 0, "late": 0, "reordered": 0 } }
+
+	def _send( self, address, ttl, check ):
+		"""
+		This function sends one echo request.
+		:param address:   The IPv4 address of the destination.
+		:param ttl:       The ttl of the request, or None for the default.
+		:param check:     The counters of the ping the request belongs to,
+		                  or None for a probe of a trace.
+		:return:          A future resolved with None if the request is
+		                  lost, and otherwise with a tuple of the ICMP type
+		                  of the answer, its sender, the round trip time in
+		                  milliseconds, the ttl of the answer and its size.
+		"""
+
+		# Sequence numbers have wrapped around onto a request that is
+		# still outstanding, which is lost
+		seq = self._sequence = ( self._sequence + 1 ) & 0xffff
+		old = self._futures.pop( seq, None )
+		if( old is not None and not old.done() ):
+			old.set_result( None )
+
+		if( ttl is None ):
+			ttl = self._defaultTtl
+		if( ttl != self._ttl ):
+			self._socket.setsockopt( socket.SOL_IP, socket.IP_TTL, ttl )
+			self._ttl = ttl
+
+		# Send the packet
+		packet = icmp.echoRequest( self.size, seq, self.ident )
+		sent = probe.stamp()
+		transport.send( self._socket, packet, address )
+
+		key = 0
+		if( check is not None ):
+			check["sent"] += 1
+			key = check["key"]
+		self._table.add( key, seq, sent )
+		self._owners[seq] = ( check, address )
+
+		future = self._loop.create_future()
+		self._futures[seq] = future
+		self._arm()
+		return future
+
+	def _readable( self ):
+		"""
+		This function is called by the loop whenever the socket is
+		readable, and handles every packet waiting on it.
+		:return:   None
+		"""
+
+		self._ring.drain( self._socket, self._handle )
+
+	def _handle( self, packet, nbytes, address, received ):
+		"""
+		This function matches one packet to the request it answers,
+		counts it against that request's ping and resolves its future.
+		Echo replies answer the request with their sequence number, and
+		Time Exceeded and Destination Unreachable errors the request
+		they quote.
+		:param packet:     A memoryview of the packet.
+		:param nbytes:     The length of the packet.
+		:param address:    The address of the sender.
+		:param received:   When the packet arrived, as taken by probe.elapsed.
+		:return:           None
+		"""
+
+		reply = icmp.parseReply( packet, nbytes )
+		if( reply is None ):
+			return
+		(icmpType, code, ident, seq, ttl, size) = reply
+		sender = address[0]
+
+		# The address the request answered was sent to
+		if( icmpType == icmp.ECHO_REPLY ):
+			destination = sender
+		elif( icmpType == icmp.TIME_EXCEEDED or icmpType == icmp.DEST_UNREACHABLE ):
+			quote = icmp.parseQuote( packet, nbytes )
+			if( quote is None ):
+				return
+			(destination, ident, seq) = quote
+		else:
+			return
+
+		# The kernel sets the identifier of a datagram socket's requests
+		if( not self._datagram and ident != self.ident ):
+			return
+		owner = self._owners[seq]
+		if( owner is None or owner[1] != destination ):
+			return
+		check = owner[0]
+
+		(status, rtt) = self._table.match( 0 if check is None else check["key"], seq, received )
+		if( status == probe.UNKNOWN ):
+			return
+
+		# Only the first echo reply to a request that is still waiting counts
+		if( check is not None ):
+			if( status == probe.DUPLICATE ):
+				check["counts"]["duplicates"] += 1
+			elif( status == probe.LATE ):
+				check["counts"]["late"] += 1
+			elif( icmpType == icmp.ECHO_REPLY ):
+				if( status == probe.REORDERED ):
+					check["counts"]["reordered"] += 1
+				check["stats"].add( rtt )
+
+		if( status == probe.REPLY or status == probe.REORDERED ):
+			future = self._futures.pop( seq, None )
+			if( future is not None and not future.done() ):
+				future.set_result( ( icmpType, sender, rtt, ttl, size ) )
+
+	def _arm( self ):
+		"""
+		This function sets the timer for the earliest deadline of the
+		requests waiting for a reply, if it is not set for it already.
+		:return:   None
+		"""
+
+		deadline = self._table.nextDeadline()
+		if( deadline is None or deadline >= self._timerAt ):
+			return
+		if( self._timer is not None ):
+			self._timer.cancel()
+		self._timerAt = deadline
+		self._timer = self._loop.call_later( max( deadline - time.perf_counter(), 0 ),
+		 self._expire )
+
+	def _expire( self ):
+		"""
+		This function is called by the timer, and gives up on the
+		requests whose time is up.
+		:return:   None
+		"""
+
+		self._timer = None
+		self._timerAt = math.inf
+		for (key, seq) in self._table.expire( time.perf_counter() ):
+			future = self._futures.pop( seq, None )
+			if( future is not None and not future.done() ):
+				future.set_result( None )
+		self._arm()
+
+# The pinger shared by the module's functions, one per event loop
+_pingers = weakref.WeakKeyDictionary()
+
+def _shared():
+	"""
+	This function finds the pinger shared by the module's functions on
+	the running loop, opening it the first time.
+	:return:   The AsyncPinger.
+	"""
+
+	loop = asyncio.get_running_loop()
+	pinger = _pingers.get( loop )
+	if( pinger is None or pinger.closed() ):
+		pinger = _pingers[loop] = AsyncPinger()
+	return pinger
+
+async def ping( destination, count=4, interval=1 ):
+	"""
+	This function pings a destination over the socket shared by every
+	ping and trace on the running loop.
+	:param destination:   The destination, either an IPv4 address or web URL.
+	:param count:         The number of requests to send.
+	:param interval:      The number of seconds between requests.
+	:return:              The output.Summary of the check.
+	"""
+
+	return await _shared().ping( destination, count, interval )
+
+async def traceroute( destination, probes=3, hops=30 ):
+	"""
+	This function traces the route to a destination over the socket
+	shared by every ping and trace on the running loop.
+	:param destination:   The destination, either an IPv4 address or web URL.
+	:param probes:        The number of probes sent to each hop.
+	:param hops:          The largest number of hops to trace.
+	:return:              A list of the output.Hop of every hop, in order.
+	"""
+
+	return await _shared().trace( destination, probes, hops )
@@ -0,0 +1,482 @@
+"""
+Benchmarks of ping and traceroute that run offline and without root:
+building and checksumming echo requests of several sizes, parsing
+replies and errors, keeping statistics, writing output, and sending
+and receiving through the whole probe loop over an in-process fake
+socket that answers every request at once. Each case is timed several
+times and the best time is kept, which is the least disturbed by
+whatever else the machine is doing.
+
+The results can be written as JSON, and compared with those of an
+earlier run, which exits with a failure if any case has become slower
+by more than the tolerance. Times only compare between runs on the
+same machine and Python. The baseline committed next to this file,
+benchmark-baseline.json, is compared with when no other is given;
+regenerate it with -o on the machine the benchmarks are run on.
+
+Usage: python benchmark.py [-k filter] [-o results.json] [-b baseline.json]
+                           [-r tolerance]
+
+-k runs only the cases whose names contain the filter, -o writes the
+results, -b compares them with those written by an earlier run instead
+of the committed baseline, or with none if given "none", and -r is the
+share by which a case may be slower, 0.25 by default.
+"""
+
+import collections
+import io
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import time
+from array import array
+
+import icmp
+import output
+import ping
+import rttstats
+
+# Packet sizes to benchmark, in bytes
+SIZES = [ 64, 1500, 9000, 65000 ]
+
+# Minimum number of seconds spent timing each case, in each of the
+# given number of runs
+BUDGET = 0.05
+RUNS = 5
+
+# Share by which a case may be slower than the baseline before it is
+# reported as a regression
+TOLERANCE = 0.25
+
+# Seed of the made up round trip times, so every run sees the same ones
+SEED = 1
+
+# Number of destinations sent to in each round of the probe loop
+TARGETS = 256
+
+# Baseline compared with when none is given on the command line
+BASELINE = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "benchmark-baseline.json" )
+
+# Version of the layout of the results
+_VERSION = 1
+
+_USAGE = ( "Usage: python benchmark.py [-k filter] [-o results.json] [-b baseline.json] " +
+ "[-r tolerance]" )
+
+# One benchmark: its name, the function timed and its argument, the
+# number of operations each call performs, and the number of bytes
+# each operation handles, or None
+Case = collections.namedtuple( "Case", [ "name", "function", "argument", "operations",
+ "bytes" ] )
+
+def _legacyChecksum( header ):
+	"""
+	The checksum as it was computed before the codec was shared, kept
+	as a point of comparison. Each byte is turned into a binary string,
+	padded and parsed back. Only packets of even length are supported.
+	:param header:   A bytearray object for which we want to calculate
+	                 the sixteen bit one's compliment.
+	:return:         The sixteen bit checksum.
+	"""
+
+	total = 0
+	for i in range( 0, len( header ), 2 ):
+		left = _legacyPad( bin(header[i])[2:], 8 )
+		right = _legacyPad( bin(header[i+1])[2:], 8 )
+		total += int( left + right, 2 )
+	while( total >> 16 ):
+		total = ( total & 0xffff ) + ( total >> 16 )
+	return total ^ 0xffff
+
+def _legacyPad( string, length ):
+	"""
+	This function pads the left side of the given binary string
+	with zeros until the length of the string is equal to the
+	length specified.
+	:param string:   The binary string to pad.
+	:param length:   The desired length of the padded string.
+	:return:         The padded string.
+	"""
+
+	diff = length - len(string)
+	for i in range(0,diff):
+		string = '0' + string
+	return string
+
+def _arrayChecksum( header ):
+	"""
+	The checksum computed by adding up an array('H') of the packet's
+	words, for comparison with icmp.checksum.
+	:param header:   A bytes-like object of even length.
+	:return:         The sixteen bit checksum.
+	"""
+
+	words = array( "H", header )
+	if( sys.byteorder == "little" ):
+		words.byteswap()
+	total = sum( words )
+	while( total >> 16 ):
+		total = ( total & 0xffff ) + ( total >> 16 )
+	return total ^ 0xffff
+
+def _legacyReply( devnull ):
+	"""
+	The output of a reply as it was written before the output sinks,
+	kept as a point of comparison: the line is built by concatenation
+	and printed, with a write to the stream for every line.
+	:param devnull:   The text stream to print to.
+	:return:          None
+	"""
+
+	print( str(64) + " bytes from " + "192.0.2.1" + ": icmp_seq=" + str(1) +
+	 " ttl=" + str(64) + " time=" + "{:4.1f}".format(0.123) + " ms", file=devnull, flush=True )
+
+class _Loopback:
+	"""
+	This class stands in for a raw ICMP socket, answering every echo
+	request sent on it with an echo reply from its destination, which
+	is waiting to be read at once. The socket is always readable, so
+	the probe loop never sleeps, and what is timed is ping's own work.
+	"""
+
+	# The IPv4 header of a reply: version and header length, type of
+	# service, total length, ID, fragment offset, ttl, protocol,
+	# checksum, source and destination
+	_HEADER = bytes( [ 0x45, 0, 0, 0, 0, 0, 0, 0, 64, socket.IPPROTO_ICMP, 0, 0 ] )
+
+	def __init__( self ):
+		"""
+		This function creates the socket, with no replies waiting.
+		"""
+
+		self.type = socket.SOCK_RAW
+		self._replies = collections.deque()
+
+		# A real socket with a byte waiting, for the selector to find readable
+		self._pair = socket.socketpair()
+		self._pair[1].send( b"x" )
+
+	def close( self ):
+		"""
+		This function closes the real sockets behind the fake one.
+		:return:   None
+		"""
+
+		for sock in self._pair:
+			sock.close()
+
+	def fileno( self ):
+		"""
+		This function finds the descriptor the selector waits on.
+		:return:   The descriptor, which is always readable.
+		"""
+
+		return self._pair[0].fileno()
+
+	def setsockopt( self, *args ):
+		"""
+		This function accepts any socket option, such as a filter.
+		:return:   None
+		"""
+
+		pass
+
+	def recv( self, size, flags=0 ):
+		"""
+		This function is how a filter's backlog is discarded. There is none.
+		:raises BlockingIOError:   Always.
+		"""
+
+		raise BlockingIOError()
+
+	def sendto( self, packet, address ):
+		"""
+		This function answers an echo request, as its destination would.
+		:param packet:    The echo request.
+		:param address:   The destination and port.
+		:return:          The length of the request.
+		"""
+
+		# An echo reply is an echo request with its type and checksum changed
+		reply = bytearray( self._HEADER )
+		reply[2:4] = ( len( reply ) + 8 + len( packet ) ).to_bytes( 2, "big" )
+		reply += socket.inet_aton( address[0] ) + bytes( 4 ) + packet
+		reply[20] = icmp.ECHO_REPLY
+		total = icmp.updateChecksum( ( packet[2] << 8 ) | packet[3],
+		 icmp.ECHO_REQUEST << 8, icmp.ECHO_REPLY << 8 )
+		reply[22:24] = total.to_bytes( 2, "big" )
+
+		self._replies.append( ( reply, address ) )
+		return len( packet )
+
+	def recvmsg_into( self, buffers, ancbufsize=0, flags=0 ):
+		"""
+		This function receives the oldest reply waiting.
+		:param buffers:      A list of the buffer to receive it into.
+		:param ancbufsize:   Ignored. No ancillary data is given.
+		:param flags:        Ignored.
+		:return:             The same as socket.recvmsg_into.
+		:raises BlockingIOError:   If no reply is waiting.
+		"""
+
+		if( len( self._replies ) == 0 ):
+			raise BlockingIOError()
+		(reply, address) = self._replies.popleft()
+		nbytes = min( len( reply ), len( buffers[0] ) )
+		buffers[0][:nbytes] = reply[:nbytes]
+		return ( nbytes, [], 0, address )
+
+def _loop( format ):
+	"""
+	This function builds the benchmark of the probe loop: sending a
+	round of requests to many destinations over a _Loopback socket and
+	handling their replies, as ping does with several destinations.
+	:param format:   The output format replies are written in, or None
+	                 to count them without writing them.
+	:return:         A function of a session that sends one round, and
+	                 the session, from ping._session.
+	"""
+
+	addresses = [ "198.18." + str( k >> 8 ) + "." + str( k & 0xff ) for k in range( TARGETS ) ]
+	targets = [ ping._target( address, address, 0x4000 + k, False )
+	 for (k, address) in enumerate( addresses ) ]
+	sink = output.sink( format or "text", open( os.devnull, "wb" ) )
+	session = ping._session( _Loopback(), targets, 1.0, None, format is not None, sink )
+
+	def send( session ):
+		"""
+		This function sends one request to every destination, collecting
+		the replies after every send, as ping._rounds does.
+		:param session:   The session.
+		:return:          None
+		"""
+
+		for target in targets:
+			ping._send( session, target, 56 )
+			ping._wait( session, [ 0 ] )
+
+	return ( send, session )
+
+def _cases():
+	"""
+	This function lists every benchmark, checking first that the
+	implementations compared with each other agree.
+	:return:   A list of Case.
+	"""
+
+	cases = list()
+
+	# Checksums and echo requests of every size
+	checksums = [ ( "legacy", _legacyChecksum ), ( "array", _arrayChecksum ),
+	 ( "icmp", icmp.checksum ) ]
+	for size in SIZES:
+		packet = bytearray( range( 256 ) ) * ( size // 256 ) + bytearray( size % 256 )
+		for (name, function) in checksums:
+			if( function( packet ) != icmp.checksum( packet ) ):
+				sys.exit( "benchmark: " + name + " checksum disagrees at " + str(size) + " bytes" )
+			cases.append( Case( "checksum/" + name + "/" + str( size ), function, packet, 1,
+			 size ) )
+
+		# Building a probe should not depend on its size
+		cases.append( Case( "build/" + str( size ),
+		 lambda count, size=size: icmp.echoRequest( size - 8, count, 0x1234 ), 1, 1, size ) )
+
+	# Parsing a reply, and the request quoted by an error
+	loopback = _Loopback()
+	loopback.sendto( icmp.echoRequest( 56, 1, 0x1234 ), ( "192.0.2.1", 80 ) )
+	reply = loopback._replies[0][0]
+	loopback.close()
+	error = bytearray( reply[:20] ) + bytes( [ icmp.TIME_EXCEEDED ] ) + bytes( 7 ) + reply[:48]
+	error[2:4] = len( error ).to_bytes( 2, "big" )
+	error[28] = 0x45
+	error[44:48] = socket.inet_aton( "192.0.2.1" )
+	error[48] = icmp.ECHO_REQUEST
+	if( icmp.parseReply( reply, len( reply ) )[:4] != ( icmp.ECHO_REPLY, 0, 0x1234, 1 ) or
+	 icmp.parseQuote( error, len( error ) ) != ( "192.0.2.1", 0x1234, 1 ) ):
+		sys.exit( "benchmark: packets made up for parsing do not parse" )
+	cases.append( Case( "parse/reply", lambda packet: icmp.parseReply( packet, len( packet ) ),
+	 memoryview( reply ), 1, None ) )
+	cases.append( Case( "parse/quote", lambda packet: icmp.parseQuote( packet, len( packet ) ),
+	 memoryview( error ), 1, None ) )
+
+	# Statistics of a thousand round trip times around a millisecond
+	generator = random.Random( SEED )
+	rtts = [ generator.lognormvariate( 0, 0.5 ) for k in range( 1000 ) ]
+	full = rttstats.Accumulator()
+	for rtt in rtts:
+		full.add( rtt )
+	cases.append( Case( "stats/add", lambda rtts: _addAll( rttstats.Accumulator(), rtts ),
+	 rtts, len( rtts ), None ) )
+	cases.append( Case( "stats/add-buckets",
+	 lambda rtts: _addAll( rttstats.Accumulator( False ), rtts ), rtts, len( rtts ), None ) )
+	cases.append( Case( "stats/merge", lambda other: rttstats.Accumulator().merge( other ),
+	 full, 1, None ) )
+	cases.append( Case( "stats/percentiles",
+	 lambda stats: stats.histogram.percentiles( [ 50, 90, 99, 99.9 ] ), full, 1, None ) )
+	cases.append( Case( "stats/serialize",
+	 lambda stats: rttstats.Accumulator.fromBytes( stats.toBytes() ), full, 1, None ) )
+
+	# Writing one reply in each format, held in memory until the buffer fills
+	record = output.Reply( time.time(), "192.0.2.1", "192.0.2.1", None, 1, 64, 64, 0.123,
+	 "reply" )
+	cases.append( Case( "output/legacy", _legacyReply, open( os.devnull, "w" ), 1, None ) )
+	for format in output.FORMATS:
+		cases.append( Case( "output/" + format, output.sink( format, io.BytesIO() ).reply,
+		 record, 1, None ) )
+
+	# The whole probe loop, per request sent and reply handled
+	for format in [ None, "text" ]:
+		(function, session) = _loop( format )
+		cases.append( Case( "loop/" + ( format or "quiet" ), function, session, TARGETS,
+		 None ) )
+
+	return cases
+
+def _addAll( stats, rtts ):
+	"""
+	This function adds round trip times to an accumulator.
+	:param stats:   The rttstats.Accumulator.
+	:param rtts:    The round trip times.
+	:return:        None
+	"""
+
+	for rtt in rtts:
+		stats.add( rtt )
+
+def _time( function, argument ):
+	"""
+	This function calls the given function repeatedly until the time
+	budget is spent, a number of times over, and keeps the best.
+	:param function:   The function to time.
+	:param argument:   The argument passed to the function on every call.
+	:return:           The least average number of seconds per call.
+	"""
+
+	best = float( "inf" )
+	for run in range( RUNS ):
+		calls = 0
+		start = time.perf_counter()
+		ellapsed = 0
+		while( ellapsed < BUDGET ):
+			function( argument )
+			calls += 1
+			ellapsed = time.perf_counter() - start
+		best = min( best, ellapsed / calls )
+	return best
+
+def _compare( results, baseline, tolerance ):
+	"""
+	This function compares the results with those of an earlier run,
+	displaying how much faster or slower each case has become.
+	:param results:     The results of this run, as written by main.
+	:param baseline:    The results of the earlier run.
+	:param tolerance:   The share by which a case may be slower.
+	:return:            A list of the names of the cases slower by more
+	                    than the tolerance.
+	"""
+
+	if( baseline.get( "python" ) != results["python"] or
+	 baseline.get( "machine" ) != results["machine"] ):
+		print( "benchmark: the baseline was run on Python " + str( baseline.get( "python" ) ) +
+		 " on " + str( baseline.get( "machine" ) ) + ", so times may not compare",
+		 file=sys.stderr )
+
+	print()
+	print( "{:<24} {:>12} {:>12} {:>8}".format( "case", "baseline us", "us/op", "change" ) )
+	slower = list()
+	for (name, case) in results["cases"].items():
+		before = baseline["cases"].get( name )
+		if( before is None ):
+			print( "{:<24} {:>12} {:>12.3f} {:>8}".format( name, "-", case["seconds"] * 1e6,
+			 "new" ) )
+			continue
+
+		change = case["seconds"] / before["seconds"] - 1
+		flag = ""
+		if( change > tolerance ):
+			slower.append( name )
+			flag = "  slower"
+		print( "{:<24} {:>12.3f} {:>12.3f} {:>+7.0f}%{}".format( name,
+		 before["seconds"] * 1e6, case["seconds"] * 1e6, change * 100, flag ) )
+	return slower
+
+def _parse( strArr ):
+	"""
+	This function reads the options given on the command line.
+	:param strArr:   The arguments, without the name of the program.
+	:return:         A dictionary of the filter, the file to write the
+	                 results to, the baseline to compare them with and
+	                 the tolerance. The files are None if there are none.
+	"""
+
+	options = { "k": "", "o": None, "b": BASELINE, "r": TOLERANCE }
+	if( len( strArr ) % 2 ):
+		sys.exit( _USAGE )
+	for index in range( 0, len( strArr ), 2 ):
+		option = strArr[index][1:]
+		if( strArr[index][0] != "-" or option not in options ):
+			sys.exit( "benchmark: unknown option " + strArr[index] )
+		options[option] = strArr[index+1]
+
+	try:
+		options["r"] = float( options["r"] )
+	except ValueError:
+		sys.exit( "benchmark: bad tolerance " + options["r"] )
+	if( options["b"] == "none" ):
+		options["b"] = None
+	return options
+
+def main():
+	"""
+	The main function. It times every case whose name contains the
+	filter, and displays the time of an operation in each and its
+	throughput, then writes the results and compares them with the
+	baseline, if asked to.
+	"""
+
+	options = _parse( sys.argv[1:] )
+
+	# Read the baseline first, so a bad one does not waste a run
+	baseline = None
+	if( options["b"] is not None ):
+		try:
+			with open( options["b"] ) as stream:
+				baseline = json.load( stream )
+		except ( OSError, ValueError ) as error:
+			sys.exit( "benchmark: cannot read baseline " + options["b"] + ": " + str( error ) )
+		if( baseline.get( "version" ) != _VERSION ):
+			sys.exit( "benchmark: the baseline " + options["b"] + " is of another version" )
+
+	results = { "version": _VERSION, "python": platform.python_version(),
+	 "implementation": platform.python_implementation(), "machine": platform.machine(),
+	 "numpy": icmp.numpy is not None, "budget": BUDGET, "runs": RUNS,
+	 "cases": dict() }
+
+	print( "{:<24} {:>12} {:>14} {:>10}".format( "case", "us/op", "ops/s", "MB/s" ) )
+	for case in _cases():
+		if( options["k"] not in case.name ):
+			continue
+		seconds = _time( case.function, case.argument ) / case.operations
+		results["cases"][case.name] = { "seconds": seconds, "bytes": case.bytes }
+
+		throughput = "-" if case.bytes is None else "{:.1f}".format( case.bytes / seconds / 1e6 )
+		print( "{:<24} {:>12.3f} {:>14.0f} {:>10}".format( case.name, seconds * 1e6,
+		 1 / seconds, throughput ), flush=True )
+
+	if( options["o"] is not None ):
+		with open( options["o"], "w" ) as stream:
+			json.dump( results, stream, indent=1 )
+			stream.write( "\n" )
+
+	if( baseline is not None ):
+		slower = _compare( results, baseline, options["r"] )
+		if( len( slower ) > 0 ):
+			sys.exit( "benchmark: " + str( len( slower ) ) + " of " +
+			 str( len( results["cases"] ) ) + " cases are slower than the baseline by more "
+			 "than {:.0f}%: ".format( options["r"] * 100 ) + ", ".join( slower ) )
+
+if __name__ == "__main__":
+	main()
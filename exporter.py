@@ -0,0 +1,364 @@
+"""
+An HTTP endpoint that serves the live statistics of ping and traceroute
+in the Prometheus text format, from a thread of the same process. The
+text of every destination is kept between scrapes and only rendered
+again once its counters have changed, and the rendering is done a few
+destinations at a time by the probe loop itself, between probes, so a
+scrape of ten thousand destinations never holds the loop up for long.
+A probe loop that is sleeping between probes leaves the scrape to render
+the metrics itself, and never both at once.
+"""
+
+import http.server
+import math
+import threading
+import time
+import rttstats
+
+# The content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# The name, type and help of every metric family, in the order they
+# are written
+_FAMILIES = [
+	( "ping_sent_total", "counter", "Echo requests sent." ),
+	( "ping_received_total", "counter", "Echo requests answered before they timed out." ),
+	( "ping_duplicates_total", "counter", "Duplicate echo replies received." ),
+	( "ping_late_total", "counter", "Echo replies received after their request timed out." ),
+	( "ping_loss_ratio", "gauge", "Share of the echo requests sent that were not answered." ),
+	( "ping_rtt_seconds", "histogram", "Round trip time of the echo requests answered." ),
+	( "traceroute_hops", "gauge", "Number of hops in the last trace of the route." ),
+	( "traceroute_hop_loss_ratio", "gauge", "Share of the probes to the hop that were not answered." ),
+	( "traceroute_hop_rtt_seconds", "gauge", "Mean round trip time of the probes to the hop." )
+]
+
+# The number of seconds a scrape waits for the probe loop to render the
+# metrics before rendering them itself
+_PATIENCE = 1.0
+
+# The number of seconds since it last called refresh within which the
+# probe loop is taken to be busy, and left to render a scrape
+_BUSY = 0.1
+
+class Exporter:
+	"""
+	This class serves the metrics of the destinations it is told to
+	watch. The probe loop calls refresh whenever it wakes; while a scrape
+	is waiting, each call renders a few more destinations, and the last
+	one assembles the text the scrape is answered with. A scrape that
+	arrives soon after another is answered with the same text. If the
+	probe loop has not called refresh lately, as in a traceroute or a
+	slow ping that is waiting, the scrape renders the metrics itself.
+	Rendering is done under a lock, which refresh only tries to take,
+	so the two never render at once and the probe loop never waits.
+	"""
+
+	def __init__( self, port, address="", age=1.0 ):
+		"""
+		This function starts serving the metrics at /metrics.
+		:param port:      The TCP port to serve them on.
+		:param address:   The address to serve them on. Every address of
+		                  the host by default.
+		:param age:       The number of seconds the text of a scrape is
+		                  reused for.
+		:raises OSError:   If the port cannot be listened on.
+		"""
+
+		self.age = age
+
+		# ( "ping", host, address ) -> the record of a destination pinged,
+		# and ( "route", destination ) -> ( address, hops ) of a route
+		self._sources = dict()
+
+		# key -> ( version, list of the text of each family ) of every
+		# destination rendered
+		self._chunks = dict()
+
+		# The text of the last scrape, and when it was rendered
+		self._body = b""
+		self._rendered = -math.inf
+
+		# Scrapes are answered one at a time. A scrape sets wanted and
+		# waits for done, which the probe loop sets once it has rendered
+		# the keys in work. The chunks, work and body are only changed
+		# while rendering is locked.
+		self._lock = threading.Lock()
+		self._rendering = threading.Lock()
+		self._wanted = threading.Event()
+		self._done = threading.Event()
+		self._refreshed = -math.inf
+		self._work = None
+		self._position = 0
+
+		self._server = http.server.ThreadingHTTPServer( ( address, port ), _Handler )
+		self._server.daemon_threads = True
+		self._server.exporter = self
+		self.port = self._server.server_address[1]
+
+		thread = threading.Thread( target=self._server.serve_forever, daemon=True )
+		thread.start()
+
+	def close( self ):
+		"""
+		This function stops serving the metrics.
+		:return:   None
+		"""
+
+		self._server.shutdown()
+		self._server.server_close()
+
+	def watch( self, target ):
+		"""
+		This function serves the metrics of a destination being pinged.
+		A destination with the same name and address takes the place of
+		the last one.
+		:param target:   The record of the destination, as kept by ping,
+		                 which is read whenever the metrics are rendered.
+		:return:         None
+		"""
+
+		self._sources[ ( "ping", target["name"], target["ip"] ) ] = target
+
+	def forget( self, target ):
+		"""
+		This function stops serving the metrics of a destination.
+		:param target:   The record of the destination.
+		:return:         None
+		"""
+
+		key = ( "ping", target["name"], target["ip"] )
+		if( self._sources.get( key ) is target ):
+			del self._sources[key]
+			self._chunks.pop( key, None )
+
+	def route( self, destination, address, hops ):
+		"""
+		This function serves the route last traced to a destination.
+		:param destination:   The destination, as given by the user.
+		:param address:       The IPv4 address of the destination.
+		:param hops:          The output.Hop of every hop traced so far.
+		:return:              None
+		"""
+
+		self._sources[ ( "route", destination ) ] = ( address, tuple( hops ) )
+
+	def refresh( self, budget=64 ):
+		"""
+		This function renders a few destinations for a scrape that is
+		waiting, if there is one. It is called by the probe loop.
+		:param budget:   The largest number of destinations to render.
+		:return:         None
+		"""
+
+		self._refreshed = time.monotonic()
+		if( not self._wanted.is_set() ):
+			return
+
+		# The scrape may be rendering the metrics itself, having given up
+		if( not self._rendering.acquire( blocking=False ) ):
+			return
+		try:
+			if( not self._wanted.is_set() ):
+				return
+
+			# Start on the destinations watched when the scrape arrived
+			if( self._work is None ):
+				self._work = list( self._sources )
+				self._position = 0
+			work = self._work
+
+			end = min( self._position + budget, len( work ) )
+			for key in work[ self._position : end ]:
+				self._chunk( key )
+			self._position = end
+
+			if( end == len( work ) ):
+				self._work = None
+				self._publish( work )
+				self._wanted.clear()
+				self._done.set()
+		finally:
+			self._rendering.release()
+
+	def scrape( self ):
+		"""
+		This function finds the text a scrape is answered with, rendering
+		it again if the last is too old. It is called by the HTTP server.
+		:return:   The text, encoded.
+		"""
+
+		with self._lock:
+			if( time.monotonic() - self._rendered < self.age ):
+				return self._body
+
+			# Have the probe loop render it, if it is busy
+			if( time.monotonic() - self._refreshed < _BUSY ):
+				with self._rendering:
+					self._work = None
+					self._done.clear()
+					self._wanted.set()
+				if( self._done.wait( _PATIENCE ) ):
+					return self._body
+
+			with self._rendering:
+				self._wanted.clear()
+				self._work = None
+				keys = list( self._sources )
+				for key in keys:
+					self._chunk( key )
+				self._publish( keys )
+				return self._body
+
+	def _chunk( self, key ):
+		"""
+		This function renders the text of one destination, unless it has
+		not changed since it was last rendered.
+		:param key:   The key of the destination.
+		:return:      None
+		"""
+
+		source = self._sources.get( key )
+		if( source is None ):
+			return
+
+		if( key[0] == "ping" ):
+			version = ( source["sent"], source["stats"].count,
+			 source["counts"]["duplicates"], source["counts"]["late"] )
+		else:
+			version = source
+
+		chunk = self._chunks.get( key )
+		if( chunk is not None and chunk[0] == version ):
+			return
+
+		if( key[0] == "ping" ):
+			self._chunks[key] = ( version, _pingText( source ) )
+		else:
+			self._chunks[key] = ( version, _routeText( key[1], *source ) )
+
+	def _publish( self, keys ):
+		"""
+		This function assembles the text of a scrape from the text of
+		every destination, family by family.
+		:param keys:   The keys of the destinations.
+		:return:       None
+		"""
+
+		parts = list()
+		for (index, (name, kind, text)) in enumerate( _FAMILIES ):
+			parts.append( ( "# HELP " + name + " " + text + "\n# TYPE " + name + " " +
+			 kind + "\n" ).encode() )
+			for key in keys:
+				chunk = self._chunks.get( key )
+				if( chunk is not None ):
+					parts.append( chunk[1][index] )
+
+		self._body = b"".join( parts )
+		self._rendered = time.monotonic()
+
+class _Handler( http.server.BaseHTTPRequestHandler ):
+	"""
+	This class answers the requests made to the endpoint.
+	"""
+
+	def do_GET( self ):
+		"""
+		This function answers a scrape of /metrics, and nothing else.
+		:return:   None
+		"""
+
+		if( self.path.split( "?" )[0] != "/metrics" ):
+			self.send_error( 404 )
+			return
+
+		body = self.server.exporter.scrape()
+		self.send_response( 200 )
+		self.send_header( "Content-Type", CONTENT_TYPE )
+		self.send_header( "Content-Length", str( len( body ) ) )
+		self.end_headers()
+		self.wfile.write( body )
+
+	def log_message( self, format, *args ):
+		"""
+		This function keeps requests out of the program's output.
+		:return:   None
+		"""
+
+		pass
+
+def _pingText( target ):
+	"""
+	This function renders the metrics of a destination being pinged.
+	:param target:   The record of the destination, as kept by ping.
+	:return:         A list of the text of each family, encoded.
+	"""
+
+	labels = "host=\"" + _escape( target["name"] ) + "\",address=\"" + target["ip"] + "\""
+	stats = target["stats"]
+	sent = target["sent"]
+	loss = 0.0 if sent == 0 else ( sent - stats.count ) / sent
+
+	lines = [ "" ] * len( _FAMILIES )
+	lines[0] = "ping_sent_total{" + labels + "} " + str( sent ) + "\n"
+	lines[1] = "ping_received_total{" + labels + "} " + str( stats.count ) + "\n"
+	lines[2] = ( "ping_duplicates_total{" + labels + "} " +
+	 str( target["counts"]["duplicates"] ) + "\n" )
+	lines[3] = "ping_late_total{" + labels + "} " + str( target["counts"]["late"] ) + "\n"
+	lines[4] = "ping_loss_ratio{" + labels + "} " + repr( max( loss, 0.0 ) ) + "\n"
+
+	# The distribution, from the coarse buckets or the histogram kept
+	if( stats.buckets is not None ):
+		below = stats.buckets.cumulative()
+	else:
+		below = stats.histogram.cumulative( rttstats.Buckets.BOUNDS )
+	histogram = [ "ping_rtt_seconds_bucket{" + labels + ",le=\"" +
+	 "{:g}".format( bound / 1000 ) + "\"} " + str( count ) + "\n"
+	 for (bound, count) in zip( rttstats.Buckets.BOUNDS, below ) ]
+	histogram.append( "ping_rtt_seconds_bucket{" + labels + ",le=\"+Inf\"} " +
+	 str( stats.count ) + "\n" )
+	histogram.append( "ping_rtt_seconds_sum{" + labels + "} " +
+	 repr( stats.mean * stats.count / 1000 ) + "\n" )
+	histogram.append( "ping_rtt_seconds_count{" + labels + "} " + str( stats.count ) + "\n" )
+	lines[5] = "".join( histogram )
+
+	return [ line.encode() for line in lines ]
+
+def _routeText( destination, address, hops ):
+	"""
+	This function renders the metrics of the route traced to a
+	destination.
+	:param destination:   The destination, as given by the user.
+	:param address:       The IPv4 address of the destination.
+	:param hops:          The output.Hop of every hop traced.
+	:return:              A list of the text of each family, encoded.
+	"""
+
+	labels = "destination=\"" + _escape( destination ) + "\",address=\"" + address + "\""
+
+	lines = [ "" ] * len( _FAMILIES )
+	lines[6] = "traceroute_hops{" + labels + "} " + str( len( hops ) ) + "\n"
+
+	losses = list()
+	rtts = list()
+	for hop in hops:
+		hopLabels = ( labels + ",hop=\"" + str( hop.hop ) + "\",hop_address=\"" +
+		 ( hop.address or "" ) + "\"" )
+		answered = [ rtt for rtt in hop.rtts if rtt is not None ]
+		losses.append( "traceroute_hop_loss_ratio{" + hopLabels + "} " +
+		 repr( 1 - len( answered ) / max( len( hop.rtts ), 1 ) ) + "\n" )
+		if( len( answered ) > 0 ):
+			rtts.append( "traceroute_hop_rtt_seconds{" + hopLabels + "} " +
+			 repr( sum( answered ) / len( answered ) / 1000 ) + "\n" )
+	lines[7] = "".join( losses )
+	lines[8] = "".join( rtts )
+
+	return [ line.encode() for line in lines ]
+
+def _escape( value ):
+	"""
+	This function escapes a label value of the Prometheus text format.
+	:param value:   The value.
+	:return:        The value, with backslashes, quotes and newlines escaped.
+	"""
+
+	return value.replace( "\\", "\\\\" ).replace( "\"", "\\\"" ).replace( "\n", "\\n" )
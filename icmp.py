@@ -0,0 +1,226 @@
+"""
+Encoding and decoding of the ICMP packets used by ping and traceroute.
+"""
+
+# NumPy is optional. It is only used to checksum very large packets.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# ICMP message types
+ECHO_REPLY = 0
+DEST_UNREACHABLE = 3
+ECHO_REQUEST = 8
+TIME_EXCEEDED = 11
+
+# Packets at least this long are checksummed with NumPy, when it is installed
+NUMPY_THRESHOLD = 8192
+
+# Echo request templates, keyed by data size and identifier
+_templates = dict()
+
+def checksum( data ):
+	"""
+	This function computes the sixteen bit one's compliment checksum of
+	the given packet. Rather than adding the packet up one word at a time
+	in Python, the whole packet is read as a single big-endian integer.
+	Since 2^16 is one more than 0xffff, the one's compliment sum of the
+	sixteen bit words is that integer modulo 0xffff. A packet of odd
+	length is padded with a zero byte.
+	:param data:   A bytes-like object, such as a bytearray or memoryview,
+	               for which we want to calculate the checksum.
+	:return:       The sixteen bit checksum.
+	"""
+
+	view = memoryview( data )
+	length = len( view )
+
+	if( numpy is not None and length >= NUMPY_THRESHOLD ):
+		total = _numpySum( view )
+
+	else:
+
+		# Take the sum, padding odd packets with a zero byte
+		value = int.from_bytes( view, "big" )
+		if( length % 2 ):
+			value <<= 8
+		total = value % 0xffff
+
+		# A sum that is a multiple of 0xffff is 0xffff, unless
+		# every word is zero
+		if( total == 0 and value != 0 ):
+			total = 0xffff
+
+	# Flip every bit using XOR
+	return total ^ 0xffff
+
+def _numpySum( view ):
+	"""
+	This function computes the sixteen bit one's compliment sum of
+	the given packet using NumPy.
+	:param view:   A memoryview of the packet.
+	:return:       The sixteen bit sum.
+	"""
+
+	length = len( view )
+	even = length - ( length % 2 )
+
+	# Add the words up, then the odd byte if there is one
+	total = int( numpy.frombuffer( view[:even], dtype=">u2" ).sum( dtype=numpy.uint64 ) )
+	if( length % 2 ):
+		total += view[length - 1] << 8
+
+	# Fold the carries back into the low sixteen bits
+	while( total >> 16 ):
+		total = ( total & 0xffff ) + ( total >> 16 )
+	return total
+
+def updateChecksum( checksum, old, new ):
+	"""
+	This function updates a sixteen bit one's compliment checksum for
+	a change in one sixteen bit word of the packet, following equation
+	3 of RFC 1624, HC' = ~(~HC + ~m + m'), without summing the packet
+	again.
+	:param checksum:   The checksum of the packet before the change.
+	:param old:        The value of the word before the change.
+	:param new:        The value of the word after the change.
+	:return:           The checksum of the packet after the change.
+	"""
+
+	total = ( ~checksum & 0xffff ) + ( ~old & 0xffff ) + new
+
+	# Fold the carries back in
+	total = ( total & 0xffff ) + ( total >> 16 )
+	total = ( total & 0xffff ) + ( total >> 16 )
+
+	return ~total & 0xffff
+
+def echoRequest( size, count, ident=0 ):
+	"""
+	This function assembles an ICMP echo request packet with the given
+	amount of data, sequence number and identifier. The packet for each
+	size and identifier is only built once and then kept as a template.
+	Later calls rewrite the sequence number and update the checksum to
+	match, so the cost does not grow with the amount of data. The packet
+	returned is the template itself, and stays valid until the next call
+	with the same size and identifier.
+	:param size:    The amount of data sent in the echo request.
+	:param count:   The sequence number of this particular echo request.
+	:param ident:   The identifier of this echo request. Zero by default.
+	:return:        A bytearray representation of this echo request packet.
+	"""
+
+	# Build the template the first time this size and identifier are seen
+	key = ( size, ident )
+	icmpHeader = _templates.get( key )
+	if( icmpHeader is None ):
+		icmpHeader = _template( size, ident )
+		_templates[key] = icmpHeader
+
+	# Sequence numbers are sixteen bits long
+	count = count & 0xffff
+
+	# Update the checksum for the change in sequence number
+	old = ( icmpHeader[6] << 8 ) | icmpHeader[7]
+	total = ( icmpHeader[2] << 8 ) | icmpHeader[3]
+	total = updateChecksum( total, old, count )
+
+	# Write the new checksum and sequence number
+	icmpHeader[2] = total >> 8
+	icmpHeader[3] = total & 0xff
+	icmpHeader[6] = count >> 8
+	icmpHeader[7] = count & 0xff
+
+	return icmpHeader
+
+def _template( size, ident ):
+	"""
+	This function assembles the template of an ICMP echo request packet
+	with the given amount of data and identifier, and a sequence number
+	of zero.
+	:param size:    The amount of data sent in the echo request.
+	:param ident:   The identifier of the echo request.
+	:return:        A bytearray representation of this echo request packet.
+	"""
+
+	# The bytearray representing this echo request packet.
+	icmpHeader = bytearray( 8 + size )
+
+	# Echo type, code is zero
+	icmpHeader[0] = ECHO_REQUEST
+	icmpHeader[1] = 0
+
+	# Identifier
+	icmpHeader[4] = ( ident >> 8 ) & 0xff
+	icmpHeader[5] = ident & 0xff
+
+	# Send bytes of ones as data
+	icmpHeader[8:] = b"\x01" * size
+
+	# Compute the 16-bit one's compliment of this packet. The
+	# checksum and sequence number start as zero.
+	total = checksum( icmpHeader )
+	icmpHeader[2] = total >> 8
+	icmpHeader[3] = total & 0xff
+
+	return icmpHeader
+
+def parseReply( packet, nbytes ):
+	"""
+	This function decodes the IPv4 and ICMP headers of a packet read
+	from a raw socket.
+	:param packet:   The received packet, starting with its IPv4 header.
+	:param nbytes:   The number of bytes received.
+	:return:         A tuple of the ICMP type, code, identifier, sequence
+	                 number, the ttl and the size of the ICMP message, or
+	                 None if the packet is too short to hold both headers.
+	"""
+
+	# Length of the IPv4 header
+	ihl = ( packet[0] & 0x0f ) * 4
+	if( nbytes < ihl + 8 ):
+		return None
+
+	# Size of the ICMP message, from the total length of the IPv4 packet
+	size = ( ( packet[2] << 8 ) | packet[3] ) - ihl
+
+	# TTL
+	ttl = packet[8]
+
+	# ICMP type, code, identifier and sequence number
+	icmpType = packet[ihl]
+	code = packet[ihl+1]
+	ident = ( packet[ihl+4] << 8 ) | packet[ihl+5]
+	seq = ( packet[ihl+6] << 8 ) | packet[ihl+7]
+
+	return ( icmpType, code, ident, seq, ttl, size )
+
+def parseQuote( packet, nbytes ):
+	"""
+	This function decodes the echo request quoted by an ICMP error,
+	such as Time Exceeded or Destination Unreachable, read from a raw
+	socket. Errors quote the IPv4 header of the packet that caused them
+	and at least the first eight bytes after it.
+	:param packet:   The received error, starting with its IPv4 header.
+	:param nbytes:   The number of bytes received.
+	:return:         A tuple of the destination of the quoted packet,
+	                 as a dotted string, and its identifier and sequence
+	                 number, or None if the quoted packet is not an echo
+	                 request or is cut short.
+	"""
+
+	# Skip the outer IPv4 header and the ICMP header
+	start = ( packet[0] & 0x0f ) * 4 + 8
+	if( nbytes < start + 20 ):
+		return None
+
+	# Then the quoted IPv4 header
+	ihl = ( packet[start] & 0x0f ) * 4
+	if( nbytes < start + ihl + 8 or packet[start+ihl] != ECHO_REQUEST ):
+		return None
+
+	destination = ".".join( str( byte ) for byte in packet[start+16:start+20] )
+	ident = ( packet[start+ihl+4] << 8 ) | packet[start+ihl+5]
+	seq = ( packet[start+ihl+6] << 8 ) | packet[start+ihl+7]
+	return ( destination, ident, seq )
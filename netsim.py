@@ -0,0 +1,659 @@
+"""
+A simulated network that ping and traceroute can probe in place of the
+real one, without root and without sending a packet. Requests sent on
+its sockets are answered by made up routers and hosts after a delay
+drawn from each hop's distribution of latencies, and may be lost,
+duplicated, held back so later replies overtake them, or, for the
+Time Exceeded errors of routers, dropped by rate limiting. Every
+decision is drawn from one seeded generator in the order requests are
+sent, so a run that sends the same requests sees the same network.
+
+A network is described in Python:
+
+	network = netsim.Network( seed=1 )
+	network.router( "10.0.0.1", latency=( "normal", 0.5, 0.1 ), rate=100 )
+	network.router( "10.0.0.2", latency=2, loss=0.01 )
+	network.route( "10.1.0.0/16", [ "10.0.0.1", "10.0.0.2" ],
+	 latency=( "lognormal", 1, 0.5 ), duplicate=0.001, reorder=0.01 )
+	transport.simulate( network )
+
+or in a JSON file of the same, read by Network.load and given to ping
+and traceroute by their -E option:
+
+	{ "seed": 1,
+	  "routers": [ { "address": "10.0.0.1", "latency": [ "normal", 0.5, 0.1 ],
+	                 "rate": 100 },
+	               { "address": "10.0.0.2", "latency": 2, "loss": 0.01 } ],
+	  "routes": [ { "prefix": "10.1.0.0/16", "path": [ "10.0.0.1", "10.0.0.2" ],
+	                "latency": [ "lognormal", 1, 0.5 ], "duplicate": 0.001,
+	                "reorder": 0.01 } ] }
+
+Latencies are in milliseconds, and are either a number or one of
+( "fixed", value ), ( "uniform", low, high ), ( "normal", mean,
+deviation ), ( "exponential", mean ), ( "lognormal", median, sigma ) or
+( "pareto", minimum, alpha ).
+"""
+
+import collections
+import heapq
+import ipaddress
+import json
+import math
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+import icmp
+import probe
+import transport
+
+# The settings of a router or host, and their defaults: the round trip
+# time it adds in milliseconds, the share of packets through it that
+# are lost each way, the shares of its answers that are duplicated and
+# held back, the number of milliseconds they are held back for, the
+# number of Time Exceeded errors it may send per second and at once,
+# and whether it never sends them
+_SETTINGS = { "latency": 0, "loss": 0.0, "duplicate": 0.0, "reorder": 0.0, "hold": 10.0,
+ "rate": math.inf, "burst": 50, "silent": False }
+
+# The distributions of latencies, and the number of parameters of each
+_DISTRIBUTIONS = { "fixed": 1, "uniform": 2, "normal": 2, "exponential": 1,
+ "lognormal": 2, "pareto": 2 }
+
+# The IPv4 header of a packet made up by the network: version and
+# header length, type of service, total length, ID, fragment offset,
+# ttl, protocol, checksum, source and destination
+_IP_HEADER = struct.Struct( "!BBHHHBBH4s4s" )
+
+# The stamp of when a packet arrived, as the kernel gives it
+_TIMESPEC = struct.Struct( "@ll" )
+
+# The most bytes of the request a Time Exceeded error quotes, which
+# keeps the error within 576 bytes
+_QUOTE = 576 - 2 * _IP_HEADER.size - 8
+
+# The ttl requests are sent with unless a socket is set otherwise
+_TTL = 64
+
+class Network:
+	"""
+	This class holds the routers and routes of a simulated network, and
+	delivers the replies to the requests sent on its sockets. Replies
+	that are due at once are delivered as the request is sent, and the
+	rest by a thread that sleeps until the next is due, so the sockets
+	become readable at the right time to whatever waits on them.
+	"""
+
+	def __init__( self, seed=0 ):
+		"""
+		This function creates a network without routers or routes, in
+		which every request is lost.
+		:param seed:   The seed of the generator every decision is drawn from.
+		"""
+
+		self.seed = seed
+		self._random = random.Random( seed )
+
+		# address -> settings of every router, and ( network, path,
+		# settings ) of every route, longest prefix first
+		self._routers = dict()
+		self._routes = list()
+
+		# address -> list of the ( address, settings ) of every hop to each
+		# destination sent to, the last hop being the destination itself,
+		# or None if no route leads to it
+		self._paths = dict()
+
+		# The rate limits of routers' errors, by address, and when the
+		# last answer from each hop of each path arrives, in milliseconds
+		self._buckets = dict()
+		self._latest = dict()
+
+		# ( due, serial, socket, packet, sender, stamp ) of every reply
+		# not yet delivered, soonest first, and the thread that delivers
+		# them, which is started in each process that needs one
+		self._pid = None
+		self._serial = 0
+		self._start()
+
+	@classmethod
+	def load( cls, path ):
+		"""
+		This function reads a network from a JSON file, as described at
+		the top of this module.
+		:param path:   The file.
+		:return:       The Network.
+		:raises OSError:      If the file cannot be read.
+		:raises ValueError:   If it does not describe a network.
+		"""
+
+		with open( path ) as stream:
+			description = json.load( stream )
+		if( not isinstance( description, dict ) ):
+			raise ValueError( "a network is described by an object" )
+
+		network = cls( description.get( "seed", 0 ) )
+		try:
+			for router in description.get( "routers", [] ):
+				router = dict( router )
+				network.router( router.pop( "address" ), **router )
+			for route in description.get( "routes", [] ):
+				route = dict( route )
+				network.route( route.pop( "prefix" ), route.pop( "path", [] ), **route )
+		except ( KeyError, TypeError ) as error:
+			raise ValueError( "bad router or route: " + str( error ) )
+		return network
+
+	def router( self, address, **settings ):
+		"""
+		This function adds a router, or changes the settings of one.
+		:param address:    Its IPv4 address.
+		:param settings:   Any of latency, loss, duplicate, reorder, hold,
+		                   rate, burst and silent, as described by _SETTINGS.
+		:return:           None
+		:raises ValueError:   If a setting is not valid.
+		"""
+
+		self._routers[ str( ipaddress.IPv4Address( address ) ) ] = _settings( settings )
+		self._paths.clear()
+
+	def route( self, prefix, path, **settings ):
+		"""
+		This function adds the route to a range of hosts.
+		:param prefix:     The range, such as "10.1.0.0/16".
+		:param path:       The addresses of the routers in the way, nearest
+		                   first, each of which must have been added.
+		:param settings:   The settings of the hosts, as for router.
+		:return:           None
+		:raises ValueError:   If the range, a router or a setting is not valid.
+		"""
+
+		for address in path:
+			if( address not in self._routers ):
+				raise ValueError( "unknown router " + str( address ) )
+
+		self._routes.append( ( ipaddress.IPv4Network( prefix ), list( path ),
+		 _settings( settings ) ) )
+		self._routes.sort( key=lambda route: -route[0].prefixlen )
+		self._paths.clear()
+
+	def socket( self ):
+		"""
+		This function opens a socket on the network.
+		:return:   The Socket.
+		"""
+
+		return Socket( self )
+
+	def _start( self ):
+		"""
+		This function prepares the delivery of replies in this process.
+		A process forked from another has no thread of its own, so it
+		starts afresh, with no replies pending.
+		:return:   None
+		"""
+
+		if( self._pid == os.getpid() ):
+			return
+		self._pid = os.getpid()
+		self._pending = list()
+		self._condition = threading.Condition()
+		self._thread = None
+
+	def _path( self, destination ):
+		"""
+		This function finds the hops to a destination.
+		:param destination:   The IPv4 address of the destination.
+		:return:              A list of the address and settings of every
+		                      hop, the destination last, or None if no
+		                      route leads to it.
+		"""
+
+		if( destination in self._paths ):
+			return self._paths[destination]
+
+		hops = None
+		address = ipaddress.IPv4Address( destination )
+		for (network, path, settings) in self._routes:
+			if( address in network ):
+				hops = [ ( router, self._routers[router] ) for router in path ]
+				hops.append( ( destination, settings ) )
+				break
+		self._paths[destination] = hops
+		return hops
+
+	def _send( self, sock, packet, destination, ttl ):
+		"""
+		This function sends a request across the network, and schedules
+		the replies to it.
+		:param sock:          The Socket it is sent on.
+		:param packet:        The ICMP message.
+		:param destination:   The IPv4 address it is sent to.
+		:param ttl:           The ttl it is sent with.
+		:return:              None
+		"""
+
+		# Only echo requests are answered
+		if( len( packet ) < 8 or packet[0] != icmp.ECHO_REQUEST ):
+			return
+		hops = self._path( destination )
+		if( hops is None or ttl <= 0 ):
+			return
+
+		now = time.perf_counter()
+		sample = self._random.random
+		reached = min( ttl, len( hops ) )
+
+		# The request crosses every hop up to the one where it ends, and
+		# the answer comes back across those before it
+		delay = 0.0
+		lost = False
+		for (address, settings) in hops[ : reached ]:
+			delay += _latency( self._random, settings["latency"] )
+			lost |= sample() < settings["loss"]
+		for (address, settings) in hops[ : reached - 1 ]:
+			lost |= sample() < settings["loss"]
+		if( lost ):
+			return
+
+		# The destination answers, or the router where the ttl ran out
+		(sender, settings) = hops[ reached - 1 ]
+		if( reached == len( hops ) ):
+			answer = _echoReply( packet, sender, _TTL - reached + 1 )
+		else:
+			if( settings["silent"] ):
+				return
+			bucket = self._buckets.get( sender )
+			if( bucket is None ):
+				bucket = probe.TokenBucket( settings["rate"], settings["burst"], now )
+				self._buckets[sender] = bucket
+			if( bucket.take( now, 1 ) == 0 ):
+				return
+			answer = _timeExceeded( packet, sender, destination, _TTL - reached + 1 )
+
+		# Answers along the same path keep their order, however their
+		# latencies were drawn, unless they are held back
+		key = ( destination, reached )
+		arrival = max( now * 1000 + delay, self._latest.get( key, 0.0 ) )
+		self._latest[key] = arrival
+		delay = arrival - now * 1000
+		if( sample() < settings["reorder"] ):
+			delay += settings["hold"]
+		self._schedule( sock, answer, sender, now, delay )
+		if( sample() < settings["duplicate"] ):
+			self._schedule( sock, answer, sender, now,
+			 delay + _latency( self._random, settings["latency"] ) )
+
+	def _schedule( self, sock, packet, sender, now, delay ):
+		"""
+		This function delivers a reply once it is due.
+		:param sock:     The Socket it is for.
+		:param packet:   The reply, with its IPv4 header.
+		:param sender:   The IPv4 address it comes from.
+		:param now:      When the request was sent, by time.perf_counter().
+		:param delay:    The number of milliseconds until it arrives.
+		:return:         None
+		"""
+
+		stamp = time.time_ns() + int( delay * 1000000 )
+		self._start()
+		with self._condition:
+			if( delay <= 0 ):
+				sock._deliver( packet, sender, stamp )
+				return
+
+			self._serial += 1
+			due = now + delay / 1000
+			heapq.heappush( self._pending, ( due, self._serial, sock, packet, sender, stamp ) )
+
+			# Wake the thread if this reply is due before the others
+			if( self._thread is None ):
+				self._thread = threading.Thread( target=self._deliver, daemon=True )
+				self._thread.start()
+			elif( self._pending[0][1] == self._serial ):
+				self._condition.notify()
+
+	def _deliver( self ):
+		"""
+		This function runs in the thread that delivers replies, and
+		sleeps until the next is due.
+		:return:   None
+		"""
+
+		pending = self._pending
+		with self._condition:
+			while( True ):
+				now = time.perf_counter()
+				while( len( pending ) > 0 and pending[0][0] <= now ):
+					(due, serial, sock, packet, sender, stamp) = heapq.heappop( pending )
+					sock._deliver( packet, sender, stamp )
+				self._condition.wait( pending[0][0] - now if len( pending ) > 0 else None )
+
+class Socket:
+	"""
+	This class stands in for a raw ICMP socket on a Network, with the
+	methods of one that ping and traceroute use. Replies wait in a queue
+	until they are read, and a real socket pair is kept readable while
+	any do, so that selectors and event loops can wait on it.
+	"""
+
+	family = socket.AF_INET
+	type = socket.SOCK_RAW
+	proto = socket.IPPROTO_ICMP
+
+	def __init__( self, network ):
+		"""
+		This function opens the socket.
+		:param network:   The Network.
+		"""
+
+		self._network = network
+		network._start()
+		self._ttl = _TTL
+		self._timeout = None
+		self._stamps = False
+
+		# ( packet, sender, stamp ) of every reply waiting to be read,
+		# and how many bytes they hold, up to the size of the receive
+		# buffer
+		self._queue = collections.deque()
+		self._queued = 0
+		self._buffer = 212992
+
+		# Holds a byte while any reply is waiting
+		self._signal = socket.socketpair()
+		for end in self._signal:
+			end.setblocking( False )
+
+	def close( self ):
+		"""
+		This function closes the socket. Replies still to come are dropped.
+		:return:   None
+		"""
+
+		if( self._signal is not None ):
+			with self._network._condition:
+				for end in self._signal:
+					end.close()
+				self._signal = None
+				self._queue.clear()
+
+	def fileno( self ):
+		"""
+		This function finds the descriptor to wait on for replies.
+		:return:   The descriptor, or -1 if the socket is closed.
+		"""
+
+		if( self._signal is None ):
+			return -1
+		return self._signal[0].fileno()
+
+	def settimeout( self, timeout ):
+		"""
+		This function sets how long a receive waits for a reply.
+		:param timeout:   The number of seconds, zero not to wait, or None
+		                  to wait for ever.
+		:return:          None
+		"""
+
+		self._timeout = timeout
+
+	def gettimeout( self ):
+		"""
+		This function finds how long a receive waits for a reply.
+		:return:   The number of seconds, as set by settimeout.
+		"""
+
+		return self._timeout
+
+	def setblocking( self, flag ):
+		"""
+		This function sets whether a receive waits for a reply.
+		:param flag:   True to wait for ever, False not to wait.
+		:return:       None
+		"""
+
+		self._timeout = None if flag else 0.0
+
+	def setsockopt( self, level, option, value ):
+		"""
+		This function sets the options the network takes notice of: the
+		ttl, the size of the receive buffer, and the stamping of replies.
+		Any other option, such as a filter, is accepted and ignored.
+		:param level:    The level of the option.
+		:param option:   The option.
+		:param value:    Its value.
+		:return:         None
+		"""
+
+		if( level == socket.SOL_IP and option == socket.IP_TTL ):
+			if( not 0 < value < 256 ):
+				raise OSError( 22, "Invalid argument" )
+			self._ttl = value
+		elif( level == socket.SOL_SOCKET and option == socket.SO_RCVBUF ):
+			self._buffer = 2 * value
+		elif( level == socket.SOL_SOCKET and option == transport.SO_TIMESTAMPNS ):
+			self._stamps = bool( value )
+
+	def getsockopt( self, level, option ):
+		"""
+		This function reads an option set by setsockopt.
+		:param level:    The level of the option.
+		:param option:   The option.
+		:return:         Its value, or zero for an option not kept.
+		"""
+
+		if( level == socket.SOL_IP and option == socket.IP_TTL ):
+			return self._ttl
+		if( level == socket.SOL_SOCKET and option == socket.SO_RCVBUF ):
+			return self._buffer
+		return 0
+
+	def sendto( self, packet, address ):
+		"""
+		This function sends an ICMP message across the network.
+		:param packet:    The ICMP message.
+		:param address:   The IPv4 address to send it to, and a port.
+		:return:          The number of bytes sent.
+		"""
+
+		self._network._send( self, bytes( packet ), address[0], self._ttl )
+		return len( packet )
+
+	def recvmsg_into( self, buffers, ancbufsize=0, flags=0 ):
+		"""
+		This function receives the oldest reply waiting, waiting for one
+		as long as the timeout allows.
+		:param buffers:      A list of the buffer to receive it into.
+		:param ancbufsize:   Room for ancillary data. The stamp of when
+		                     the reply arrived is given if there is room
+		                     and stamps were asked for.
+		:param flags:        socket.MSG_DONTWAIT not to wait.
+		:return:             The same as socket.recvmsg_into.
+		:raises BlockingIOError:   If none is waiting, and it may not wait.
+		:raises socket.timeout:    If none arrives in time.
+		"""
+
+		(packet, sender, stamp) = self._take( flags & socket.MSG_DONTWAIT )
+		nbytes = min( len( packet ), len( buffers[0] ) )
+		buffers[0][ : nbytes ] = packet[ : nbytes ]
+
+		ancdata = list()
+		if( self._stamps and ancbufsize >= transport.ANCILLARY_SIZE ):
+			ancdata.append( ( socket.SOL_SOCKET, transport.SO_TIMESTAMPNS,
+			 _TIMESPEC.pack( stamp // 1000000000, stamp % 1000000000 ) ) )
+		return ( nbytes, ancdata, 0, ( sender, 0 ) )
+
+	def recvfrom_into( self, buffer, nbytes=0, flags=0 ):
+		"""
+		This function receives the oldest reply waiting, as recvmsg_into.
+		:param buffer:   The buffer to receive it into.
+		:param nbytes:   Ignored. The reply is cut to fit the buffer.
+		:param flags:    socket.MSG_DONTWAIT not to wait.
+		:return:         The number of bytes received and the sender.
+		"""
+
+		(nbytes, ancdata, msgFlags, address) = self.recvmsg_into( [ buffer ], 0, flags )
+		return ( nbytes, address )
+
+	def recv( self, size, flags=0 ):
+		"""
+		This function receives the oldest reply waiting, as recvmsg_into.
+		:param size:    The most bytes to return.
+		:param flags:   socket.MSG_DONTWAIT not to wait.
+		:return:        The reply.
+		"""
+
+		(packet, sender, stamp) = self._take( flags & socket.MSG_DONTWAIT )
+		return packet[ : size ]
+
+	def _take( self, dontwait ):
+		"""
+		This function takes the oldest reply from the queue.
+		:param dontwait:   If true, do not wait whatever the timeout.
+		:return:           Its packet, sender and stamp.
+		:raises BlockingIOError:   If none is waiting, and it may not wait.
+		:raises socket.timeout:    If none arrives in time.
+		"""
+
+		deadline = None if self._timeout is None else time.monotonic() + self._timeout
+		while( True ):
+			with self._network._condition:
+				if( self._signal is None ):
+					raise OSError( 9, "Bad file descriptor" )
+				if( len( self._queue ) > 0 ):
+					reply = self._queue.popleft()
+					self._queued -= len( reply[0] )
+					if( len( self._queue ) == 0 ):
+						self._signal[0].recv( 16 )
+					return reply
+				signal = self._signal[0]
+
+			if( dontwait or self._timeout == 0 ):
+				raise BlockingIOError( 11, "Resource temporarily unavailable" )
+			remaining = None if deadline is None else max( deadline - time.monotonic(), 0 )
+			if( len( select.select( [ signal ], [], [], remaining )[0] ) == 0 ):
+				raise socket.timeout( "timed out" )
+
+	def _deliver( self, packet, sender, stamp ):
+		"""
+		This function queues a reply. It is called with the network's
+		lock held. A reply that does not fit in the receive buffer is
+		dropped, as the kernel would.
+		:param packet:   The reply.
+		:param sender:   The IPv4 address it comes from.
+		:param stamp:    When it arrived, in nanoseconds since the epoch.
+		:return:         None
+		"""
+
+		if( self._signal is None or self._queued + len( packet ) > self._buffer ):
+			return
+		self._queue.append( ( packet, sender, stamp ) )
+		self._queued += len( packet )
+		if( len( self._queue ) == 1 ):
+			self._signal[1].send( b"x" )
+
+def _settings( given ):
+	"""
+	This function checks the settings of a router or host.
+	:param given:   The settings given, as described by _SETTINGS.
+	:return:        A dictionary of every setting, with the defaults of
+	                those not given.
+	:raises ValueError:   If a setting is unknown or not valid.
+	"""
+
+	settings = dict( _SETTINGS )
+	for (name, value) in given.items():
+		if( name not in settings ):
+			raise ValueError( "unknown setting " + name )
+		settings[name] = value
+
+	for name in [ "loss", "duplicate", "reorder" ]:
+		if( not 0 <= settings[name] <= 1 ):
+			raise ValueError( "bad share " + name + ": " + str( settings[name] ) )
+	if( not settings["hold"] >= 0 or not settings["rate"] >= 0 or not settings["burst"] >= 1 ):
+		raise ValueError( "bad hold, rate or burst" )
+
+	# A latency is a distribution and its parameters
+	latency = settings["latency"]
+	if( isinstance( latency, ( int, float ) ) ):
+		latency = ( "fixed", latency )
+	latency = tuple( latency )
+	if( len( latency ) == 0 or _DISTRIBUTIONS.get( latency[0] ) != len( latency ) - 1 or
+	 not all( isinstance( value, ( int, float ) ) for value in latency[1:] ) ):
+		raise ValueError( "bad latency " + str( settings["latency"] ) )
+	settings["latency"] = latency
+	return settings
+
+def _latency( generator, latency ):
+	"""
+	This function draws a latency from its distribution.
+	:param generator:   The random.Random to draw from.
+	:param latency:     The distribution and its parameters, as checked
+	                    by _settings.
+	:return:            The latency, in milliseconds. Never negative.
+	"""
+
+	kind = latency[0]
+	if( kind == "fixed" ):
+		value = latency[1]
+	elif( kind == "uniform" ):
+		value = generator.uniform( latency[1], latency[2] )
+	elif( kind == "normal" ):
+		value = generator.gauss( latency[1], latency[2] )
+	elif( kind == "exponential" ):
+		value = generator.expovariate( 1 / latency[1] ) if latency[1] > 0 else 0
+	elif( kind == "lognormal" ):
+		value = latency[1] * math.exp( generator.gauss( 0, latency[2] ) )
+	else:
+		value = latency[1] * generator.paretovariate( latency[2] )
+	return max( value, 0.0 )
+
+def _echoReply( request, sender, ttl ):
+	"""
+	This function answers an echo request.
+	:param request:   The echo request, without an IPv4 header.
+	:param sender:    The IPv4 address of the host answering.
+	:param ttl:       The ttl of the reply when it arrives.
+	:return:          The echo reply, with its IPv4 header.
+	"""
+
+	reply = bytearray( _IP_HEADER.pack( 0x45, 0, _IP_HEADER.size + len( request ), 0, 0, ttl,
+	 socket.IPPROTO_ICMP, 0, socket.inet_aton( sender ), bytes( 4 ) ) ) + request
+
+	# An echo reply is the request with its type, and so checksum, changed
+	start = _IP_HEADER.size
+	reply[start] = icmp.ECHO_REPLY
+	total = icmp.updateChecksum( ( request[2] << 8 ) | request[3], icmp.ECHO_REQUEST << 8,
+	 icmp.ECHO_REPLY << 8 )
+	reply[start+2] = total >> 8
+	reply[start+3] = total & 0xff
+	return bytes( reply )
+
+def _timeExceeded( request, sender, destination, ttl ):
+	"""
+	This function makes up the Time Exceeded error a router sends for a
+	request whose ttl ran out there.
+	:param request:       The echo request, without an IPv4 header.
+	:param sender:        The IPv4 address of the router.
+	:param destination:   The IPv4 address the request was sent to.
+	:param ttl:           The ttl of the error when it arrives.
+	:return:              The error, with its IPv4 header.
+	"""
+
+	quote = request[ : _QUOTE ]
+	message = bytearray( [ icmp.TIME_EXCEEDED, 0, 0, 0, 0, 0, 0, 0 ] )
+	message += _IP_HEADER.pack( 0x45, 0, _IP_HEADER.size + len( request ), 0, 0, 1,
+	 socket.IPPROTO_ICMP, 0, bytes( 4 ), socket.inet_aton( destination ) )
+	message += quote
+
+	total = icmp.checksum( message )
+	message[2] = total >> 8
+	message[3] = total & 0xff
+
+	return _IP_HEADER.pack( 0x45, 0, _IP_HEADER.size + len( message ), 0, 0, ttl,
+	 socket.IPPROTO_ICMP, 0, socket.inet_aton( sender ), bytes( 4 ) ) + bytes( message )
@@ -0,0 +1,626 @@
+"""
+Writing the results of ping and traceroute, either as text for people
+or as records for programs, through a buffer that is flushed once it
+is large enough or old enough rather than on every line.
+"""
+
+import collections
+import json
+import math
+import socket
+import struct
+import sys
+import time
+
+# The output formats, as named by the -o option
+FORMATS = [ "text", "json", "csv", "binary" ]
+
+# One echo reply. time is when it was read, in seconds since the epoch,
+# name is None if the sender's name is not known, rtt is in milliseconds
+# and status is one of the probe module's REPLY, REORDERED, DUPLICATE
+# or LATE.
+Reply = collections.namedtuple( "Reply",
+ [ "time", "host", "address", "name", "seq", "ttl", "size", "rtt", "status" ] )
+
+# One hop of a route. address is None if no probe was answered, and
+# rtts holds the round trip time of each probe in milliseconds, or
+# None for a probe that went unanswered.
+Hop = collections.namedtuple( "Hop", [ "hop", "address", "name", "rtts" ] )
+
+# The statistics of one destination. Times are in milliseconds, and
+# those of the round trip times are None if no reply was received. The
+# percentiles are also None if no histogram of the times was kept.
+Summary = collections.namedtuple( "Summary",
+ [ "host", "address", "sent", "received", "duplicates", "late", "reordered",
+ "loss", "elapsed", "minimum", "mean", "maximum", "mdev",
+ "p50", "p90", "p99", "p999" ] )
+
+# The rolling statistics of one hop of a route probed over and over.
+# time is when they were taken, in seconds since the epoch, sent is the
+# number of probes they cover and loss the percentage of those lost.
+# Times are in milliseconds, and are None if no probe was answered.
+Statistics = collections.namedtuple( "Statistics",
+ [ "time", "hop", "address", "name", "sent", "loss", "last", "mean", "best", "worst",
+ "stdev", "p50", "p90", "p99" ] )
+
+# The status of a reply, as numbered in the binary format
+_STATUSES = [ "reply", "reordered", "duplicate", "late" ]
+
+# Layout of the binary records, each of which starts with its kind:
+# a reply, a hop followed by the round trip time of each of its probes
+# (NaN for one unanswered), a summary (NaN for times not known), and
+# the statistics of a hop (likewise)
+_REPLY = struct.Struct( "<BQ4sHBHdB" )
+_HOP = struct.Struct( "<BB4sB" )
+_RTT = struct.Struct( "<d" )
+_SUMMARY = struct.Struct( "<B4sIIIIIddddddddd" )
+_STATISTICS = struct.Struct( "<BQB4sIddddddddd" )
+_KINDS = { "reply": 1, "hop": 2, "summary": 3, "statistics": 4 }
+
+# The columns of the statistics of the hops, as text shows them
+_COLUMNS = "{:>3}  {:<32} {:>6} {:>5} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7}"
+
+class BufferedWriter:
+	"""
+	This class gathers output in memory and writes it to a stream in
+	one call once enough of it has built up, or once the oldest of it
+	has waited long enough, so that a fast ping does not make a system
+	call for every line. The caller polls the writer while idle so that
+	the time limit holds even when no more output arrives.
+	"""
+
+	def __init__( self, stream, size=65536, interval=None ):
+		"""
+		This function creates an empty writer.
+		:param stream:     The binary stream to write to.
+		:param size:       The number of bytes held before writing them.
+		:param interval:   The number of seconds output may be held before
+		                   it is written. If None, output to a terminal is
+		                   written at once, and any other output is held
+		                   for up to a second.
+		"""
+
+		if( interval is None ):
+			interval = 0 if stream.isatty() else 1.0
+
+		self.size = size
+		self.interval = interval
+		self._stream = stream
+
+		# The output held, its length, and when the oldest of it arrived
+		self._parts = list()
+		self._pending = 0
+		self._since = None
+
+	def write( self, data ):
+		"""
+		This function adds output to the buffer, writing the buffer
+		out if it is full or has been held long enough.
+		:param data:   The bytes to write.
+		:return:       None
+		"""
+
+		self._parts.append( data )
+		self._pending += len( data )
+		if( self._since is None ):
+			self._since = time.perf_counter()
+		if( self._pending >= self.size or self.interval == 0 ):
+			self.flush()
+		else:
+			self.poll()
+
+	def deadline( self ):
+		"""
+		This function finds when the output held must be written.
+		:return:   That time, in seconds by time.perf_counter(), or None
+		           if nothing is held.
+		"""
+
+		if( self._since is None ):
+			return None
+		return self._since + self.interval
+
+	def poll( self ):
+		"""
+		This function writes the output held if it has been held long enough.
+		:return:   None
+		"""
+
+		if( self._since is not None and time.perf_counter() >= self._since + self.interval ):
+			self.flush()
+
+	def flush( self ):
+		"""
+		This function writes all the output held.
+		:return:   None
+		"""
+
+		if( self._pending > 0 ):
+			self._stream.write( b"".join( self._parts ) )
+			self._stream.flush()
+		self._parts = list()
+		self._pending = 0
+		self._since = None
+
+class TextSink:
+	"""
+	This class writes results as the lines iputils ping and traceroute
+	display.
+	"""
+
+	def __init__( self, writer, hopLoss=False, live=False ):
+		"""
+		This function creates a sink.
+		:param writer:    The BufferedWriter to write through.
+		:param hopLoss:   If true, the share of probes lost is added to
+		                  every hop, as traceroute's -S option asks.
+		:param live:      If true, the statistics of a hop are written
+		                  over its line of a table on a terminal, rather
+		                  than below everything written so far.
+		"""
+
+		self.writer = writer
+		self.hopLoss = hopLoss
+		self.live = live
+
+		# The row of the table of statistics of every hop, and the line
+		# last written in each row
+		self._rows = dict()
+		self._lines = list()
+
+	def comment( self, line ):
+		"""
+		This function writes a line meant for people only, such as a
+		header. It is left out of the other formats.
+		:param line:   The line, without its newline.
+		:return:       None
+		"""
+
+		self.writer.write( ( line + "\n" ).encode() )
+
+	def reply( self, record ):
+		"""
+		This function writes an echo reply.
+		:param record:   The Reply.
+		:return:         None
+		"""
+
+		note = ""
+		if( record.status == "duplicate" ):
+			note = " (DUP!)"
+		elif( record.status == "late" ):
+			note = " (LATE)"
+
+		sender = record.address
+		if( record.name is not None ):
+			sender = record.name + " (" + record.address + ")"
+		self.comment( "{} bytes from {}: icmp_seq={} ttl={} time={:4.1f} ms{}".format(
+		 record.size, sender, record.seq, record.ttl, record.rtt, note ) )
+
+	def hop( self, record ):
+		"""
+		This function writes one hop of a route.
+		:param record:   The Hop.
+		:return:         None
+		"""
+
+		# A hop that did not answer is shown by its number alone
+		if( record.address is None ):
+			output = str( record.hop ) + "  "
+		elif( record.name is None ):
+			output = str( record.hop ) + "  " + record.address + " "
+		else:
+			output = str( record.hop ) + "  " + record.name + "  (" + record.address + ")  "
+
+		for rtt in record.rtts:
+			if( rtt is None ):
+				output += "* "
+			else:
+				output += "{:4.3f}".format( rtt ) + " ms "
+
+		if( self.hopLoss ):
+			lost = record.rtts.count( None )
+			output += " (" + "{:.0f}".format( lost / len( record.rtts ) * 100 ) + "% loss)"
+		self.comment( output )
+
+	def statistics( self, record ):
+		"""
+		This function writes the statistics of one hop as a row of a
+		table, under a heading written with the first row. A row is only
+		written again once it has changed.
+		:param record:   The Statistics.
+		:return:         None
+		"""
+
+		host = "???"
+		if( record.name is not None ):
+			host = record.name
+		elif( record.address is not None ):
+			host = record.address
+		times = [ "" if value is None else "{:.1f}".format( value ) for value in
+		 ( record.last, record.mean, record.best, record.worst, record.stdev,
+		 record.p50, record.p90, record.p99 ) ]
+		line = _COLUMNS.format( str( record.hop ) + ".", host[:32],
+		 "{:.1f}%".format( record.loss ), record.sent, *times ).rstrip()
+
+		row = self._rows.get( record.hop )
+		if( row is None ):
+			if( len( self._lines ) == 0 ):
+				self.comment( _COLUMNS.format( "", "Host", "Loss%", "Snt", "Last", "Avg",
+				 "Best", "Wrst", "StDev", "p50", "p90", "p99" ) )
+			self._rows[ record.hop ] = len( self._lines )
+			self._lines.append( line )
+			self.comment( line )
+		elif( line != self._lines[row] ):
+			self._lines[row] = line
+
+			# Move up to the row, write over it, and move back down below
+			# the table
+			if( self.live ):
+				up = len( self._lines ) - row
+				self.writer.write( ( "\x1b[" + str( up ) + "A\r" + line + "\x1b[K\x1b[" +
+				 str( up ) + "B\r" ).encode() )
+			else:
+				self.comment( line )
+
+	def summary( self, record ):
+		"""
+		This function writes the statistics of one destination.
+		:param record:   The Summary.
+		:return:         None
+		"""
+
+		# Unusual replies, if there were any
+		unusual = ""
+		if( record.duplicates > 0 ):
+			unusual += "+" + str( record.duplicates ) + " duplicates, "
+		if( record.late > 0 ):
+			unusual += str( record.late ) + " late, "
+		if( record.reordered > 0 ):
+			unusual += str( record.reordered ) + " reordered, "
+
+		self.comment( "" )
+		self.comment( "--- " + record.host + " ping statistics --" )
+		self.comment( str( record.sent ) + " packets transmitted, " + str( record.received ) +
+		 " received, " + unusual + "{:4.1f}".format( record.loss ) + "% packet loss, time " +
+		 "{:4.0f}".format( record.elapsed ) + "ms" )
+
+		# If none were received, there are no times to display
+		if( record.received > 0 ):
+			self.comment( "rtt min/avg/max/mdev = " + "{:6.3f}".format( record.minimum ) + "/" +
+			 "{:6.3f}".format( record.mean ) + "/" + "{:6.3f}".format( record.maximum ) + "/" +
+			 "{:5.3f}".format( record.mdev ) + "ms" )
+			if( record.p50 is not None ):
+				self.comment( "rtt p50/p90/p99/p99.9 = " + "/".join( "{:.3f}".format( value )
+				 for value in ( record.p50, record.p90, record.p99, record.p999 ) ) + " ms" )
+		else:
+			self.comment( "" )
+
+	def close( self ):
+		"""
+		This function writes out everything still held.
+		:return:   None
+		"""
+
+		self.writer.flush()
+
+class JsonSink( TextSink ):
+	"""
+	This class writes results as JSON Lines: one object per line, whose
+	"type" is "reply", "hop", "summary" or "statistics" and whose other
+	keys are the fields of the record.
+	"""
+
+	def __init__( self, writer ):
+		"""
+		This function creates a sink.
+		:param writer:   The BufferedWriter to write through.
+		"""
+
+		self.writer = writer
+		self._encoder = json.JSONEncoder( separators=( ",", ":" ) )
+
+	def comment( self, line ):
+		"""
+		This function leaves out lines meant for people only.
+		:param line:   The line.
+		:return:       None
+		"""
+
+		pass
+
+	def reply( self, record ):
+		"""
+		This function writes an echo reply.
+		:param record:   The Reply.
+		:return:         None
+		"""
+
+		self._record( "reply", record )
+
+	def hop( self, record ):
+		"""
+		This function writes one hop of a route.
+		:param record:   The Hop.
+		:return:         None
+		"""
+
+		self._record( "hop", record )
+
+	def statistics( self, record ):
+		"""
+		This function writes the statistics of one hop.
+		:param record:   The Statistics.
+		:return:         None
+		"""
+
+		self._record( "statistics", record )
+
+	def summary( self, record ):
+		"""
+		This function writes the statistics of one destination.
+		:param record:   The Summary.
+		:return:         None
+		"""
+
+		self._record( "summary", record )
+
+	def _record( self, kind, record ):
+		"""
+		This function writes one record as a line of JSON.
+		:param kind:     The type of the record.
+		:param record:   The record.
+		:return:         None
+		"""
+
+		fields = record._asdict()
+		fields["type"] = kind
+		self.writer.write( ( self._encoder.encode( fields ) + "\n" ).encode() )
+
+class CsvSink( JsonSink ):
+	"""
+	This class writes results as comma separated values. Each record's
+	row starts with its type, and the first record of each type is
+	preceded by a header row naming its columns, itself starting with
+	"type". The round trip times of a hop are separated by semicolons,
+	with '*' for a probe that went unanswered, and values that are not
+	known are left empty.
+	"""
+
+	def __init__( self, writer ):
+		"""
+		This function creates a sink.
+		:param writer:   The BufferedWriter to write through.
+		"""
+
+		self.writer = writer
+		self._headed = set()
+
+	def _record( self, kind, record ):
+		"""
+		This function writes one record as a row, after its header if
+		it is the first of its type.
+		:param kind:     The type of the record.
+		:param record:   The record.
+		:return:         None
+		"""
+
+		row = ""
+		if( kind not in self._headed ):
+			self._headed.add( kind )
+			row = "type," + ",".join( record._fields ) + "\n"
+		row += kind + "," + ",".join( _csvField( value ) for value in record ) + "\n"
+		self.writer.write( row.encode() )
+
+class BinarySink( JsonSink ):
+	"""
+	This class writes results as packed little-endian records, each
+	starting with a byte giving its kind, as read back by decode. Names
+	are left out, and times are doubles in milliseconds.
+	"""
+
+	def _record( self, kind, record ):
+		"""
+		This function writes one record packed.
+		:param kind:     The type of the record.
+		:param record:   The record.
+		:return:         None
+		"""
+
+		if( kind == "reply" ):
+			data = _REPLY.pack( _KINDS[kind], int( record.time * 1e9 ),
+			 socket.inet_aton( record.address ), record.seq, record.ttl, record.size,
+			 record.rtt, _STATUSES.index( record.status ) )
+		elif( kind == "hop" ):
+			data = _HOP.pack( _KINDS[kind], record.hop,
+			 socket.inet_aton( record.address or "0.0.0.0" ), len( record.rtts ) )
+			data += b"".join( _RTT.pack( math.nan if rtt is None else rtt )
+			 for rtt in record.rtts )
+		elif( kind == "statistics" ):
+			times = [ math.nan if value is None else value for value in record[6:] ]
+			data = _STATISTICS.pack( _KINDS[kind], int( record.time * 1e9 ), record.hop,
+			 socket.inet_aton( record.address or "0.0.0.0" ), record.sent, record.loss,
+			 *times )
+		else:
+			times = [ math.nan if value is None else value for value in record[8:] ]
+			data = _SUMMARY.pack( _KINDS[kind], socket.inet_aton( record.address ),
+			 record.sent, record.received, record.duplicates, record.late,
+			 record.reordered, *times )
+		self.writer.write( data )
+
+class ListSink( JsonSink ):
+	"""
+	This class keeps records in a list instead of writing them, for
+	programs that use ping and traceroute as a library and want the
+	records themselves.
+	"""
+
+	def __init__( self ):
+		"""
+		This function creates an empty sink. It has no writer.
+		"""
+
+		self.writer = None
+		self.records = collections.deque()
+
+	def _record( self, kind, record ):
+		"""
+		This function keeps one record.
+		:param kind:     The type of the record.
+		:param record:   The record.
+		:return:         None
+		"""
+
+		self.records.append( record )
+
+	def close( self ):
+		"""
+		This function does nothing, as nothing is held back.
+		:return:   None
+		"""
+
+		pass
+
+def summarize( host, address, sent, stats, counts, elapsed ):
+	"""
+	This function builds the statistics of one destination from the
+	counters kept while pinging it.
+	:param host:      The destination, as given by the user.
+	:param address:   The IPv4 address of the destination.
+	:param sent:      The number of echo requests sent.
+	:param stats:     The rttstats.Accumulator of its replies.
+	:param counts:    The numbers of duplicate, late and reordered replies,
+	                  keyed by "duplicates", "late" and "reordered".
+	:param elapsed:   The time spent pinging it, in milliseconds.
+	:return:          The Summary.
+	"""
+
+	received = stats.count
+	loss = 0.0 if sent == 0 else 100 - ( ( received / sent ) * 100 )
+
+	# If none were received, there are no times
+	times = [ None ] * 8
+	if( received > 0 ):
+		times = [ stats.minimum, stats.mean, stats.maximum, stats.mdev() ]
+
+		# Percentiles are only known if a histogram was kept
+		if( stats.histogram is not None ):
+			times += stats.histogram.percentiles( [ 50, 90, 99, 99.9 ], stats.minimum,
+			 stats.maximum )
+		else:
+			times += [ None ] * 4
+
+	return Summary( host, address, sent, received, counts["duplicates"], counts["late"],
+	 counts["reordered"], loss, elapsed, *times )
+
+def statistics( hop, address, name, stats ):
+	"""
+	This function builds the statistics of one hop from the window of
+	its probes.
+	:param hop:       The number of the hop.
+	:param address:   The IPv4 address of the hop, or None if no probe
+	                  was answered.
+	:param name:      The name of the hop, or None if it is not known.
+	:param stats:     The rttstats.Rolling of its probes.
+	:return:          The Statistics.
+	"""
+
+	# Percentiles are only known once a probe has been answered
+	percentiles = [ None ] * 3
+	if( stats.count > 0 ):
+		percentiles = stats.histogram.percentiles( [ 50, 90, 99 ], stats.best(), stats.worst() )
+
+	return Statistics( time.time(), hop, address, name, stats.sent, stats.loss(), stats.last,
+	 stats.mean(), stats.best(), stats.worst(), stats.stdev(), *percentiles )
+
+def sink( format, stream=None, hopLoss=False, live=False ):
+	"""
+	This function creates a sink that writes results in the given format.
+	:param format:    One of FORMATS.
+	:param stream:    The binary stream to write to. Standard output by default.
+	:param hopLoss:   If true, text output adds the share of probes lost
+	                  to every hop.
+	:param live:      If true, text output writes the statistics of each
+	                  hop over its line of a table, for a terminal.
+	:return:          The sink. Every sink has the methods comment, reply,
+	                  hop, statistics, summary and close, and a writer
+	                  attribute holding its BufferedWriter.
+	"""
+
+	if( stream is None ):
+		stream = sys.stdout.buffer
+	writer = BufferedWriter( stream )
+
+	if( format == "json" ):
+		return JsonSink( writer )
+	elif( format == "csv" ):
+		return CsvSink( writer )
+	elif( format == "binary" ):
+		return BinarySink( writer )
+	return TextSink( writer, hopLoss, live )
+
+def decode( data ):
+	"""
+	This function reads back the records written by a BinarySink.
+	:param data:   The bytes written.
+	:return:       A generator of Reply, Hop, Summary and Statistics
+	               records, where host and name are None and a summary's
+	               loss is computed from its counts.
+	"""
+
+	offset = 0
+	while( offset < len( data ) ):
+		kind = data[offset]
+		if( kind == _KINDS["reply"] ):
+			(kind, stamp, address, seq, ttl, size, rtt, status) = _REPLY.unpack_from( data, offset )
+			offset += _REPLY.size
+			yield Reply( stamp / 1e9, None, socket.inet_ntoa( address ), None, seq, ttl,
+			 size, rtt, _STATUSES[status] )
+		elif( kind == _KINDS["hop"] ):
+			(kind, hop, address, count) = _HOP.unpack_from( data, offset )
+			offset += _HOP.size
+			rtts = list()
+			for k in range( count ):
+				(rtt,) = _RTT.unpack_from( data, offset )
+				offset += _RTT.size
+				rtts.append( None if math.isnan( rtt ) else rtt )
+			address = socket.inet_ntoa( address )
+			yield Hop( hop, None if address == "0.0.0.0" else address, None, rtts )
+		elif( kind == _KINDS["summary"] ):
+			fields = _SUMMARY.unpack_from( data, offset )
+			offset += _SUMMARY.size
+			(kind, address, sent, received, duplicates, late, reordered) = fields[:7]
+			times = [ None if math.isnan( value ) else value for value in fields[7:] ]
+			loss = 0.0 if sent == 0 else 100 - received / sent * 100
+			yield Summary( None, socket.inet_ntoa( address ), sent, received, duplicates,
+			 late, reordered, loss, *times )
+		elif( kind == _KINDS["statistics"] ):
+			fields = _STATISTICS.unpack_from( data, offset )
+			offset += _STATISTICS.size
+			(kind, stamp, hop, address, sent, loss) = fields[:6]
+			times = [ None if math.isnan( value ) else value for value in fields[6:] ]
+			address = socket.inet_ntoa( address )
+			yield Statistics( stamp / 1e9, hop, None if address == "0.0.0.0" else address,
+			 None, sent, loss, *times )
+		else:
+			raise ValueError( "unknown record kind " + str( kind ) )
+
+def _csvField( value ):
+	"""
+	This function formats one value of a CSV row.
+	:param value:   The value.
+	:return:        The text of the value, quoted if it needs to be.
+	"""
+
+	# Numbers never need quoting
+	kind = type( value )
+	if( kind is int or kind is float ):
+		return repr( value )
+	if( value is None ):
+		return ""
+	if( kind is list ):
+		return ";".join( "*" if rtt is None else repr( rtt ) for rtt in value )
+	text = str( value )
+	if( "," in text or "\"" in text or "\n" in text ):
+		return "\"" + text.replace( "\"", "\"\"" ) + "\""
+	return text
@@ -3,16 +3,233 @@ __author__ = Kyle McGlynn 11/12/2017
 """
 
 import socket
+import icmp
 import sys
 import time
-import threading
 import math
+import selectors
+import signal
+import rttstats
+import resolver
+import probe
+import transport
+import output
+import scheduler
+import exporter
+import shard
+import netsim
+import struct
 
-def _ping( destination, c, i, s, t ):
+# Layout of a serialized destination record: its address, the number of
+# packets sent, its duplicate, late and reordered replies and the length
+# of its name, followed by the name and its serialized statistics
+_TARGET = struct.Struct( "<4sIIIIH" )
+
+# The number of seconds between looks for destinations whose addresses
+# have been found, while some are still being looked up
+_POLL = 0.05
+
+class Pinger:
+	"""
+	This class pings destinations for programs that use ping as a
+	library. Its socket, the buffers replies are received into and the
+	resolver's cache of names are kept from one destination to the
+	next, so thousands of checks cost no more than their packets. Each
+	check is a generator of the replies as they arrive, as output.Reply
+	records, and its statistics are an output.Summary.
 	"""
-	This function opens a raw socket, sends ICMP echo requests to the
-	destination, receives ICMP echo responses, and passes the statistics
-	to the _statistics function.
+
+	def __init__( self, size=56, timeout=10, names=None, sock=None, writer=None,
+	 metrics=None ):
+		"""
+		This function opens the socket, a raw socket if the process may
+		open one and otherwise an ICMP datagram socket.
+		:param size:      The size of the data sent in each echo request.
+		:param timeout:   The number of seconds to wait for each reply.
+		:param names:     A resolver.ReverseResolver used to name the
+		                  senders of replies, or None to leave them unnamed.
+		:param sock:      The socket to use, from transport.openSocket, or
+		                  None to open one.
+		:param writer:    An output.BufferedWriter the caller writes
+		                  replies through, polled while waiting so that
+		                  its output is not held past its time limit,
+		                  or None.
+		:param metrics:   An exporter.Exporter the statistics of every
+		                  destination checked are served through, or None.
+		:raises PermissionError:   If neither kind of socket is allowed.
+		"""
+
+		self.size = size
+		self.timeout = timeout
+
+		if( sock is None ):
+			sock = transport.openSocket()
+		sock.settimeout(0)
+
+		# Have the kernel stamp when each reply arrives
+		transport.enableTimestamps( sock )
+
+		# Replies are gathered here as they are received, until they
+		# are handed to the caller
+		self._records = output.ListSink()
+
+		# Every destination is pinged with an identifier of the pinger's own
+		self.ident = transport.identifier()
+		self._target = _target( "", "", self.ident )
+		self._session = _session( sock, [ self._target ], timeout, names, True,
+		 self._records )
+		self._session["writer"] = writer
+		self._session["metrics"] = metrics
+
+		# The sequence number of the last request sent, carried from
+		# one destination to the next so that a reply to an earlier
+		# check is never taken for one to the current check
+		self._sequence = 0
+
+		# When the current check started and, once it has, finished
+		self._enter = time.perf_counter()
+		self._finish = None
+
+	def __enter__( self ):
+		"""
+		This function lets the pinger be used in a with statement.
+		:return:   The pinger.
+		"""
+
+		return self
+
+	def __exit__( self, kind, value, traceback ):
+		"""
+		This function closes the pinger at the end of a with statement.
+		:return:   None
+		"""
+
+		self.close()
+
+	def close( self ):
+		"""
+		This function closes the socket, and gives back its identifier.
+		:return:   None
+		"""
+
+		if( self._session["socket"].fileno() < 0 ):
+			return
+		self._session["selector"].close()
+		self._session["socket"].close()
+		transport.release( self.ident )
+
+	def ping( self, destination, count=4, interval=1, deadline=0, preload=1, address=None ):
+		"""
+		This function pings a destination. Requests are sent every
+		interval seconds whether or not earlier ones have been answered,
+		and each reply is matched to its request by sequence number.
+		:param destination:   The destination, either an IPv4 address or web URL.
+		:param count:         The number of requests to send. If zero, they
+		                      are sent until the deadline.
+		:param interval:      The number of seconds between requests.
+		:param deadline:      The number of seconds after which to stop. If
+		                      zero, there is no deadline.
+		:param preload:       The number of requests sent at once at the
+		                      start, before the interval applies.
+		:param address:       The IPv4 address of the destination, if it has
+		                      been resolved already.
+		:return:              A generator of the output.Reply of every reply,
+		                      as it arrives. Its return value is the
+		                      output.Summary of the check, which summary()
+		                      also gives.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		if( address is None ):
+			address = socket.gethostbyname( destination )
+
+		# The destination, with its counters and rtt statistics, takes
+		# the place of the last one
+		self._sequence = ( self._target["base"] + self._target["sent"] ) & 0xffff
+		target = _target( destination, address, self.ident )
+		target["base"] = self._sequence
+		self._target = target
+
+		session = self._session
+		session["byIdent"] = { target["ident"]: target }
+		session["byAddress"] = { address: target }
+		session["table"] = table = probe.InFlight( self.timeout )
+		if( session["metrics"] is not None ):
+			session["metrics"].watch( target )
+		records = self._records.records
+		records.clear()
+
+		# Record start time of packet send/receive
+		self._enter = enter = time.perf_counter()
+		self._finish = None
+		
+		# The time at which the check ends
+		end = enter + deadline if deadline > 0 else math.inf
+		
+		# The time at which the next packet is due
+		nextSend = enter
+
+		# Continue so long as the deadline has not passed and there are
+		# packets left to send or replies left to wait for
+		while( time.perf_counter() < end ):
+			
+			# Send the next packet once it is due. The first few
+			# packets are due at once.
+			more = _checkCount( count, target["sent"] )
+			if( more and time.perf_counter() >= nextSend ):
+				_send( session, target, self.size )
+				if( target["sent"] >= preload ):
+					nextSend += interval
+				more = _checkCount( count, target["sent"] )
+			
+			# Give up on requests that have gone unanswered for too long
+			table.expire( time.perf_counter() )
+			if( not more and len( table ) == 0 ):
+				break
+			
+			# Sleep until a reply arrives, the next packet is due, a
+			# request times out or the check ends
+			_wait( session, [ end, nextSend if more else None, table.nextDeadline() ] )
+
+			# Hand over the replies that arrived
+			while( len( records ) > 0 ):
+				yield records.popleft()
+
+		self._finish = time.perf_counter()
+		return self.summary()
+
+	def check( self, destination, count=4, interval=1, deadline=0 ):
+		"""
+		This function pings a destination and returns its statistics only.
+		:param destination:   The destination, either an IPv4 address or web URL.
+		:param count:         The number of requests to send.
+		:param interval:      The number of seconds between requests.
+		:param deadline:      The number of seconds after which to stop. If
+		                      zero, there is no deadline.
+		:return:              The output.Summary of the check.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		for reply in self.ping( destination, count, interval, deadline ):
+			pass
+		return self.summary()
+
+	def summary( self ):
+		"""
+		This function computes the statistics of the current or last
+		check, which may have been stopped before it finished.
+		:return:   The output.Summary of the check.
+		"""
+
+		finish = self._finish if self._finish is not None else time.perf_counter()
+		return _summary( self._target, ( finish - self._enter ) * 1000 )
+
+def _ping( destination, c, i, s, t, W, l, names, sink, quiet, metrics ):
+	"""
+	This function pings the destination with a Pinger, which sends
+	ICMP echo requests to the destination and receives ICMP echo
+	responses, and writes the replies and statistics to the output
+	sink.
 	:param destination:   The destination, either an IPv4 address or web URL.
 	:param c:             The number of packets to be sent. If zero, it is
 	                      the 'default' value and is interpreted as infinity.
@@ -20,414 +237,1116 @@ def _ping( destination, c, i, s, t ):
 	:param s:             The size of the data to be sent in each ICMP echo request.
 	:param t:             The number of seconds before the program exits. If zero,
 	                      it is the 'default' value and is interpreted as infinity.
+	:param W:             The number of seconds to wait for each reply.
+	:param l:             The number of packets sent at once at the start,
+	                      before the interval applies.
+	:param names:         A resolver.ReverseResolver used to name the senders of
+	                      replies, or None to display their addresses only.
+	:param sink:          The output sink the results are written to.
+	:param quiet:         If true, only the summary is written.
+	:param metrics:       An exporter.Exporter the statistics are served
+	                      through, or None.
 	:return:              None
 	"""
 
-    # Open the raw socket
-	send = socket.socket( socket.AF_INET, socket.SOCK_RAW, 1 )
-	
-	# Set to zero seconds to prevent blocking
-	send.settimeout(0)
+    # Open the raw socket, or a datagram socket without the privileges
+	pinger = Pinger( s, W, names, _open(), sink.writer, metrics )
 	
 	# Get destination IP address
 	try:
 		destIPv4 = socket.gethostbyname( destination )
 	except socket.gaierror:		
-		print( "ping: unknown host " + destination )
+		print( "ping: unknown host " + destination, file=sys.stderr )
 		sys.exit(0)
 	
-	# Used to communicate between the timeout thread adn the main thread
-	flagLock = threading.Lock()
-	flag = [True]
-	
-	# The timeout thread. Once t seconds have ellapsed, the program terminates
-	threading.Thread( target=_checkTime, args=(t, flagLock, flag, ) ).start()
+	# Print the statistics so far whenever SIGQUIT arrives
+	_onQuit( lambda: _interim( pinger._target["sent"], pinger._target["stats"], "" ) )
 	
-	# The rtt of each received ICMP echo response
-	stats = list()
-	
-	# Number of sent packets
-	counter = 0
-	
-	print("PING " + destination + " (" + destIPv4 + ") " +
+	sink.comment( "PING " + destination + " (" + destIPv4 + ") " +
 	 str(s) + "(" + str(s+28) + ") bytes of data." )
-	
-	# Record start time of packet send/receive
-	enter = time.time()
 	 
 	# If the user hits Ctrl+C, stop sending packets 
 	try:
-		
-		# Send packets so long as a timeout has not occured or a specified 
-		# number of packets has not been sent
-		while( _checkFlag( flagLock, flag ) and _checkCount( c, counter ) ):
-			
-			# Build the packet
-			packet = _icmp( s, counter + 1 )
-			counter += 1
-			
-			# Send the packet
-			send.sendto( packet, (str(destIPv4), 80) )
-			
-			# Get the response packet
-			start = time.time()
-			
-			# So long as the waiting period has not
-			# passed, continue
-			while( time.time() - start < i ):
-				
-				# If a timeout has occured, cancel
-				if( _checkFlag( flagLock, flag) is False ):
-					start = i
-				try:
-					arr = bytearray(100)
-					(nbytes, (senderIPv4, port)) = send.recvfrom_into( arr )
-					rtt = ( time.time() - start ) * 1000
-					_processPackets( senderIPv4, arr, rtt )
-					stats.append( rtt )
-				except BlockingIOError:
-					bull = ""	
-			
+		for reply in pinger.ping( destination, c, i, t, l, destIPv4 ):
+			if( not quiet ):
+				sink.reply( reply )
 	except KeyboardInterrupt:
-		bull=""
-		
-	# Compute total time spent	
-	ellapsed = ( time.time() - enter ) * 1000
+		pass
 	
 	# Compute and display statistics
-	_statistics( counter, stats, destination, ellapsed )
+	sink.summary( pinger.summary() )
+	pinger.close()
+	sink.close()
 	sys.exit(0)
 
-def _processPackets( sender, packet, rtt ):
+def _flood( destination, c, s, t, W, l, r, sink, metrics ):
 	"""
-	This function processes the received packet, extracting the 
-	packet size, ttl, ICMP sequence, and computing the alternative
-	name of the destination.
-	:param sender:   The sender of the ICMP echo response.
-	:param packet:   The received packet.
-	:param rtt:      The round trip time between ICMP echo request and 
-	                 echo response.
-	:return:         None.
+	This function floods the destination with ICMP echo requests for
+	capacity testing. Requests are paced by a token bucket at r packets
+	per second, and up to l of them may be sent in one burst. Replies
+	are matched and timed as usual but not displayed, and the summary
+	reports the rate achieved, the share of requests dropped and the
+	CPU time spent per packet.
+	:param destination:   The destination, either an IPv4 address or web URL.
+	:param c:             The number of packets to be sent. If zero, it is
+	                      the 'default' value and is interpreted as infinity.
+	:param s:             The size of the data to be sent in each ICMP echo request.
+	:param t:             The number of seconds before the program exits. If zero,
+	                      it is the 'default' value and is interpreted as infinity.
+	:param W:             The number of seconds to wait for each reply.
+	:param l:             The largest number of packets sent in one burst.
+	:param r:             The number of packets to send per second. If zero,
+	                      packets are sent as fast as possible.
+	:param sink:          The output sink the results are written to.
+	:param metrics:       An exporter.Exporter the statistics are served
+	                      through, or None.
+	:return:              None
+	"""
+
+	# Open the raw socket, or a datagram socket without the privileges
+	send = _open()
+	send.setblocking( False )
+	transport.enableTimestamps( send )
+
+	# Replies arrive faster than they can be read in bursts
+	send.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22 )
+
+	# Get destination IP address
+	try:
+		destIPv4 = socket.gethostbyname( destination )
+	except socket.gaierror:
+		print( "ping: unknown host " + destination, file=sys.stderr )
+		sys.exit(0)
+
+	# Replies are counted but not displayed
+	target = _target( destination, destIPv4, transport.identifier() )
+	session = _session( send, [ target ], W, None, False, sink, metrics )
+	table = session["table"]
+
+	# Print the statistics so far whenever SIGQUIT arrives
+	_onQuit( lambda: _interim( target["sent"], target["stats"], "" ) )
+
+	sink.comment( "PING " + destination + " (" + destIPv4 + ") " +
+	 str(s) + "(" + str(s+28) + ") bytes of data." )
+
+	# Record start time of packet send/receive, in wall clock
+	# and CPU time
+	enter = time.perf_counter()
+	cpu = time.process_time()
+
+	# The time at which the program exits
+	end = enter + t if t > 0 else math.inf
+
+	# Paces the requests. The selector sleeps in whole milliseconds,
+	# so the bucket must hold at least two milliseconds' worth of
+	# tokens for high rates to be reached.
+	burst = l if r <= 0 else max( l, math.ceil( r * 0.002 ) )
+	bucket = probe.TokenBucket( r if r > 0 else math.inf, burst, enter )
+
+	try:
+		while( time.perf_counter() < end ):
+			now = time.perf_counter()
+
+			# Send every packet the bucket allows
+			more = _checkCount( c, target["sent"] )
+			if( more ):
+				wanted = burst if c == 0 else c - target["sent"]
+				for k in range( bucket.take( now, wanted ) ):
+					_send( session, target, s )
+				more = _checkCount( c, target["sent"] )
+
+			# Give up on requests that have gone unanswered for too long
+			table.expire( now )
+			if( not more and len( table ) == 0 ):
+				break
+
+			# Sleep until a reply arrives or the next token is due
+			_wait( session, [ end, bucket.ready( now ) if more else None,
+			 table.nextDeadline() ] )
+
+	except KeyboardInterrupt:
+		pass
+
+	# Compute total time spent
+	ellapsed = ( time.perf_counter() - enter ) * 1000
+	cpu = time.process_time() - cpu
+
+	# Compute and display statistics
+	sink.summary( _summary( target, ellapsed ) )
+
+	# How hard the flood pushed
+	sent = target["sent"]
+	packets = max( sent + target["stats"].count, 1 )
+	sink.comment( "flood: {:.0f} pps achieved{}, {:.2f}% dropped, {:.1f} us CPU per packet".format(
+	 sent / max( ellapsed / 1000, 1e-9 ), "" if r <= 0 else " of {:.0f}".format( r ),
+	 _loss( sent, target["stats"].count ), cpu / packets * 1e6 ) )
+	_receiveStatistics( sink, session["ring"] )
+	transport.release( target["ident"] )
+	sink.close()
+	sys.exit(0)
+
+def _pingMany( destinations, c, i, s, t, W, names, sink, quiet, metrics ):
+	"""
+	This function pings many destinations at once over a single raw
+	socket, in the manner of fping. Every destination is given its own
+	ICMP identifier so that replies can be told apart, and each round
+	sends one echo request to every destination before waiting for the
+	interval to pass. The statistics of each destination are passed to
+	the output sink.
+	:param destinations:   The destinations, either IPv4 addresses or web URLs.
+	:param c:              The number of packets to be sent to each destination.
+	                       If zero, it is the 'default' value and is interpreted
+	                       as infinity.
+	:param i:              The number of seconds between rounds of packets.
+	:param s:              The size of the data to be sent in each ICMP echo request.
+	:param t:              The number of seconds before the program exits. If zero,
+	                       it is the 'default' value and is interpreted as infinity.
+	:param W:              The number of seconds to wait for each reply.
+	:param names:          A resolver.ReverseResolver used to name the senders of
+	                       replies, or None to display their addresses only.
+	:param sink:           The output sink the results are written to.
+	:param quiet:          If true, only the summaries are written.
+	:param metrics:        An exporter.Exporter the statistics are served
+	                       through, or None.
+	:return:               None
+	"""
+
+	# Open the raw socket shared by every destination, or a datagram
+	# socket without the privileges
+	send = _openShared()
+
+	# Look up the IPv4 address of every destination, many at a time
+	lookups = _lookups()
+	lookups.submit( destinations )
+
+	# The identifier of a destination is its position in the list,
+	# counting from the first of those handed out for them
+	first = transport.identifier( len( destinations ) )
+
+	# Wait for replies without spinning, and keep track of the
+	# requests waiting for a reply. Destinations join as their
+	# addresses are found.
+	session = _session( send, [], W, names, not quiet, sink, metrics )
+	transport.attachFilter( send, first, first + len( destinations ) - 1 )
+	targets = list()
+
+	# Print the statistics so far whenever SIGQUIT arrives
+	_onQuit( lambda: [ _interim( target["sent"], target["stats"], target["name"] )
+	 for target in targets ] )
+
+	sink.comment( "PING " + str( len( destinations ) ) + " hosts, " + str(s) + "(" +
+	 str(s+28) + ") bytes of data." )
+
+	ellapsed = _rounds( session, targets, c, i, s, t,
+	 lambda: _arrivals( session, lookups, first ) )
+	lookups.save()
+
+	# Compute and display statistics for every destination, in the
+	# order given
+	targets.sort( key=lambda target: target["ident"] )
+	for target in targets:
+		sink.summary( _summary( target, ellapsed ) )
+	_receiveStatistics( sink, session["ring"] )
+	transport.release( first )
+	sink.close()
+	sys.exit(0)
+
+def _pingSharded( destinations, P, c, i, s, t, W, sink ):
+	"""
+	This function pings many destinations at once, as _pingMany does,
+	but spreads them over P worker processes, each with its own socket
+	and ICMP identifiers of its own. Replies are
+	counted but not displayed. When a worker finishes, the statistics
+	of each of its destinations are sent back to this process in
+	compact binary form, and once every worker has finished they are
+	written together, followed by the statistics of all destinations
+	taken as one.
+	:param destinations:   The destinations, either IPv4 addresses or web URLs.
+	:param P:              The number of worker processes.
+	:param c:              The number of packets to be sent to each destination.
+	                       If zero, it is the 'default' value and is interpreted
+	                       as infinity.
+	:param i:              The number of seconds between rounds of packets.
+	:param s:              The size of the data to be sent in each ICMP echo request.
+	:param t:              The number of seconds before the program exits. If zero,
+	                       it is the 'default' value and is interpreted as infinity.
+	:param W:              The number of seconds to wait for each reply.
+	:param sink:           The output sink the results are written to.
+	:return:               None
+	"""
+
+	shards = shard.split( list( enumerate( destinations ) ), P )
+
+	sink.comment( "PING " + str( len( destinations ) ) + " hosts, " + str(s) + "(" +
+	 str(s+28) + ") bytes of data, in " + str( len( shards ) ) + " processes." )
+
+	# The record of every destination, in the order given, once its
+	# worker has sent it back
+	targets = [ None ] * len( destinations )
+	def collect( number, result ):
+		(index, data) = result
+		targets[index] = _unpackTarget( data )
+
+	# Record start time of packet send/receive
+	enter = time.perf_counter()
+	# Each worker is handed an identifier for every destination of its share
+	shard.run( shards, lambda number, part, first, ship:
+	 _pingShard( part, first, c, i, s, t, W, ship ), collect, len )
+	ellapsed = ( time.perf_counter() - enter ) * 1000
+
+	# Compute and display statistics for every destination, and for
+	# all of them taken as one
+	known = [ target for target in targets if target is not None ]
+	total = _target( str( len( known ) ) + " hosts", "0.0.0.0", 0 )
+	for target in known:
+		sink.summary( _summary( target, ellapsed ) )
+		total["sent"] += target["sent"]
+		total["stats"].merge( target["stats"] )
+		for (kind, count) in target["counts"].items():
+			total["counts"][kind] += count
+	sink.summary( _summary( total, ellapsed ) )
+	sink.close()
+	sys.exit(0)
+
+def _pingShard( part, first, c, i, s, t, W, ship ):
+	"""
+	This function pings one worker's share of the destinations, and
+	sends the record of each back to the parent.
+	:param part:    The destinations of the share, each with its position
+	                in the list of all destinations.
+	:param first:   The first of the ICMP identifiers the share may use.
+	:param c:       The number of packets to be sent to each destination.
+	:param i:       The number of seconds between rounds of packets.
+	:param s:       The size of the data to be sent in each ICMP echo request.
+	:param t:       The number of seconds before the worker stops.
+	:param W:       The number of seconds to wait for each reply.
+	:param ship:    A function that sends a result to the parent.
+	:return:        None
+	"""
+
+	send = _openShared()
+
+	# Destinations are pinged as their addresses are found, and unknown
+	# hosts are left out
+	lookups = _lookups()
+	lookups.submit( [ destination for (position, destination) in part ] )
+	session = _session( send, [], W, None, False, output.ListSink() )
+	transport.attachFilter( send, first, first + len( part ) - 1 )
+
+	targets = list()
+	_rounds( session, targets, c, i, s, t, lambda: _arrivals( session, lookups, first ) )
+	lookups.save()
+
+	for target in targets:
+		ship( ( part[ target["ident"] - first ][0], _packTarget( target ) ) )
+
+def _openShared():
+	"""
+	This function opens a socket to be shared by many destinations.
+	:return:   The socket, from _open, set not to block, with timestamps
+	           and a receive buffer large enough for bursts of replies.
+	"""
+
+	send = _open()
+	send.setblocking( False )
+	transport.enableTimestamps( send )
+
+	# Replies from many destinations arrive in bursts, so give
+	# the kernel room to queue them
+	send.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20 )
+	return send
+
+def _lookups():
+	"""
+	This function creates the resolver that looks up the addresses of
+	many destinations at once, keeping them from one run to the next.
+	:return:   The resolver.ForwardResolver.
+	"""
+
+	return resolver.ForwardResolver( path=resolver.cachePath() )
+
+def _arrivals( session, lookups, first ):
+	"""
+	This function collects the destinations whose addresses have been
+	found since it was last called, and adds them to the session.
+	Unknown hosts are reported and left out.
+	:param session:   The session, from _session.
+	:param lookups:   The resolver.ForwardResolver the destinations were
+	                  submitted to, numbered from zero.
+	:param first:     The ICMP identifier of the first destination. Each
+	                  destination's identifier is its number on from it.
+	:return:          A list of the records of the destinations found,
+	                  and whether any are still being looked up.
+	"""
+
+	# Answers that arrive in between are collected next time
+	coming = len( lookups ) > 0
+
+	joined = list()
+	for (number, destination, destIPv4) in lookups.ready():
+		if( destIPv4 is None ):
+			print( "ping: unknown host " + destination, file=sys.stderr )
+			continue
+		target = _target( destination, destIPv4, first + number )
+		_join( session, target )
+		joined.append( target )
+	return ( joined, coming )
+
+def _rounds( session, targets, c, i, s, t, arrivals=None ):
+	"""
+	This function sends rounds of packets to many destinations, one to
+	each destination every i seconds, and receives their replies, until
+	every round is sent and answered or the time runs out. Destinations
+	that join part way through are sent their first packet at once and
+	then follow the rounds, until they too have been sent c packets.
+	:param session:   The session, from _session.
+	:param targets:   The records of the destinations, to which those
+	                  that join are added.
+	:param c:         The number of packets to send to each destination.
+	                  If zero, it is interpreted as infinity.
+	:param i:         The number of seconds between rounds.
+	:param s:         The size of the data to be sent in each ICMP echo request.
+	:param t:         The number of seconds before stopping. If zero,
+	                  it is interpreted as infinity.
+	:param arrivals:  A function that returns the records of the
+	                  destinations that join, already in the session, and
+	                  whether more may join, as _arrivals does, or None if
+	                  none will.
+	:return:          The time spent, in milliseconds.
+	"""
+
+	table = session["table"]
+
+	# Record start time of packet send/receive
+	enter = time.perf_counter()
+
+	# The time at which the program exits
+	end = enter + t if t > 0 else math.inf
+
+	# Number of rounds sent, the time at which the next is due, whether
+	# any destination has packets left to send, and whether more
+	# destinations may join
+	rounds = 0
+	nextRound = enter
+	behind = True
+	coming = arrivals is not None
+
+	# If the user hits Ctrl+C, stop sending packets
+	try:
+
+		# Continue so long as a timeout has not occured and there are
+		# packets left to send or replies left to wait for
+		while( time.perf_counter() < end ):
+
+			# Destinations that join between rounds are sent to at once
+			if( coming ):
+				(joined, coming) = arrivals()
+				targets.extend( joined )
+				behind = behind or len( joined ) > 0
+				if( rounds > 0 and time.perf_counter() < nextRound ):
+					for target in joined:
+						_send( session, target, s )
+						_wait( session, [ 0 ] )
+
+			# Send one packet to every destination with packets left once
+			# the round is due, collecting any replies that arrive in the
+			# meantime so their rtt is not inflated. Rounds missed while
+			# no destination had packets left are not made up.
+			now = time.perf_counter()
+			if( behind and now >= nextRound ):
+				rounds += 1
+				nextRound += i
+				if( nextRound <= now ):
+					nextRound = now + i
+				behind = False
+				for target in targets:
+					if( _checkCount( c, target["sent"] ) ):
+						_send( session, target, s )
+						_wait( session, [ 0 ] )
+						behind = behind or _checkCount( c, target["sent"] )
+
+			# Give up on requests that have gone unanswered for too long
+			table.expire( time.perf_counter() )
+			if( not behind and not coming and len( table ) == 0 ):
+				break
+
+			# Sleep until a reply arrives, the next round is due, a
+			# request times out or the program exits, or until it is
+			# time to look for destinations that have joined
+			_wait( session, [ end, nextRound if behind else None, table.nextDeadline(),
+			 time.perf_counter() + _POLL if coming else None ] )
+
+	except KeyboardInterrupt:
+		pass
+
+	# Compute total time spent
+	return ( time.perf_counter() - enter ) * 1000
+
+def _daemon( path, i, s, t, W, names, sink, quiet, metrics ):
+	"""
+	This function pings the destinations listed in a target file
+	continuously, each at its own interval, until it is stopped. A
+	scheduler.Scheduler spreads the sends evenly across each interval.
+	Every destination is sent the same ICMP identifier, so
+	replies are told apart by sender, and keeps only its counters, not
+	a histogram of its round trip times, so that tens of thousands of
+	destinations take little memory. On SIGHUP the file is read again:
+	new destinations are added, the rest carry on, and those no longer
+	listed are dropped once their last requests have been answered or
+	have timed out, and their statistics written. How late each send
+	was is kept in a histogram and reported on SIGQUIT and with the
+	statistics.
+	:param path:     The target file. Each line is a destination and,
+	                 optionally, the number of seconds between its packets.
+	:param i:        The number of seconds between packets to destinations
+	                 listed without an interval.
+	:param s:        The size of the data to be sent in each ICMP echo request.
+	:param t:        The number of seconds before the program exits. If zero,
+	                 it is the 'default' value and is interpreted as infinity.
+	:param W:        The number of seconds to wait for each reply.
+	:param names:    A resolver.ReverseResolver used to name the senders of
+	                 replies, or None to display their addresses only.
+	:param sink:     The output sink the results are written to.
+	:param quiet:    If true, only the summaries are written.
+	:param metrics:  An exporter.Exporter the statistics are served
+	                 through, or None.
+	:return:         None
 	"""
 	
-	# Size
-	lengthL = packet[2]
-	lengthR = packet[3]
-	length = int( ( bin( lengthL )[2:] + bin( lengthR )[2:] ) ,2 )
-	size = length - 20 # Minus 20 bytes for size of IP header
+	entries = _readTargets( path )
 	
-	# TTL
-	ttl = packet[8]
+	# Open the raw socket shared by every destination, or a datagram
+	# socket without the privileges
+	send = _open()
+	send.setblocking( False )
+	transport.enableTimestamps( send )
 	
-	# ICMP Seq
-	icmp_seqL = packet[26]
-	icmp_seqR = packet[27]
-	icmp_seq = int( ( bin( icmp_seqL )[2:] + bin( icmp_seqR )[2:] ), 2 )
+	# Replies from many destinations arrive in bursts, so give
+	# the kernel room to queue them
+	send.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22 )
 	
-	# Alternative name
-	(source, aliaslist, ipaddrlist) = socket.gethostbyaddr( sender )
+	# Every destination shares one identifier, so the list can change
+	# without running out of identifiers
+	session = _session( send, [], W, names, not quiet, sink, metrics )
+	session["shared"] = True
+	ident = transport.identifier()
+	transport.attachFilter( send, ident, ident )
+	table = session["table"]
 	
-	print( str(size) + " bytes from " + str(source) + " (" + sender +
-	 "): icmp_seq=" + str(icmp_seq) + " ttl=" + str(ttl) + " time=" +
-	 "{:4.1f}".format(rtt) + " ms")
+	# Record start time of packet send/receive
+	enter = time.perf_counter()
 	
-def _statistics( sent, stats, destination, ellapsed ):
-	"""
-	This function calculates the statistics of this ping operation, such
-	as: minimum rtt, max rtt, average rtt, and standard deviation.
-	:param sent:          The number sent ICMP echo request packets
-	:param stats:         The rtt of the received ICMP echo reponse packets
-	:param destination:   The destination of the ICMP echo request packets
-	:param ellapsed:      The amount of time spent sending and receiving packets
-	:return:              None
-	"""
+	# The time at which the program exits
+	end = enter + t if t > 0 else math.inf
 	
-	# Stats title
-	print("")
-	print( "--- " + destination + " ping statistics --" )
-
-	# Number received
-	received = len( stats )
+	schedule = scheduler.Scheduler( enter )
+	_retarget( session, schedule, entries, i, ident )
+	
+	# How late each send was, in milliseconds
+	lateness = rttstats.Histogram()
+	
+	# Print the statistics so far whenever SIGQUIT arrives
+	_onQuit( lambda: print( _daemonStatistics( session, schedule, lateness ),
+	 file=sys.stderr ) )
+	
+	# Read the target file again whenever SIGHUP arrives. The signal only
+	# asks for it, since the schedule may be in the middle of a change.
+	hangup = { "pending": False }
 	
-	# Percent lost
-	lost = 100 - ( ( received / sent ) * 100 )
+	# address -> ( when its last requests time out, record ) of every
+	# destination dropped. A destination dropped again waits for the
+	# requests sent since.
+	leaving = dict()
+	if( hasattr( signal, "SIGHUP" ) and path != "-" ):
+		signal.signal( signal.SIGHUP, lambda signum, frame: hangup.update( pending=True ) )
 	
-	# Second line of stats
-	print( str(sent) + " packets transmitted, " + str(received) + " received, " +
-	"{:4.1f}".format(lost) + "% packet loss, time " + "{:4.0f}".format(ellapsed) + "ms" ) 
+	sink.comment( "PING " + str( len( schedule ) ) + " hosts, " + str(s) + "(" +
+	 str(s+28) + ") bytes of data." )
 	
-	# If none were received, don't calculate statistics
-	if( received > 0 ):
+	# If the user hits Ctrl+C, stop sending packets
+	try:
+		while( time.perf_counter() < end ):
+			now = time.perf_counter()
 			
-		#Total time
-		total = sum( stats )
-		
-		# Min
-		minimum = min( stats )
-		
-		# Max 
-		maximum = max( stats )
-		
-		# Avg
-		average = total / received
-		
-		# StdDev
-		standard_dev = _standardDev( stats, average )
-		
-		# Last line of stats
-		print( "rtt min/avg/max/mdev = " + "{:6.3f}".format(minimum) + "/" +
-		"{:6.3f}".format(average) + "/" + "{:6.3f}".format(maximum) + "/" + 
-		"{:5.3f}".format(standard_dev) + "ms")
+			# Send to every destination that is due
+			for (target, late) in schedule.due( now ):
+				_send( session, target, s )
+				lateness.record( ( time.perf_counter() - now + late ) * 1000 )
+			
+			# Give up on requests that have gone unanswered for too long
+			table.expire( now )
+			
+			if( hangup["pending"] ):
+				hangup["pending"] = False
+				try:
+					entries = _parseTargets( _readLines( path ) )
+				except ( OSError, ValueError ) as error:
+					print( "ping: cannot reload target file " + path + ": " + str( error ),
+					 file=sys.stderr )
+				else:
+					for target in _retarget( session, schedule, entries, i, ident ):
+						leaving[ target["ip"] ] = ( now + W, target )
+			
+			# Write the statistics of the destinations dropped, unless they
+			# have been listed again since
+			for address in [ address for (address, (deadline, target)) in leaving.items()
+			 if deadline <= now ]:
+				(deadline, target) = leaving.pop( address )
+				if( address not in schedule and session["byAddress"].get( address ) is target ):
+					del session["byAddress"][ target["ip"] ]
+					sink.summary( _summary( target, ( now - enter ) * 1000 ) )
+					if( metrics is not None ):
+						metrics.forget( target )
+			
+			# Sleep until a reply arrives, the next send is due, a request
+			# times out or the program exits, waking at least once a second
+			_wait( session, [ end, now + 1, schedule.nextDue(), table.nextDeadline(),
+			 min( [ deadline for (deadline, target) in leaving.values() ], default=None ) ] )
 	
-	else:
-		print()
+	except KeyboardInterrupt:
+		pass
+	
+	# Compute total time spent
+	ellapsed = ( time.perf_counter() - enter ) * 1000
 	
-def _standardDev( stats, average ):
+	# Compute and display statistics for every destination
+	for target in session["byAddress"].values():
+		sink.summary( _summary( target, ellapsed ) )
+	sink.comment( _daemonStatistics( session, schedule, lateness ) )
+	_receiveStatistics( sink, session["ring"] )
+	transport.release( ident )
+	sink.close()
+	sys.exit(0)
+
+def _retarget( session, schedule, entries, i, ident ):
 	"""
-	This function calculates the standard deviation between
-	the rtts of the different packets.
-	:param stats:     A collection of values for which we want
-	                  to discover the standard deviation.
-	:param average:   The average value of collection.
-	:return:          The standard deviation of the collection.
+	This function makes the destinations of a target list the ones
+	that are sent to. Destinations that were known already keep their
+	records, and unknown hosts are skipped.
+	:param session:    The session, from _session.
+	:param schedule:   The scheduler.Scheduler of the destinations, keyed
+	                   by address.
+	:param entries:    The destinations and their intervals, from
+	                   _parseTargets.
+	:param i:          The interval of destinations listed without one.
+	:param ident:      The ICMP identifier sent to every destination.
+	:return:           A list of the records of the destinations no
+	                   longer sent to.
 	"""
-	total = 0
-	for i in stats:
-		total += pow( ( average - i ), 2)
-	return math.sqrt( total )	
 	
-def _checkCount( c, count ):
+	byAddress = session["byAddress"]
+	
+	# Look up every destination, many at a time
+	lookups = _lookups()
+	addresses = lookups.resolve( [ destination for (destination, interval) in entries ] )
+	lookups.save()
+	
+	# The record and interval wanted for each address. A destination
+	# listed twice under different names is pinged once.
+	wanted = dict()
+	for ((destination, interval), destIPv4) in zip( entries, addresses ):
+		if( destIPv4 is None ):
+			print( "ping: unknown host " + destination, file=sys.stderr )
+			continue
+		if( destIPv4 in wanted ):
+			continue
+		target = byAddress.get( destIPv4 )
+		if( target is None ):
+			target = _target( destination, destIPv4, ident, False )
+			if( session["metrics"] is not None ):
+				session["metrics"].watch( target )
+		wanted[destIPv4] = ( target, interval if interval is not None else i )
+	
+	# Stop sending to the destinations no longer listed. Their records
+	# are kept, so that replies still on their way are counted.
+	dropped = list()
+	for destIPv4 in schedule.keys():
+		if( destIPv4 not in wanted ):
+			dropped.append( schedule.remove( destIPv4 ) )
+	
+	# Add the new destinations, and change the intervals of the others.
+	# The time is taken last so that the first sends are not late.
+	now = time.perf_counter()
+	for (destIPv4, (target, interval)) in wanted.items():
+		byAddress[destIPv4] = target
+		schedule.add( destIPv4, interval, target, now )
+	return dropped
+
+def _daemonStatistics( session, schedule, lateness ):
 	"""
-	This function checks to make sure that the specified number of packets
-	has not yet been sent yet.
-	:param c:       The maximum number that will be sent.
-	                If this value is zero, it is interpreted as infinity.
-	:param count:   The number of packets sent so far.
-	:return:        True if there are more packets to be sent. False
-	                otherwise.
+	This function describes how all the destinations of a daemon are
+	doing, and how closely their sends kept to the schedule.
+	:param session:    The session, from _session.
+	:param schedule:   The scheduler.Scheduler of the destinations.
+	:param lateness:   The rttstats.Histogram of how late each send was.
+	:return:           A line describing them.
 	"""
 	
-	# If c=0, then count is not part of ping's exit condition.
-	# If c/=0, then count is part of ping's exit condition.
-	if( c == 0 or count is not c ):
-		return True
-	else:
-		return False
+	targets = session["byAddress"].values()
+	sent = sum( target["sent"] for target in targets )
+	received = sum( target["stats"].count for target in targets )
+	line = "{} hosts, {}/{} packets, {:.1f}% loss".format( len( schedule ), received,
+	 sent, _loss( sent, received ) )
+	if( lateness.total > 0 ):
+		line += ", send lateness p50/p99/p99.9/max = " + "/".join( "{:.3f}".format( value )
+		 for value in lateness.percentiles( [ 50, 99, 99.9, 100 ] ) ) + " ms"
+	return line
 
-def _checkTime( t, lock, flag ):
+def _target( name, ipv4, ident, histogram=True ):
 	"""
-	This function checks to make sure that the specified number
-	of seconds have not yet ellapsed.
-	:param t:      The total number of seconds before the program terminates.
-	:param lock:   A lock to prevent simultaneous access.
-	:param flag:   A shared value between the thread using this
-	               function and the main thread.
-	:return:       None
+	This function creates the record kept for one destination.
+	:param name:        The destination, as given by the user.
+	:param ipv4:        The IPv4 address of the destination.
+	:param ident:       The ICMP identifier used for the destination.
+	:param histogram:   If false, its round trip times are not kept in
+	                    a histogram, so the record stays small.
+	:return:            A dictionary of the destination's name, address,
+	                    identifier, number of packets sent, the sequence
+	                    number its first packet follows, the
+	                    rttstats.Accumulator of its replies, and counts of
+	                    its duplicate, late and reordered replies.
 	"""
 	
-	if( t > 0 ):
-		time.sleep(t)
-		lock.acquire()
-		flag[0] = False
-		lock.release()
+	return { "name": name, "ip": ipv4, "ident": ident, "sent": 0, "base": 0,
+	 "stats": rttstats.Accumulator( histogram ),
+	 "counts": { "duplicates": 0, "late": 0, "reordered": 0 } }
 
-def _checkFlag( lock, flag ):
+def _packTarget( target ):
 	"""
-	This function checks to see if the boolean value shared between
-	the timeout and main threads has been altered.
-	:param lock:   A lock to prevent simultaneous access.
-	:param flag:   A shared value between the thread using this
-	               function and the timeout thread.
-	:return:       None	               
+	This function serializes the record of a destination compactly, so
+	that it can be sent to another process.
+	:param target:   The record of the destination.
+	:return:         The serialized record.
 	"""
-	
-	lock.acquire()
-	boolean = flag[0]
-	lock.release()	
-	return boolean
-		
-def _icmp( size, count ):
+
+	name = target["name"].encode()
+	counts = target["counts"]
+	return ( _TARGET.pack( socket.inet_aton( target["ip"] ), target["sent"],
+	 counts["duplicates"], counts["late"], counts["reordered"], len( name ) ) +
+	 name + target["stats"].toBytes() )
+
+def _unpackTarget( data ):
 	"""
-	This function assembles an ICMP echo request packet with the given
-	amount of data and the given sequence number.
-	:param size:    The amount of data sent in the echo request.
-	:param count:   The sequence number of this particular echo request.
-	:return:        A bytearray representation of this echo request packet.
+	This function rebuilds the record of a destination serialized by
+	_packTarget.
+	:param data:   The serialized record.
+	:return:       The record. Its identifier is zero.
+	"""
+
+	(address, sent, duplicates, late, reordered, length) = _TARGET.unpack_from( data )
+	offset = _TARGET.size
+	target = _target( bytes( data[ offset : offset + length ] ).decode(),
+	 socket.inet_ntoa( address ), 0 )
+	target["sent"] = sent
+	target["counts"] = { "duplicates": duplicates, "late": late, "reordered": reordered }
+	target["stats"] = rttstats.Accumulator.fromBytes( data[ offset + length : ] )
+	return target
+
+def _open():
+	"""
+	This function opens the socket to send echo requests on, a raw
+	socket if possible and an ICMP datagram socket otherwise.
+	:return:   The socket, from transport.openSocket.
+	"""
+
+	try:
+		return transport.openSocket()
+	except PermissionError:
+		sys.exit( "ping: raw sockets need root, and ICMP datagram sockets are "
+		 "not allowed by net.ipv4.ping_group_range" )
+
+def _session( send, targets, W, names, show, sink, metrics=None ):
+	"""
+	This function gathers what is needed to send requests to, and
+	receive replies from, a set of destinations over one socket.
+	:param send:      The socket, from _open.
+	:param targets:   The records of the destinations.
+	:param W:         The number of seconds to wait for each reply.
+	:param names:     A resolver.ReverseResolver, or None.
+	:param show:      If false, replies are counted but not displayed.
+	:param sink:      The output sink replies are written to.
+	:param metrics:   An exporter.Exporter the statistics of the
+	                  destinations are served through, or None.
+	:return:          A dictionary of the socket, a selector with the
+	                  socket registered for reading, the transport.BufferRing
+	                  replies are received into, the destinations keyed
+	                  by ICMP identifier and by address, whether the
+	                  destinations share one identifier, as they do on
+	                  a datagram socket, the probe.InFlight
+	                  table of requests, the resolver, whether to show
+	                  replies, the output sink, the writer it writes
+	                  through, if any, and the exporter, if any.
 	"""
 	
-	# The bytearray representing this echo request packet.
-	icmpHeader = bytearray( 8 + size )
-	
-	# Echo type
-	icmpHeader[0] = 8 
+	selector = selectors.DefaultSelector()
+	selector.register( send, selectors.EVENT_READ )
 	
-	# Code is zero
-	icmpHeader[1] = 0
+	session = { "socket": send, "selector": selector, "ring": transport.BufferRing(),
+	 "byIdent": dict(), "byAddress": dict(),
+	 "shared": transport.isDatagram( send ), "table": probe.InFlight( W ),
+	 "names": names, "show": show, "sink": sink, "writer": sink.writer,
+	 "metrics": metrics }
+	for target in targets:
+		_join( session, target )
 	
-	# Checksum starts as zero
-	icmpHeader[2] = 0
-	icmpHeader[3] = 0
+	# Have the kernel drop replies meant for other processes
+	byIdent = session["byIdent"]
+	if( len( byIdent ) > 0 ):
+		transport.attachFilter( send, min( byIdent ), max( byIdent ) )
+	return session
+
+def _join( session, target ):
+	"""
+	This function adds a destination to a session, so that its replies
+	are recognized and its statistics served.
+	:param session:   The session, from _session.
+	:param target:    The record of the destination.
+	:return:          None
+	"""
 	
-	# Identifier is zero
-	icmpHeader[4] = 0
-	icmpHeader[5] = 0
+	session["byIdent"][ target["ident"] ] = target
+	session["byAddress"][ target["ip"] ] = target
+	if( session["metrics"] is not None ):
+		session["metrics"].watch( target )
+
+def _send( session, target, s ):
+	"""
+	This function sends the next ICMP echo request to a destination
+	and records it as waiting for a reply.
+	:param session:   The session, from _session.
+	:param target:    The destination's record.
+	:param s:         The size of the data to be sent in the echo request.
+	:return:          None
+	"""
 	
-	# Sequence number is zero
-	binary = _pad( bin(count)[2:], 16 )	
-	icmpHeader[6] = int( binary[:8], 2 )
-	icmpHeader[7] = int( binary[8:], 2 )
-    
-    # Send 56 bytes of ones as data
-	total = size + 8
-	for i in range(8, total):
-		icmpHeader[i] = 1
+	# Build the packet
+	target["sent"] += 1
+	seq = ( target["base"] + target["sent"] ) & 0xffff
+	packet = icmp.echoRequest( s, seq, target["ident"] )
 	
-	# Compute the 16-bit one's compliment of this packet.
-	(icmpHeader[2], icmpHeader[3]) = _compute_checksum( icmpHeader )
+	# Send the packet
+	session["table"].add( _key( session, target ), seq, probe.stamp() )
+	transport.send( session["socket"], packet, target["ip"] )
 
-	return icmpHeader
+def _key( session, target ):
+	"""
+	This function finds the key a destination's requests are kept by in
+	the probe.InFlight table: its identifier, or its address if the
+	destinations share one identifier.
+	:param session:   The session, from _session.
+	:param target:    The destination's record.
+	:return:          The key.
+	"""
 	
-def _compute_checksum( header ):
+	if( session["shared"] ):
+		return target["ip"]
+	return target["ident"]
+
+def _wait( session, deadlines ):
 	"""
-	This function computes the sixteen bit one's compliment of the
-	given bytearray.
-	:param header:   A bytearray object for which we want to calculate
-	                 the sixteen bit one's compliment.
-	:return:         The bytes representing the sixteen bit checksum.
+	This function sleeps until the socket is readable or the earliest
+	of the given deadlines passes, and then receives every reply that
+	is waiting.
+	:param session:     The session, from _session.
+	:param deadlines:   The times at which to stop waiting, by
+	                    time.perf_counter(). Entries that are None
+	                    are ignored.
+	:return:            None
 	"""
 	
-	# Take the sum
-	total = _sixteenBitSum( header )
+	wake = min( deadline for deadline in deadlines if deadline is not None )
 	
-	# Convert to binary
-	binary = bin( total )
-    
-    # Remove '0b'
-	binarySub = binary[2:]
+	# Output held back must not wait longer than its time limit
+	writer = session["writer"]
+	held = None if writer is None else writer.deadline()
+	if( held is not None ):
+		writer.poll()
+		wake = min( wake, held )
+	if( len( session["selector"].select( max( wake - time.perf_counter(), 0 ) ) ) > 0 ):
+		session["ring"].drain( session["socket"],
+		 lambda packet, nbytes, address, received:
+		 _receive( session, packet, nbytes, address[0], received ) )
 	
-	length = len( binarySub )
+	# Render a little of a scrape of the metrics, if one is waiting
+	if( session["metrics"] is not None ):
+		session["metrics"].refresh()
 
-	if length < 16:
-		binarySub = '00' + binarySub
+def _receive( session, packet, nbytes, senderIPv4, received ):
+	"""
+	This function handles one packet from the socket. Echo replies are
+	matched to their destination by ICMP identifier and to their request
+	by sequence number. Duplicate, late and reordered replies are counted.
+	Anything else on the socket, such as other programs' replies, is
+	ignored.
+	:param session:      The session, from _session.
+	:param packet:       A memoryview of the packet, which is only valid
+	                     until this function returns.
+	:param nbytes:       The length of the packet.
+	:param senderIPv4:   The sender of the packet.
+	:param received:     When the packet arrived, as taken by probe.elapsed.
+	:return:             None
+	"""
+
+	# Skip anything that is not an echo reply
+	reply = icmp.parseReply( packet, nbytes )
+	if( reply is None or reply[0] != icmp.ECHO_REPLY ):
+		return
+
+	# Identifier and sequence number
+	(icmpType, code, ident, icmp_seq, ttl, size) = reply
 
+	# The reply must come from the destination it claims to answer. On
+	# a datagram socket the kernel sets the identifier of every request
+	# to the socket's own, so only the sender tells destinations apart.
+	if( session["shared"] ):
+		target = session["byAddress"].get( senderIPv4 )
 	else:
-    
-		
-		while( len( binarySub ) != 16 ):
-			
-			# If this is zero, then we don't need to pad 
-			rem = len( binarySub ) % 4
-			for i in range( 0, rem ):
-				binarySub = '0' + binarySub
-		
-			# Position of first sixteen bits
-			begin = len( binarySub ) - 16 + 1
-		
-			# Get the carry and right hand side
-			carry = int( binarySub[0:begin], 2 )
-			right = int( binarySub[begin:], 2 )
+		target = session["byIdent"].get( ident )
+	if( target is None or target["ip"] != senderIPv4 ):
+		return
+
+	# Find the request this reply answers
+	(status, rtt) = session["table"].match( _key( session, target ), icmp_seq, received )
+	if( status == probe.UNKNOWN ):
+		return
+
+	# Only the first reply to a request that is still waiting counts
+	if( status == probe.DUPLICATE ):
+		target["counts"]["duplicates"] += 1
+	elif( status == probe.LATE ):
+		target["counts"]["late"] += 1
+	else:
+		if( status == probe.REORDERED ):
+			target["counts"]["reordered"] += 1
+		target["stats"].add( rtt )
 
-			binarySub = bin( carry + right )[2:]
+	if( session["show"] ):
+		_processPackets( session["sink"], target, senderIPv4, packet, rtt,
+		 session["names"], status )
+
+def _processPackets( sink, target, sender, packet, rtt, names, status ):
+	"""
+	This function processes the received packet, extracting the 
+	packet size, ttl, ICMP sequence, and the alternative name of
+	the destination, and writes the reply to the output sink. The
+	name is looked up in the background, so the address is written
+	on its own until the name is known.
+	:param sink:     The output sink.
+	:param target:   The record of the destination that replied.
+	:param sender:   The sender of the ICMP echo response.
+	:param packet:   The received packet.
+	:param rtt:      The round trip time between ICMP echo request and 
+	                 echo response.
+	:param names:    A resolver.ReverseResolver, or None to display
+	                 the address only.
+	:param status:   What the reply is, as decided by probe.InFlight.match.
+	:return:         None.
+	"""
+	
+	# Size, ttl and ICMP seq
+	(icmpType, code, ident, icmp_seq, ttl, size) = icmp.parseReply( packet, len( packet ) )
+	
+	# Alternative name, if it is known yet
+	source = None
+	if( names is not None ):
+		source = names.lookup( sender )
+	
+	sink.reply( output.Reply( time.time(), target["name"], sender, source, icmp_seq,
+	 ttl, size, rtt, status ) )
+	
+def _summary( target, ellapsed ):
+	"""
+	This function computes the statistics of this ping operation for
+	one destination, such as: minimum rtt, max rtt, average rtt, mean
+	deviation and percentiles.
+	:param target:     The record of the destination.
+	:param ellapsed:   The amount of time spent sending and receiving
+	                   packets, in milliseconds.
+	:return:           An output.Summary.
+	"""
+	
+	return output.summarize( target["name"], target["ip"], target["sent"],
+	 target["stats"], target["counts"], ellapsed )
+
+def _interim( sent, stats, destination ):
+	"""
+	This function displays a one line summary of the statistics so far
+	on standard error, as iputils ping does on SIGQUIT, without stopping.
+	:param sent:          The number sent ICMP echo request packets
+	:param stats:         The rttstats.Accumulator of the received ICMP
+	                      echo reponse packets
+	:param destination:   The destination to name at the start of the line,
+	                      or the empty string to name none.
+	:return:              None
+	"""
 	
-	# Flip every bit using XOR		
-	binarySub = bin(int( binarySub, 2 ) ^ 65535)[2:]
-	first = int( binarySub[0:8], 2)
-	second = int( binarySub[8:], 2)
+	output = ""
+	if( destination != "" ):
+		output = destination + ": "
+	output += "{}/{} packets, {:.0f}% loss".format( stats.count, sent,
+	 _loss( sent, stats.count ) )
+	if( stats.count > 0 ):
+		output += ", min/avg/ewma/max = {:.3f}/{:.3f}/{:.3f}/{:.3f} ms".format(
+		 stats.minimum, stats.mean, stats.ewma, stats.maximum )
+	print( output, file=sys.stderr )
 
-	return ( first, second )
+def _receiveStatistics( sink, ring ):
+	"""
+	This function displays how many packets were read each time the
+	socket was found readable.
+	:param sink:   The output sink.
+	:param ring:   The transport.BufferRing the packets were read into.
+	:return:       None
+	"""
+	
+	sink.comment( "receive: {} wakeups, {} datagrams, {:.1f} per wakeup, at most {}".format(
+	 ring.wakeups, ring.datagrams, ring.datagrams / max( ring.wakeups, 1 ),
+	 ring.largest ) )
 
-def _sixteenBitSum( arr ):
+def _loss( sent, received ):
 	"""
-	This function computes the sixteen bit sum of the given
-	bytearray.
-	:param arr:   The bytearray object for which we want
-	              to calculate the sixteen bit sum.
-	:return:      The sixteen bit sum.
+	This function calculates the percentage of packets lost.
+	:param sent:       The number of packets sent.
+	:param received:   The number of packets received.
+	:return:           The percentage lost, or zero if none were sent.
 	"""
 	
-	total = 0
-	length = len( arr )
-	for i in range( 0, length, 2 ):
-		left = _pad( bin(arr[i])[2:], 8 )
-		right = _pad( bin(arr[i+1])[2:], 8 )
-		concat = left + right
-		total += int( concat, 2 )
-	return total
+	if( sent == 0 ):
+		return 0.0
+	return 100 - ( ( received / sent ) * 100 )
 
-def _pad( string, length ):
+def _onQuit( report ):
+	"""
+	This function arranges for the given report to be displayed whenever
+	the program receives SIGQUIT (Ctrl+\\), on platforms that have it.
+	:param report:   A function of no arguments that displays the report.
+	:return:         None
 	"""
-	This function pads the left side of the given binary string 
-	with zeros until the length of the string is equal to the
-	length specified.
-	:param string:   The binary string to pad.
-	:param length:   The desired length of the padded string.
-	:return:         The padded string.
+	
+	if( hasattr( signal, "SIGQUIT" ) ):
+		signal.signal( signal.SIGQUIT, lambda signum, frame: report() )
+	
+def _checkCount( c, count ):
+	"""
+	This function checks to make sure that the specified number of packets
+	has not yet been sent yet.
+	:param c:       The maximum number that will be sent.
+	                If this value is zero, it is interpreted as infinity.
+	:param count:   The number of packets sent so far.
+	:return:        True if there are more packets to be sent. False
+	                otherwise.
 	"""
 	
-	diff = length - len(string)
-	for i in range(0,diff):
-		string = '0' + string
-	return string
+	# If c=0, then count is not part of ping's exit condition.
+	# If c/=0, then count is part of ping's exit condition.
+	if( c == 0 or count < c ):
+		return True
+	else:
+		return False
 
 def _parse( strArr ):
 	"""
 	This funciton parses the array of inputs to the ping program 
-	for different possible options and the destination.
+	for different possible options and the destinations.
 	:param strArr:   The array of inputs to the ping program.
-	:return:         The specified settings for this particular
-	                 execution of the ping program.
+	:return:         The destinations and the specified settings for
+	                 this particular execution of the ping program.
 	"""
 	
 	# Starting location in the array of arguments
 	pointer = 0
 	
-	# Number of packets to send. This default value of zero is 
-	# interpreted as infinity.
-	c = 0
-	
-	# The number of seconds between sent ICMP echo request packets.
-	# One is the default value.
-	i = 1
+	options = {
 	
-	# The number of bytes of data to be sent in the ICMP echo
-	# request packet. The default value is 56 bytes.
-	s = 56
-	
-	# The numebr of seconds the ping program should run for.
-	# This default value of zero is interpreted as infinity.
-	t = 0
+		# Number of packets to send. This default value of zero is 
+		# interpreted as infinity.
+		"c": 0,
+		
+		# The number of seconds between sent ICMP echo request packets.
+		# One is the default value.
+		"i": 1,
+		
+		# The number of bytes of data to be sent in the ICMP echo
+		# request packet. The default value is 56 bytes.
+		"s": 56,
+		
+		# The numebr of seconds the ping program should run for.
+		# This default value of zero is interpreted as infinity.
+		"t": 0,
+		
+		# A file listing further destinations, one per line.
+		# The empty string means there is no such file.
+		"F": "",
+		
+		# Display addresses only, without looking up their names.
+		"n": False,
+		
+		# The number of seconds to wait for each reply. Ten is the
+		# default value.
+		"W": 10,
+		
+		# Flood the destination for capacity testing.
+		"f": False,
+		
+		# The number of packets sent at once. One is the default value.
+		"l": 1,
+		
+		# The number of packets per second to flood at. This default
+		# value of zero is interpreted as no limit.
+		"r": 0,
+		
+		# Write only the summary, not every reply.
+		"q": False,
+		
+		# Ping the destinations of the target file continuously, each
+		# at its own interval, until stopped.
+		"D": False,
+		
+		# The format of the output, one of output.FORMATS.
+		"o": "text",
+		
+		# The TCP port to serve metrics on. This default value of zero
+		# means they are not served.
+		"M": 0,
+		
+		# The number of processes many destinations are spread over.
+		# One is the default value.
+		"P": 1,
+		
+		# A file describing a simulated network to probe instead of the
+		# real one. The empty string means the real one is probed.
+		"E": ""
+	}
 	
-	# Destination of the ICMP echo request packets.
-	addr = ""
+	# Destinations of the ICMP echo request packets.
+	destinations = list()
 	
-	# Process options before address
-	(addr, pointer, c, i, s, t) = _processOptions( 0, strArr, c, i, s, t )
+	# Options and destinations may appear in any order
+	while( pointer < len( strArr ) ):
+		(addr, pointer) = _processOptions( pointer, strArr, options )
+		if( addr != "" ):
+			destinations.append( addr )
 
-	# Process options after address
-	(bull, pointer, c, i, s, t) = _processOptions( pointer, strArr, c, i, s, t )	
-
-	return (addr, c, i, s, t)
+	return ( destinations, options )
 		
-def _processOptions( index, strArr, c, i, s, t ):
+def _processOptions( index, strArr, options ):
 	"""
 	This function processes the array of ping program inputs for
 	various options and their values. This function ends when
-	the destination of the ICMP echo request packets is found or
+	a destination of the ICMP echo request packets is found or
 	when there are no more inputes to process.
-	:param index:    Index in the array that the processing will start at.
-	:param strArr:   The array of inputs to the ping program.
-	:param c:        The number of packets to be sent. If zero, it is
-	                 the 'default' value and is interpreted as infinity.
-	:param i:        The number of seconds before another packet is sent.
-	:param s:        The size of the data to be sent in each ICMP echo request.
-	:param t:        The number of seconds before the program exits. If zero,
-	                 it is the 'default' value and is interpreted as infinity.
-	:return: 		 Part of the specified settings for this particular
-	                 execution of the ping program. 	  
+	:param index:     Index in the array that the processing will start at.
+	:param strArr:    The array of inputs to the ping program.
+	:param options:   The settings of this execution of the ping program,
+	                  updated with every option found.
+	:return: 		  The destination found, or the empty string, and the
+	                  index at which processing should continue.
 	"""
 	
 	# Possible options
-	options = [ "-c", "-i", "-s", "-t" ]
+	valueLess = [ "-n", "-f", "-q", "-D" ]
+	valued = [ "-c", "-i", "-s", "-t", "-W", "-l", "-r", "-M", "-P" ]
+	named = [ "-F", "-o", "-E" ]
 	
 	# Number of arguments
 	length = len( strArr )
@@ -435,47 +1354,46 @@ def _processOptions( index, strArr, c, i, s, t ):
 	# Starting index in the array of arguments
 	pointer = index
 	
-	# Continue until we find the destination
-	flag = True
-	while( flag ):
-		try:
+	# Continue until we find a destination
+	while( pointer < length ):
+		option = strArr[pointer]
+		
+		# Options that are switched on by being present
+		if( option in valueLess ):
+			options[ option[1:] ] = True
+			pointer += 1
+		
+		# Options whose value is a name
+		elif( option in named and pointer + 1 < length ):
+			options[ option[1:] ] = strArr[pointer+1]
+			pointer += 2
 			
-			# Check if we have reached the end
-			if( pointer < length ):
-				
-				# If the current item is not an option, it must be the destination
-				location = options.index( strArr[pointer] )
-				
-				# Get the value associated with the option
+		elif( option in valued ):
+			
+			# Get the value associated with the option. If there is
+			# none, the option is returned as if it were the destination
+			try:
 				value = float(strArr[pointer+1])
+			except ( ValueError, IndexError ):
+				return ( option, pointer + 1 )
 				
-				# Assess validity of value
-				( c, i, s, t ) = _chooseOption( options[location], value, c, i, s, t )
-				pointer += 2
-				
-			else:
-				flag = False
-				
-		# Thrown by options.index when we reach the destination		
-		except ValueError:
-			flag = False
-			addr = strArr[pointer]
-			return ( addr, pointer + 1, c, i, s, t )
-	return ( "", pointer, c, i, s, t )	
-	
-def _chooseOption( option, value, c, i, s, t ):
-	"""
-	This function validates the value of a discovered option.
-	:param option:   The option whose value we want to validate.
-	:param value:    The value to be validated.
-	:param c:        The number of packets to be sent. If zero, it is
-	                 the 'default' value and is interpreted as infinity.
-	:param i:        The number of seconds before another packet is sent.
-	:param s:        The size of the data to be sent in each ICMP echo request.
-	:param t:        The number of seconds before the program exits. If zero,
-	                 it is the 'default' value and is interpreted as infinity.
-	:return: 		 Part of the specified settings for this particular
-	                 execution of the ping program. 
+			# Assess validity of value
+			_chooseOption( option, value, options )
+			pointer += 2
+		
+		# If the current item is not an option, it must be a destination
+		else:
+			return ( option, pointer + 1 )
+	return ( "", pointer )	
+	
+def _chooseOption( option, value, options ):
+	"""
+	This function validates the value of a discovered option and
+	stores it in the settings.
+	:param option:    The option whose value we want to validate.
+	:param value:     The value to be validated.
+	:param options:   The settings of this execution of the ping program.
+	:return: 		  None
 	"""
 	
 	if( option == "-c" ):
@@ -483,7 +1401,7 @@ def _chooseOption( option, value, c, i, s, t ):
 			c = int(value)
 			if c <= 0:
 				sys.exit( "ping: bad number of packets to transmit." )
-			return ( c, i, s, t )
+			options["c"] = c
 		except ValueError:
 			sys.exit( "ping: bad number of packets to transmit." )
 			
@@ -491,8 +1409,8 @@ def _chooseOption( option, value, c, i, s, t ):
 		try:
 			i = float(value)
 			if i <= 0: 
-				sys.exit( "ping: cannot flood; minimal interval allowed for user is 200ms")
-			return ( c, i, s, t )
+				sys.exit( "ping: bad timing interval; use -f to flood" )
+			options["i"] = i
 		except ValueError:
 			sys.exit( "ping: bad timing interval" )
 			
@@ -501,34 +1419,188 @@ def _chooseOption( option, value, c, i, s, t ):
 			s = int(value)
 			if s < 0:
 				sys.exit( "ping: illegal negative packet size " + str(s) + "." )
-			return ( c, i, s, t )
+			options["s"] = s
 		except:
 			sys.exit( "ping: bad packet size" )
+	elif( option == "-l" ):
+		try:
+			l = int(value)
+			if l <= 0 or l != value:
+				sys.exit( "ping: bad preload value, should be 1..65536" )
+			options["l"] = min( l, 65536 )
+		except ( ValueError, OverflowError ):
+			sys.exit( "ping: bad preload value, should be 1..65536" )
+	elif( option == "-r" ):
+		if value < 0:
+			sys.exit( "ping: bad flood rate." )
+		options["r"] = value
+	elif( option == "-M" ):
+		try:
+			M = int(value)
+			if M <= 0 or M > 65535 or M != value:
+				sys.exit( "ping: bad metrics port." )
+			options["M"] = M
+		except ( ValueError, OverflowError ):
+			sys.exit( "ping: bad metrics port." )
+	elif( option == "-P" ):
+		try:
+			P = int(value)
+			if P <= 0 or P != value:
+				sys.exit( "ping: bad number of processes." )
+			options["P"] = P
+		except ( ValueError, OverflowError ):
+			sys.exit( "ping: bad number of processes." )
+	elif( option == "-W" ):
+		try:
+			W = float(value)
+			if not math.isfinite( W ) or W <= 0:
+				sys.exit( "ping: bad linger time." )
+			options["W"] = W
+		except ValueError:
+			sys.exit( "ping: bad linger time." )
 	else:
 		try:
 			t = float(value)
 			if t < 0:
 				sys.exit( "ping: bad wait time." )
-			return ( c, i, s, value )
+			options["t"] = t
 		except:
 			sys.exit( "ping: bad timeout" )
+
+def _readTargets( path ):
+	"""
+	This function reads a list of destinations from a file, one per
+	line, each optionally followed by the number of seconds between
+	its packets. Blank lines and lines starting with '#' are skipped.
+	:param path:   The file to read, or '-' for standard input.
+	:return:       A list of the destinations and their intervals, as
+	               from _parseTargets.
+	"""
+	
+	try:
+		return _parseTargets( _readLines( path ) )
+	except OSError:
+		sys.exit( "ping: cannot read target file " + path )
+	except ValueError as error:
+		sys.exit( "ping: " + str( error ) )
+
+def _readLines( path ):
+	"""
+	This function reads the lines of a target file.
+	:param path:   The file to read, or '-' for standard input.
+	:return:       A list of the lines.
+	:raises OSError:   If the file cannot be read.
+	"""
+	
+	if( path == "-" ):
+		return sys.stdin.readlines()
+	with open( path ) as targetFile:
+		return targetFile.readlines()
+
+def _parseTargets( lines ):
+	"""
+	This function parses the lines of a target file.
+	:param lines:   The lines. Each is a destination, optionally followed
+	                by the number of seconds between its packets. Blank
+	                lines and lines starting with '#' are skipped.
+	:return:        A list of the destinations and their intervals, with
+	                None for a destination listed without one.
+	:raises ValueError:   If an interval is not a positive number.
+	"""
+	
+	destinations = list()
+	for line in lines:
+		fields = line.split()
+		if( len( fields ) == 0 or fields[0][0] == "#" ):
+			continue
+		
+		interval = None
+		if( len( fields ) > 1 ):
+			try:
+				interval = float( fields[1] )
+			except ValueError:
+				interval = 0
+			if( not interval > 0 or interval == math.inf ):
+				raise ValueError( "bad timing interval for " + fields[0] )
+		destinations.append( ( fields[0], interval ) )
+	return destinations
 			
 def main():
 	"""
 	The main function. It first checks to make that the user has
 	entered more than just the name of the program. If more has
 	been entered, the input is processed. If the input is succesfully
-	processed, then the ping program can start.
+	processed, then the ping program can start. A single destination
+	is pinged on its own, while several destinations share one socket.
 	"""
 	
+	usage = ( "Usage: ping [-n] [-f] [-q] [-D] [-c count] [-i wait] [-l preload] [-r rate] " +
+	 "[-s packetsize] [-t timeout] [-W linger] [-o text|json|csv|binary] [-M port] " +
+	 "[-P processes] [-F targetfile] [-E networkfile] destination [destination ...]" )
+	
 	if( len(sys.argv[1:]) == 0 ):
-		print("Usage: ping [-c count] [-i wait] [-s packetsize] [-t timeout] destination")
+		print( usage )
 	else:
-		(addr, c, i, s, t) = _parse(sys.argv[1:])
-		if( addr[0] == "-"):
-			print("Usage: ping [-c count] [-i wait] [-s packetsize] [-t timeout] destination")
-		else:	
-			_ping(addr, c, i, s, t)
+		(destinations, options) = _parse(sys.argv[1:])
+		if( options["D"] ):
+			if( options["F"] == "" or len( destinations ) > 0 or options["f"] ):
+				sys.exit( "ping: -D pings the destinations of a target file given by -F" )
+		elif( options["F"] != "" ):
+			destinations += [ destination for (destination, interval)
+			 in _readTargets( options["F"] ) ]
+		
+		(c, i, s, t, W) = ( options["c"], options["i"], options["s"], options["t"], options["W"] )
+		
+		if( options["o"] not in output.FORMATS ):
+			sys.exit( "ping: unknown output format " + options["o"] )
+		if( options["P"] > 1 and ( options["D"] or options["f"] or options["M"] > 0 ) ):
+			sys.exit( "ping: -P cannot be used with -D, -f or -M" )
+		
+		# Every destination pinged at once has an identifier of its own,
+		# while the daemon shares one among them all
+		if( not options["D"] and len( destinations ) > transport.IDENTIFIERS ):
+			sys.exit( "ping: cannot ping more than " + str( transport.IDENTIFIERS ) +
+			 " destinations at once, except with -D" )
+		sink = output.sink( options["o"] )
+		
+		# Probe a simulated network if -E is given
+		if( options["E"] != "" ):
+			try:
+				transport.simulate( netsim.Network.load( options["E"] ) )
+			except ( OSError, ValueError ) as error:
+				sys.exit( "ping: cannot read network file " + options["E"] + ": " + str( error ) )
+		
+		# Statistics are also served over HTTP if -M is given
+		metrics = None
+		if( options["M"] > 0 ):
+			try:
+				metrics = exporter.Exporter( options["M"] )
+			except OSError as error:
+				sys.exit( "ping: cannot serve metrics on port " + str( options["M"] ) +
+				 ": " + str( error.strerror ) )
+		
+		# Names are looked up in the background unless -n is given.
+		# Floods and quiet runs display no replies, so never need them.
+		names = None
+		if( not options["n"] and not options["f"] and not options["q"] ):
+			names = resolver.ReverseResolver()
+		
+		if( options["D"] ):
+			_daemon( options["F"], i, s, t, W, names, sink, options["q"], metrics )
+		elif( len( destinations ) == 0 or
+		 any( addr[0] == "-" for addr in destinations ) ):
+			print( usage )
+		elif( options["f"] ):
+			if( len( destinations ) > 1 or options["F"] != "" ):
+				sys.exit( "ping: -f floods a single destination" )
+			_flood( destinations[0], c, s, t, W, options["l"], options["r"], sink, metrics )
+		elif( options["P"] > 1 and len( destinations ) > 1 ):
+			_pingSharded( destinations, options["P"], c, i, s, t, W, sink )
+		elif( len( destinations ) == 1 and options["F"] == "" ):
+			_ping( destinations[0], c, i, s, t, W, options["l"], names, sink, options["q"],
+			 metrics )
+		else:
+			_pingMany( destinations, c, i, s, t, W, names, sink, options["q"], metrics )
 	
 if __name__ == "__main__":
     main()
@@ -0,0 +1,263 @@
+"""
+Bookkeeping for the echo requests that have been sent but not answered.
+"""
+
+import collections
+import heapq
+import time
+
+# What a reply turned out to be, as decided by InFlight.match
+REPLY = "reply"
+REORDERED = "reordered"
+DUPLICATE = "duplicate"
+LATE = "late"
+UNKNOWN = "unknown"
+
+# Leeway allowed between the kernel's and the user space round trip
+# times, in nanoseconds, for the clocks being read at slightly
+# different moments
+SLACK = 10000
+
+def stamp():
+	"""
+	This function stamps a request as it is sent, reading the monotonic
+	clock first and then the wall clock.
+	:return:   A tuple of time.perf_counter_ns() and time.time_ns().
+	"""
+
+	mono = time.perf_counter_ns()
+	return ( mono, time.time_ns() )
+
+def elapsed( sent, received ):
+	"""
+	This function computes a round trip time. The kernel's stamp of when
+	the reply arrived is used if there is one, since it leaves out any
+	time the reply spent waiting to be read. The kernel stamps replies
+	with the wall clock, so that round trip time is checked against the
+	monotonic one: if it is negative or longer, the wall clock has been
+	adjusted in between and the monotonic round trip time is used.
+	:param sent:       The stamp of the request, from stamp().
+	:param received:   A tuple of time.perf_counter_ns() when the reply
+	                   was read, and the kernel's stamp of when it arrived
+	                   in nanoseconds since the epoch, or None.
+	:return:           The round trip time, in milliseconds.
+	"""
+
+	(sentMono, sentReal) = sent
+	(receivedMono, kernel) = received
+
+	user = receivedMono - sentMono
+	if( kernel is not None ):
+		rtt = kernel - sentReal
+		if( 0 <= rtt <= user + SLACK ):
+			return rtt / 1000000
+	return user / 1000000
+
+class InFlight:
+	"""
+	This class keeps every outstanding echo request by its key, such as
+	the ICMP identifier of its destination, and its sequence number,
+	along with the time it was sent and the time by which it must be
+	answered. Sending and receiving are therefore independent of each
+	other: a reply is matched to the request it answers whenever it
+	arrives, and its round trip time comes from that request's send
+	time. Requests that have been answered or have timed out are
+	remembered for a while longer, so that duplicate and late replies
+	can be told apart from replies that were never asked for.
+	"""
+
+	def __init__( self, timeout, memory=65536 ):
+		"""
+		This function creates an empty table.
+		:param timeout:   The default number of seconds a request may go
+		                  unanswered before it is considered lost.
+		:param memory:    The number of answered or lost requests to remember.
+		"""
+
+		self.timeout = timeout
+		self.memory = memory
+
+		# ( key, seq ) -> send stamp of each outstanding request
+		self._probes = dict()
+
+		# ( deadline, key, seq, send stamp ) of each request, soonest first.
+		# Entries of requests that have since been answered are skipped
+		# when they reach the top.
+		self._deadlines = list()
+
+		# ( key, seq ) -> ( outcome, send stamp ) of requests that have
+		# been answered or lost, oldest first
+		self._done = collections.OrderedDict()
+
+		# key -> highest sequence number answered so far
+		self._highest = dict()
+
+	def __len__( self ):
+		"""
+		This function counts the outstanding requests.
+		:return:   The number of requests neither answered nor lost.
+		"""
+
+		return len( self._probes )
+
+	def add( self, key, seq, sent, timeout=None ):
+		"""
+		This function records that a request has been sent. If a request
+		with the same key and sequence number is still outstanding, the
+		sequence numbers have wrapped around and the old one is lost.
+		:param key:       The key of the request's destination.
+		:param seq:       The sequence number of the request.
+		:param sent:      The stamp of the request, from stamp().
+		:param timeout:   The number of seconds the request may go
+		                  unanswered, if not the table's default.
+		:return:          None
+		"""
+
+		if( timeout is None ):
+			timeout = self.timeout
+
+		probe = ( key, seq )
+		if( probe in self._probes ):
+			self._forget( probe, LATE )
+
+		self._probes[probe] = sent
+		deadline = sent[0] / 1000000000 + timeout
+		heapq.heappush( self._deadlines, ( deadline, key, seq, sent ) )
+
+	def match( self, key, seq, received ):
+		"""
+		This function matches a reply to the request it answers.
+		:param key:        The key of the reply's sender.
+		:param seq:        The sequence number of the reply.
+		:param received:   When the reply arrived, as taken by elapsed().
+		:return:           A tuple of what the reply is, one of REPLY,
+		                   REORDERED, DUPLICATE, LATE or UNKNOWN, and its
+		                   round trip time in milliseconds, or None for UNKNOWN.
+		"""
+
+		probe = ( key, seq )
+		sent = self._probes.pop( probe, None )
+
+		# Answered or lost already
+		if( sent is None ):
+			done = self._done.get( probe )
+			if( done is None ):
+				return ( UNKNOWN, None )
+			(outcome, sent) = done
+			if( outcome == REPLY ):
+				return ( DUPLICATE, elapsed( sent, received ) )
+			return ( LATE, elapsed( sent, received ) )
+
+		self._forget( probe, REPLY, sent )
+
+		# A reply is reordered if a later request was answered before it.
+		# Sequence numbers are compared modulo 2^16 as they wrap around.
+		status = REPLY
+		highest = self._highest.get( key )
+		if( highest is not None and ( ( seq - highest ) & 0xffff ) > 0x8000 ):
+			status = REORDERED
+		else:
+			self._highest[key] = seq
+
+		return ( status, elapsed( sent, received ) )
+
+	def expire( self, now ):
+		"""
+		This function gives up on the requests whose time is up.
+		:param now:   The current time, in seconds, by time.perf_counter().
+		:return:      A list of the ( key, seq ) of every request lost.
+		"""
+
+		lost = list()
+		while( len( self._deadlines ) > 0 and self._deadlines[0][0] <= now ):
+			(deadline, key, seq, sent) = heapq.heappop( self._deadlines )
+			probe = ( key, seq )
+
+			# Skip requests answered since, or sent again after wrapping
+			if( self._probes.get( probe ) == sent ):
+				del self._probes[probe]
+				self._forget( probe, LATE, sent )
+				lost.append( probe )
+		return lost
+
+	def nextDeadline( self ):
+		"""
+		This function finds when the next outstanding request times out.
+		:return:   That time, in seconds by time.perf_counter(), or None
+		           if nothing is outstanding.
+		"""
+
+		# Drop requests from the top that have already been answered
+		while( len( self._deadlines ) > 0 ):
+			(deadline, key, seq, sent) = self._deadlines[0]
+			if( self._probes.get( ( key, seq ) ) == sent ):
+				return deadline
+			heapq.heappop( self._deadlines )
+		return None
+
+	def _forget( self, probe, outcome, sent=None ):
+		"""
+		This function remembers how a request ended, forgetting the
+		oldest such request once too many are remembered.
+		:param probe:     The ( key, seq ) of the request.
+		:param outcome:   REPLY if it was answered, LATE if it was lost.
+		:param sent:      The stamp of the request. If None, it is taken
+		                  from the outstanding requests.
+		:return:          None
+		"""
+
+		if( sent is None ):
+			sent = self._probes.pop( probe )
+		self._done[probe] = ( outcome, sent )
+		self._done.move_to_end( probe )
+		while( len( self._done ) > self.memory ):
+			self._done.popitem( last=False )
+
+class TokenBucket:
+	"""
+	This class paces sending. Tokens are added at a steady rate, up to
+	a fixed number, and a request may only be sent by taking a token.
+	A full bucket lets that many requests go out at once, after which
+	requests leave at the rate tokens are added.
+	"""
+
+	def __init__( self, rate, burst, now ):
+		"""
+		This function creates a full bucket.
+		:param rate:    The number of tokens added per second, or
+		                math.inf for no limit.
+		:param burst:   The largest number of tokens the bucket holds.
+		:param now:     The current time, in seconds.
+		"""
+
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self._stamp = now
+
+	def take( self, now, wanted ):
+		"""
+		This function takes as many tokens as are wanted and available.
+		:param now:      The current time, in seconds.
+		:param wanted:   The largest number of tokens to take.
+		:return:         The number of tokens taken.
+		"""
+
+		# Add the tokens earned since last time
+		self.tokens = min( self.burst, self.tokens + ( now - self._stamp ) * self.rate )
+		self._stamp = now
+
+		taken = int( min( self.tokens, wanted ) )
+		self.tokens -= taken
+		return taken
+
+	def ready( self, now ):
+		"""
+		This function finds when the next token will be available.
+		:param now:   The current time, in seconds.
+		:return:      That time, in seconds.
+		"""
+
+		if( self.tokens >= 1 ):
+			return now
+		return self._stamp + ( 1 - self.tokens ) / self.rate
@@ -0,0 +1,343 @@
+"""
+Name lookups for ping and traceroute that happen in the background, so
+that a slow DNS server never holds up the handling of packets, and so
+that long lists of names are looked up many at a time.
+"""
+
+import collections
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+class ReverseResolver:
+	"""
+	This class looks up the names of IPv4 addresses (PTR records) on a
+	small pool of background threads. Answers, including failures, are
+	kept in a cache of bounded size for a limited time. Asking for an
+	address never blocks: the name is returned if it is already known,
+	and otherwise a lookup is started and None is returned, so that the
+	caller can show the address on its own for now.
+	"""
+
+	def __init__( self, workers=4, size=4096, ttl=300, negativeTtl=60 ):
+		"""
+		This function creates a resolver. Its threads are daemons, so a
+		lookup that is still in progress does not delay the program's exit.
+		:param workers:       The number of lookups that may run at once.
+		:param size:          The largest number of addresses kept in the cache.
+		:param ttl:           The number of seconds a name is kept for.
+		:param negativeTtl:   The number of seconds an address with no name
+		                      is kept for.
+		"""
+
+		self.size = size
+		self.ttl = ttl
+		self.negativeTtl = negativeTtl
+
+		# Address -> ( name or None, time at which the entry expires ),
+		# least recently used first
+		self._cache = collections.OrderedDict()
+
+		# Addresses waiting for, or in the middle of, a lookup
+		self._pending = set()
+
+		# Protects the cache and the pending set
+		self._lock = threading.Lock()
+
+		# Addresses to be looked up by the worker threads
+		self._queue = queue.Queue()
+		for i in range( workers ):
+			threading.Thread( target=self._work, daemon=True ).start()
+
+	def lookup( self, address ):
+		"""
+		This function returns the name of an address if it is known,
+		and otherwise starts looking it up.
+		:param address:   The IPv4 address.
+		:return:          The name of the address, or None if it has no
+		                  name or the lookup has not finished yet.
+		"""
+
+		now = time.monotonic()
+		with self._lock:
+			entry = self._cache.get( address )
+			if( entry is not None and entry[1] > now ):
+				self._cache.move_to_end( address )
+				return entry[0]
+
+			# Only look each address up once at a time
+			if( address not in self._pending ):
+				self._pending.add( address )
+				self._queue.put( address )
+		return None
+
+	def _work( self ):
+		"""
+		This function is run by each worker thread. It looks up the
+		addresses on the queue, one at a time, and caches the answers.
+		:return:   None
+		"""
+
+		while( True ):
+			address = self._queue.get()
+			try:
+				(name, aliaslist, ipaddrlist) = socket.gethostbyaddr( address )
+				expires = time.monotonic() + self.ttl
+			except OSError:
+				name = None
+				expires = time.monotonic() + self.negativeTtl
+
+			with self._lock:
+				self._cache[address] = ( name, expires )
+				self._cache.move_to_end( address )
+
+				# Forget the least recently used addresses
+				while( len( self._cache ) > self.size ):
+					self._cache.popitem( last=False )
+				self._pending.discard( address )
+
+class ForwardResolver:
+	"""
+	This class looks up the IPv4 addresses of many names at once, on
+	a bounded pool of background threads, so that a long list of names
+	takes about as long as its slowest few lookups rather than all of
+	them one after another. Names are numbered in the order they are
+	submitted, and each answer can be collected as soon as it is known,
+	so the caller can start on the names found while the rest are still
+	being looked up. Answers, including failures, are cached for a
+	limited time, and the cache can be kept in a file from one run to
+	the next.
+	"""
+
+	def __init__( self, workers=32, ttl=300, negativeTtl=60, path=None ):
+		"""
+		This function creates a resolver, reading the cache from its file
+		if it has one. Its threads are started as they are needed, and
+		are daemons, so a lookup that is still in progress does not delay
+		the program's exit.
+		:param workers:       The number of lookups that may run at once.
+		:param ttl:           The number of seconds an address is kept for.
+		:param negativeTtl:   The number of seconds a name with no address
+		                      is kept for.
+		:param path:          The file the cache is kept in, or None to
+		                      keep it in memory only.
+		"""
+
+		self.workers = workers
+		self.ttl = ttl
+		self.negativeTtl = negativeTtl
+		self.path = path
+
+		# Name -> ( address or None, time at which the entry expires, in
+		# seconds since the epoch so that it means the same to later runs )
+		self._cache = dict()
+		if( path is not None ):
+			self._cache = _readCache( path )
+
+		# The name and, once it is known, the answer for each number,
+		# with None for a name that has no address
+		self._names = list()
+		self._answers = dict()
+
+		# The numbers answered since ready was last called
+		self._fresh = list()
+
+		# Name -> numbers waiting for the lookup of that name
+		self._waiting = dict()
+
+		# Protects everything above, and is notified of every answer
+		self._condition = threading.Condition()
+
+		# Names to be looked up by the worker threads
+		self._queue = queue.Queue()
+		self._threads = 0
+
+	def __len__( self ):
+		"""
+		This function counts the names still being looked up.
+		:return:   The number of names submitted and not yet answered.
+		"""
+
+		with self._condition:
+			return len( self._names ) - len( self._answers )
+
+	def submit( self, names ):
+		"""
+		This function starts looking names up. Addresses and names that
+		are cached are answered at once.
+		:param names:   The names, which are numbered on from those
+		                submitted before.
+		:return:        The number of the first of them.
+		"""
+
+		now = time.time()
+		with self._condition:
+			start = len( self._names )
+			for name in names:
+				number = len( self._names )
+				self._names.append( name )
+
+				# A name already waiting for its lookup is not looked up again
+				if( name in self._waiting ):
+					self._waiting[name].append( number )
+					continue
+
+				address = _literal( name )
+				entry = self._cache.get( name )
+				if( address is not None ):
+					self._answer( number, address )
+				elif( entry is not None and entry[1] > now ):
+					self._answer( number, entry[0] )
+				else:
+					self._waiting[name] = [ number ]
+					self._queue.put( name )
+					if( self._threads < min( self.workers, len( self._waiting ) ) ):
+						self._threads += 1
+						threading.Thread( target=self._work, daemon=True ).start()
+		return start
+
+	def ready( self ):
+		"""
+		This function collects the answers that have arrived since it was
+		last called, without waiting for any more.
+		:return:   A list of the number, name and address of each, where
+		           the address is None for a name that has none.
+		"""
+
+		with self._condition:
+			fresh = self._fresh
+			self._fresh = list()
+			return [ ( number, self._names[number], self._answers[number] )
+			 for number in fresh ]
+
+	def wait( self, number, timeout=None ):
+		"""
+		This function waits for the answer for one name.
+		:param number:    The number of the name.
+		:param timeout:   The most seconds to wait, or None to wait as long
+		                  as the lookup takes.
+		:return:          Its address, or None if it has none or the time
+		                  ran out.
+		"""
+
+		with self._condition:
+			self._condition.wait_for( lambda: number in self._answers, timeout )
+			return self._answers.get( number )
+
+	def resolve( self, names ):
+		"""
+		This function looks names up, all at once, and waits for every
+		answer.
+		:param names:   The names.
+		:return:        A list of the address of each, or None for a
+		                name that has none.
+		"""
+
+		start = self.submit( names )
+		return [ self.wait( number ) for number in range( start, start + len( names ) ) ]
+
+	def save( self ):
+		"""
+		This function writes the cache to its file, if it has one, along
+		with the entries written there since it was read that are still
+		fresh. The file is replaced whole, so a run that is stopped part
+		way never leaves it half written. A cache that cannot be written
+		is not kept.
+		:return:   None
+		"""
+
+		if( self.path is None ):
+			return
+		now = time.time()
+		with self._condition:
+			entries = _readCache( self.path )
+			entries.update( self._cache )
+		entries = { name: entry for (name, entry) in entries.items() if entry[1] > now }
+
+		try:
+			os.makedirs( os.path.dirname( self.path ) or ".", exist_ok=True )
+			temporary = self.path + "." + str( os.getpid() )
+			with open( temporary, "w" ) as stream:
+				json.dump( entries, stream )
+			os.replace( temporary, self.path )
+		except OSError:
+			pass
+
+	def _answer( self, number, address ):
+		"""
+		This function records the answer for a name. It is called with
+		the lock held.
+		:param number:    The number of the name.
+		:param address:   Its address, or None.
+		:return:          None
+		"""
+
+		self._answers[number] = address
+		self._fresh.append( number )
+
+	def _work( self ):
+		"""
+		This function is run by each worker thread. It looks up the names
+		on the queue, one at a time, and caches the answers.
+		:return:   None
+		"""
+
+		while( True ):
+			name = self._queue.get()
+			try:
+				infos = socket.getaddrinfo( name, None, socket.AF_INET, socket.SOCK_RAW )
+				address = infos[0][4][0]
+				expires = time.time() + self.ttl
+			except ( OSError, UnicodeError, IndexError ):
+				address = None
+				expires = time.time() + self.negativeTtl
+
+			with self._condition:
+				self._cache[name] = ( address, expires )
+				for number in self._waiting.pop( name ):
+					self._answer( number, address )
+				self._condition.notify_all()
+
+def cachePath():
+	"""
+	This function finds where ping and traceroute keep the addresses of
+	the names they look up: hosts.json under $XDG_CACHE_HOME/python-ping,
+	or ~/.cache/python-ping.
+	:return:   The path of the file.
+	"""
+
+	base = os.environ.get( "XDG_CACHE_HOME" ) or os.path.join( os.path.expanduser( "~" ),
+	 ".cache" )
+	return os.path.join( base, "python-ping", "hosts.json" )
+
+def _readCache( path ):
+	"""
+	This function reads the cache kept in a file.
+	:param path:   The file.
+	:return:       A dictionary of name -> ( address or None, expiry ), which
+	               is empty if the file cannot be read or is not a cache.
+	"""
+
+	try:
+		with open( path ) as stream:
+			entries = json.load( stream )
+		return { str( name ): ( address, float( expires ) )
+		 for (name, (address, expires)) in entries.items() }
+	except ( OSError, ValueError, TypeError, AttributeError ):
+		return dict()
+
+def _literal( name ):
+	"""
+	This function recognizes a name that is an IPv4 address already.
+	:param name:   The name.
+	:return:       The address, or None if the name is not one.
+	"""
+
+	try:
+		socket.inet_pton( socket.AF_INET, name )
+	except ( OSError, ValueError ):
+		return None
+	return name
@@ -0,0 +1,544 @@
+"""
+Round trip time statistics that are kept up to date as replies arrive,
+in constant memory however long ping runs for.
+"""
+
+import bisect
+import math
+import struct
+from array import array
+
+class Accumulator:
+	"""
+	This class accumulates round trip times one at a time. The running
+	mean and sum of squared deviations are updated with Welford's method,
+	so the summary costs the same after ten replies as after ten million,
+	and no reply needs to be kept.
+	"""
+
+	# Layout of the counters of a serialized accumulator, followed by
+	# whether a histogram rather than buckets comes next
+	_STATE = struct.Struct( "<Qddddd?" )
+
+	def __init__( self, histogram=True ):
+		"""
+		This function creates an empty accumulator.
+		:param histogram:   If false, coarse Buckets are kept in place of
+		                    the histogram, so percentiles are not known
+		                    but the accumulator takes a few hundred bytes
+		                    rather than some sixteen kilobytes.
+		"""
+
+		# Number of round trip times seen
+		self.count = 0
+
+		# Running mean, and sum of squared deviations from it
+		self.mean = 0.0
+		self.m2 = 0.0
+
+		# Smallest and largest round trip times seen
+		self.minimum = math.inf
+		self.maximum = -math.inf
+
+		# Exponentially weighted moving average, as reported by iputils
+		self.ewma = 0.0
+
+		# Distribution of the round trip times, for percentiles, or
+		# failing that a coarse one
+		self.histogram = Histogram() if histogram else None
+		self.buckets = None if histogram else Buckets()
+
+	def add( self, rtt ):
+		"""
+		This function adds one round trip time to the accumulator.
+		:param rtt:   The round trip time, in milliseconds.
+		:return:      None
+		"""
+
+		self.count += 1
+		if( self.histogram is not None ):
+			self.histogram.record( rtt )
+		else:
+			self.buckets.record( rtt )
+
+		# Welford's update of the mean and squared deviations
+		delta = rtt - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * ( rtt - self.mean )
+
+		if( rtt < self.minimum ):
+			self.minimum = rtt
+		if( rtt > self.maximum ):
+			self.maximum = rtt
+
+		# The first reply seeds the moving average
+		if( self.count == 1 ):
+			self.ewma = rtt
+		else:
+			self.ewma += ( rtt - self.ewma ) / 8
+
+	def merge( self, other ):
+		"""
+		This function adds every round trip time seen by another
+		accumulator to this one, using Chan's parallel form of
+		Welford's method.
+		:param other:   The accumulator to merge into this one.
+		:return:        None
+		"""
+
+		if( other.count == 0 ):
+			return
+		if( self.count == 0 ):
+			self.ewma = other.ewma
+
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.m2 += other.m2 + delta * delta * self.count * other.count / count
+		self.mean += delta * other.count / count
+		self.count = count
+
+		self.minimum = min( self.minimum, other.minimum )
+		self.maximum = max( self.maximum, other.maximum )
+		if( self.histogram is not None and other.histogram is not None ):
+			self.histogram.merge( other.histogram )
+		if( self.buckets is not None and other.buckets is not None ):
+			self.buckets.merge( other.buckets )
+
+	def mdev( self ):
+		"""
+		This function computes the mean deviation of the round trip
+		times, as iputils does: the square root of the mean squared
+		deviation from the average.
+		:return:   The mean deviation, or zero if nothing was added.
+		"""
+
+		if( self.count == 0 ):
+			return 0.0
+		return math.sqrt( self.m2 / self.count )
+
+	def toBytes( self ):
+		"""
+		This function serializes the accumulator compactly, so that it
+		can be merged in another process.
+		:return:   The serialized accumulator.
+		"""
+
+		distribution = self.histogram if self.histogram is not None else self.buckets
+		return ( self._STATE.pack( self.count, self.mean, self.m2, self.minimum,
+		 self.maximum, self.ewma, self.histogram is not None ) + distribution.toBytes() )
+
+	@classmethod
+	def fromBytes( cls, data ):
+		"""
+		This function rebuilds an accumulator serialized by toBytes.
+		:param data:   The serialized accumulator.
+		:return:       The accumulator.
+		"""
+
+		(count, mean, m2, minimum, maximum, ewma, histogram) = cls._STATE.unpack_from( data )
+		accumulator = cls( histogram )
+		(accumulator.count, accumulator.mean, accumulator.m2) = (count, mean, m2)
+		(accumulator.minimum, accumulator.maximum, accumulator.ewma) = (minimum, maximum, ewma)
+
+		rest = data[ cls._STATE.size : ]
+		if( histogram ):
+			accumulator.histogram = Histogram.fromBytes( rest )
+		else:
+			accumulator.buckets = Buckets.fromBytes( rest )
+		return accumulator
+
+class Rolling:
+	"""
+	This class keeps the statistics of the last few probes of one hop,
+	as mtr shows them: the share lost, the last, mean, best and worst
+	round trip times, their standard deviation, and a Histogram of them
+	for percentiles. Every probe added pushes the oldest one out, so the
+	memory kept and the cost of adding a probe are fixed however long
+	the hop is probed for.
+	"""
+
+	def __init__( self, size=100 ):
+		"""
+		This function creates an empty window.
+		:param size:   The number of probes kept.
+		"""
+
+		self.size = size
+
+		# The round trip time of every probe kept, NaN for one lost, and
+		# the slot of the next probe, which holds the oldest
+		self._rtts = array( "d", [ math.nan ] ) * size
+		self._next = 0
+
+		# The number of probes kept, and of those answered
+		self.sent = 0
+		self.count = 0
+
+		# The last round trip time, or None if no probe was answered yet
+		self.last = None
+
+		# Sum and sum of squares of the round trip times kept
+		self._sum = 0.0
+		self._squares = 0.0
+
+		self.histogram = Histogram()
+
+	def add( self, rtt ):
+		"""
+		This function adds one probe, forgetting the oldest if the window
+		is full.
+		:param rtt:   The round trip time, in milliseconds, or None if
+		              the probe was lost.
+		:return:      None
+		"""
+
+		old = self._rtts[ self._next ]
+		if( self.sent == self.size ):
+			if( not math.isnan( old ) ):
+				self.count -= 1
+				self._sum -= old
+				self._squares -= old * old
+				self.histogram.record( old, -1 )
+		else:
+			self.sent += 1
+
+		if( rtt is None ):
+			self._rtts[ self._next ] = math.nan
+		else:
+			self._rtts[ self._next ] = rtt
+			self.count += 1
+			self._sum += rtt
+			self._squares += rtt * rtt
+			self.histogram.record( rtt )
+			self.last = rtt
+		self._next = ( self._next + 1 ) % self.size
+
+		# The sums are worked out afresh once per pass over the window, so
+		# the rounding of what is taken away does not build up
+		if( self._next == 0 ):
+			answered = [ value for value in self._rtts if not math.isnan( value ) ]
+			self._sum = math.fsum( answered )
+			self._squares = math.fsum( value * value for value in answered )
+
+	def loss( self ):
+		"""
+		This function computes the share of the probes kept that were lost.
+		:return:   The share, as a percentage, or zero if none are kept.
+		"""
+
+		if( self.sent == 0 ):
+			return 0.0
+		return 100 - self.count / self.sent * 100
+
+	def mean( self ):
+		"""
+		This function computes the mean round trip time of the probes kept.
+		:return:   The mean, or None if none was answered.
+		"""
+
+		if( self.count == 0 ):
+			return None
+		return self._sum / self.count
+
+	def stdev( self ):
+		"""
+		This function computes the standard deviation of the round trip
+		times of the probes kept.
+		:return:   The standard deviation, or None if none was answered.
+		"""
+
+		if( self.count == 0 ):
+			return None
+		mean = self._sum / self.count
+		return math.sqrt( max( self._squares / self.count - mean * mean, 0.0 ) )
+
+	def best( self ):
+		"""
+		This function finds the shortest round trip time of the probes kept.
+		:return:   The time, or None if none was answered.
+		"""
+
+		if( self.count == 0 ):
+			return None
+		return min( value for value in self._rtts if not math.isnan( value ) )
+
+	def worst( self ):
+		"""
+		This function finds the longest round trip time of the probes kept.
+		:return:   The time, or None if none was answered.
+		"""
+
+		if( self.count == 0 ):
+			return None
+		return max( value for value in self._rtts if not math.isnan( value ) )
+
+	def rtts( self ):
+		"""
+		This function lists the probes kept.
+		:return:   A list of the round trip time of every probe kept,
+		           oldest first, with None for a probe that was lost.
+		"""
+
+		order = list( self._rtts[ self._next : ] ) + list( self._rtts[ : self._next ] )
+		return [ None if math.isnan( value ) else value
+		 for value in order[ len( order ) - self.sent : ] ]
+
+class Histogram:
+	"""
+	This class counts round trip times in logarithmic buckets, in the
+	manner of an HDR histogram. Times below SUB_COUNT microseconds each
+	get their own bucket. Above that, every power of two is split into
+	SUB_COUNT / 2 buckets, so any time is known to within about one
+	percent. The number of buckets is fixed however many times are
+	recorded, and two histograms are merged by adding their buckets.
+	"""
+
+	# Bits of precision kept within each power of two
+	SUB_BITS = 7
+	SUB_COUNT = 1 << SUB_BITS
+	HALF_COUNT = SUB_COUNT >> 1
+
+	# The largest time tracked, in microseconds (about 19 hours).
+	# Anything longer is counted as this long.
+	MAX_BITS = 36
+	MAX_VALUE = ( 1 << MAX_BITS ) - 1
+
+	# Total number of buckets
+	BUCKETS = ( MAX_BITS - SUB_BITS + 2 ) * HALF_COUNT
+
+	# Layout of the header of a serialized histogram
+	_HEADER = struct.Struct( "<BI" )
+
+	def __init__( self ):
+		"""
+		This function creates an empty histogram.
+		"""
+
+		# The number of times counted in each bucket
+		self.counts = array( "Q", [0] ) * self.BUCKETS
+
+		# The number of times recorded
+		self.total = 0
+
+	def record( self, rtt, times=1 ):
+		"""
+		This function counts a round trip time.
+		:param rtt:     The round trip time, in milliseconds.
+		:param times:   How many times to count it. One by default, and
+		                negative to take back times counted before.
+		:return:        None
+		"""
+
+		value = min( max( int( rtt * 1000 ), 0 ), self.MAX_VALUE )
+		self.counts[ self._index( value ) ] += times
+		self.total += times
+
+	def _index( self, value ):
+		"""
+		This function finds the bucket a time belongs in.
+		:param value:   The time, in whole microseconds.
+		:return:        The index of its bucket.
+		"""
+
+		# Small times are counted exactly
+		if( value < self.SUB_COUNT ):
+			return value
+
+		# Otherwise keep the top SUB_BITS bits of the time
+		shift = value.bit_length() - self.SUB_BITS
+		return shift * self.HALF_COUNT + ( value >> shift )
+
+	def _value( self, index ):
+		"""
+		This function finds the time in the middle of a bucket. A time
+		is counted in the bucket of its whole microseconds, so the bucket
+		of an exact microsecond runs up to the next one.
+		:param index:   The index of the bucket.
+		:return:        The time, in milliseconds.
+		"""
+
+		if( index < self.SUB_COUNT ):
+			return ( index + 0.5 ) / 1000
+
+		shift = index // self.HALF_COUNT - 1
+		sub = index - shift * self.HALF_COUNT
+		low = sub << shift
+		return ( low + ( 1 << shift ) / 2 ) / 1000
+
+	def percentiles( self, wanted, minimum=-math.inf, maximum=math.inf ):
+		"""
+		This function finds several percentiles of the recorded times
+		in one pass over the buckets.
+		:param wanted:    The percentiles to find, in increasing order,
+		                  such as [ 50, 90, 99, 99.9 ].
+		:param minimum:   The shortest time recorded, if it is known. The
+		                  middle of its bucket may be shorter still, and no
+		                  percentile is reported below it.
+		:param maximum:   The longest time recorded, if it is known, above
+		                  which no percentile is reported.
+		:return:          A list of the times at those percentiles, in
+		                  milliseconds. Empty if nothing was recorded.
+		"""
+
+		if( self.total == 0 ):
+			return list()
+
+		# The number of times at or below each percentile
+		ranks = [ max( 1, math.ceil( self.total * p / 100 ) ) for p in wanted ]
+
+		found = list()
+		seen = 0
+		for index in range( self.BUCKETS ):
+			seen += self.counts[index]
+			while( len( found ) < len( ranks ) and seen >= ranks[ len( found ) ] ):
+				found.append( min( max( self._value( index ), minimum ), maximum ) )
+			if( len( found ) == len( ranks ) ):
+				break
+		return found
+
+	def cumulative( self, bounds ):
+		"""
+		This function counts the recorded times at or below each of
+		several bounds, as a Prometheus histogram reports them. A time is
+		taken to be the middle of its bucket.
+		:param bounds:   The bounds, in milliseconds, in increasing order.
+		:return:         A list of the number of times at or below each.
+		"""
+
+		# The number of times between each bound and the one below it
+		counts = [ 0 ] * ( len( bounds ) + 1 )
+		for (index, count) in enumerate( self.counts ):
+			if( count ):
+				counts[ bisect.bisect_left( bounds, self._value( index ) ) ] += count
+
+		# Each bound also counts everything below it
+		found = list()
+		seen = 0
+		for count in counts[ : len( bounds ) ]:
+			seen += count
+			found.append( seen )
+		return found
+
+	def merge( self, other ):
+		"""
+		This function adds the counts of another histogram to this one.
+		:param other:   The histogram to merge into this one.
+		:return:        None
+		"""
+
+		counts = self.counts
+		for (index, count) in enumerate( other.counts ):
+			if( count ):
+				counts[index] += count
+		self.total += other.total
+
+	def toBytes( self ):
+		"""
+		This function serializes the histogram compactly, keeping only
+		the buckets that are not empty, so that it can be merged in
+		another process.
+		:return:   The serialized histogram.
+		"""
+
+		indexes = [ index for (index, count) in enumerate( self.counts ) if count ]
+		counts = [ self.counts[index] for index in indexes ]
+		return ( self._HEADER.pack( self.SUB_BITS, len( indexes ) ) +
+		 struct.pack( "<" + str( len( indexes ) ) + "H", *indexes ) +
+		 struct.pack( "<" + str( len( counts ) ) + "Q", *counts ) )
+
+	@classmethod
+	def fromBytes( cls, data ):
+		"""
+		This function rebuilds a histogram serialized by toBytes.
+		:param data:   The serialized histogram.
+		:return:       The histogram.
+		"""
+
+		(subBits, entries) = cls._HEADER.unpack_from( data )
+		if( subBits != cls.SUB_BITS ):
+			raise ValueError( "histogram precision does not match" )
+
+		offset = cls._HEADER.size
+		indexes = struct.unpack_from( "<" + str( entries ) + "H", data, offset )
+		offset += 2 * entries
+		counts = struct.unpack_from( "<" + str( entries ) + "Q", data, offset )
+
+		histogram = cls()
+		for (index, count) in zip( indexes, counts ):
+			histogram.counts[index] = count
+			histogram.total += count
+		return histogram
+
+class Buckets:
+	"""
+	This class counts round trip times below a fixed set of bounds, as
+	a Prometheus histogram does. It is far coarser than a Histogram, but
+	takes a hundred or so bytes, so it suits keeping the distribution of
+	each of many thousands of destinations.
+	"""
+
+	# The upper bound of each bucket, in milliseconds. Anything above the
+	# last is counted in a bucket of its own.
+	BOUNDS = ( 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000 )
+
+	def __init__( self ):
+		"""
+		This function creates empty buckets.
+		"""
+
+		# The number of times counted in each bucket
+		self.counts = array( "Q", [0] ) * ( len( self.BOUNDS ) + 1 )
+
+	def record( self, rtt ):
+		"""
+		This function counts a round trip time.
+		:param rtt:   The round trip time, in milliseconds.
+		:return:      None
+		"""
+
+		self.counts[ bisect.bisect_left( self.BOUNDS, rtt ) ] += 1
+
+	def cumulative( self ):
+		"""
+		This function counts the recorded times at or below each bound.
+		:return:   A list of the number of times at or below each of BOUNDS.
+		"""
+
+		found = list()
+		seen = 0
+		for count in self.counts[ : len( self.BOUNDS ) ]:
+			seen += count
+			found.append( seen )
+		return found
+
+	def merge( self, other ):
+		"""
+		This function adds the counts of other buckets to these.
+		:param other:   The buckets to merge into these.
+		:return:        None
+		"""
+
+		for (index, count) in enumerate( other.counts ):
+			self.counts[index] += count
+
+	def toBytes( self ):
+		"""
+		This function serializes the buckets, so that they can be merged
+		in another process.
+		:return:   The serialized buckets.
+		"""
+
+		return struct.pack( "<" + str( len( self.counts ) ) + "Q", *self.counts )
+
+	@classmethod
+	def fromBytes( cls, data ):
+		"""
+		This function rebuilds buckets serialized by toBytes.
+		:param data:   The serialized buckets.
+		:return:       The buckets.
+		"""
+
+		buckets = cls()
+		buckets.counts = array( "Q",
+		 struct.unpack_from( "<" + str( len( buckets.counts ) ) + "Q", data ) )
+		return buckets
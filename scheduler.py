@@ -0,0 +1,160 @@
+"""
+Scheduling of probes to many destinations that are pinged continuously,
+each at its own interval. Every destination keeps to a grid of send
+times whose phase within the interval is taken from a hash of its key,
+so that sends to thousands of destinations are spread evenly across
+each interval rather than bunched at its start, and a destination keeps
+its place on the grid when the list of destinations is reloaded.
+"""
+
+import heapq
+import math
+import zlib
+
+class Scheduler:
+	"""
+	This class keeps the time at which each destination is next due in
+	a heap, so that finding the destinations that are due costs a few
+	comparisons however many there are. A destination that is removed,
+	or whose interval changes, is left in the heap and skipped when it
+	reaches the top, so changing the list never rebuilds the heap.
+	"""
+
+	def __init__( self, start ):
+		"""
+		This function creates an empty scheduler.
+		:param start:   The time the grids of send times start from, by
+		                time.perf_counter().
+		"""
+
+		self.start = start
+
+		# ( due, serial, key ) of every scheduled send, soonest first.
+		# The serial breaks ties and tells stale entries apart.
+		self._heap = list()
+
+		# key -> [ interval, item, serial ] of every destination
+		self._entries = dict()
+		self._serial = 0
+
+	def __len__( self ):
+		"""
+		This function counts the destinations scheduled.
+		:return:   The number of destinations.
+		"""
+
+		return len( self._entries )
+
+	def __contains__( self, key ):
+		"""
+		This function checks whether a destination is scheduled.
+		:param key:   The key of the destination.
+		:return:      True if it is scheduled. False otherwise.
+		"""
+
+		return key in self._entries
+
+	def keys( self ):
+		"""
+		This function lists the destinations scheduled.
+		:return:   A list of their keys.
+		"""
+
+		return list( self._entries )
+
+	def add( self, key, interval, item, now ):
+		"""
+		This function schedules a destination, or changes the interval
+		of one that is scheduled already. Its first send is the first
+		point of its grid still to come.
+		:param key:        The key of the destination, a string such as
+		                   its address.
+		:param interval:   The number of seconds between its sends.
+		:param item:       What due returns when the destination is due.
+		:param now:        The current time, by time.perf_counter().
+		:return:           None
+		"""
+
+		# A destination whose interval is unchanged keeps its next send
+		entry = self._entries.get( key )
+		if( entry is not None and entry[0] == interval ):
+			entry[1] = item
+			return
+
+		self._serial += 1
+		self._entries[key] = [ interval, item, self._serial ]
+
+		# Where in its interval the destination is sent to
+		phase = zlib.crc32( key.encode() ) / 0x100000000 * interval
+		due = self._following( self.start + phase, interval, now )
+		heapq.heappush( self._heap, ( due, self._serial, key ) )
+
+	def remove( self, key ):
+		"""
+		This function stops sending to a destination.
+		:param key:   The key of the destination.
+		:return:      Its item, or None if it was not scheduled.
+		"""
+
+		entry = self._entries.pop( key, None )
+		if( entry is None ):
+			return None
+		return entry[1]
+
+	def due( self, now ):
+		"""
+		This function finds the destinations whose sends are due, and
+		schedules the next send of each one interval later. A send that
+		is more than a whole interval behind skips the sends it missed
+		rather than making them up in a burst.
+		:param now:   The current time, by time.perf_counter().
+		:return:      A list of the item of each destination due, and how
+		              many seconds late its send is.
+		"""
+
+		heap = self._heap
+		entries = self._entries
+		ready = list()
+		while( len( heap ) > 0 and heap[0][0] <= now ):
+			(due, serial, key) = heap[0]
+
+			# Skip destinations that were removed or rescheduled
+			entry = entries.get( key )
+			if( entry is None or entry[2] != serial ):
+				heapq.heappop( heap )
+				continue
+
+			ready.append( ( entry[1], now - due ) )
+			heapq.heapreplace( heap,
+			 ( self._following( due + entry[0], entry[0], now ), serial, key ) )
+		return ready
+
+	def nextDue( self ):
+		"""
+		This function finds when the next send is due.
+		:return:   That time, by time.perf_counter(), or None if no
+		           destination is scheduled.
+		"""
+
+		heap = self._heap
+		while( len( heap ) > 0 ):
+			(due, serial, key) = heap[0]
+			entry = self._entries.get( key )
+			if( entry is not None and entry[2] == serial ):
+				return due
+			heapq.heappop( heap )
+		return None
+
+	def _following( self, due, interval, now ):
+		"""
+		This function finds the first point of a grid of send times that
+		is after the current time.
+		:param due:        A point of the grid.
+		:param interval:   The spacing of the grid, in seconds.
+		:param now:        The current time, by time.perf_counter().
+		:return:           The point, by time.perf_counter().
+		"""
+
+		if( due > now ):
+			return due
+		return due + ( math.floor( ( now - due ) / interval ) + 1 ) * interval
@@ -0,0 +1,126 @@
+"""
+Spreading probes over several worker processes, so that the parsing and
+bookkeeping of many destinations is not held to one core. Each worker is
+forked with its share of the destinations and a range of ICMP
+identifiers no other worker uses, opens its own socket, and
+sends its results back to the parent through a pipe as they are ready.
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import transport
+
+def split( items, count ):
+	"""
+	This function deals items out to a number of shards in turn, so
+	that every shard gets a like share however the items are ordered.
+	:param items:   The items.
+	:param count:   The number of shards wanted.
+	:return:        A list of the shards, each a list of items. There are
+	                no more shards than items.
+	"""
+
+	return [ items[k::count] for k in range( min( count, len( items ) ) ) ]
+
+def run( shards, work, handle, identifiers=None ):
+	"""
+	This function runs work on every shard, each in a process of its
+	own, and hands every result the workers send to handle as it arrives.
+	Ctrl+C stops the workers, which still send what they have; this
+	process carries on until every worker has finished.
+	:param shards:        The shards, from split.
+	:param work:          A function of the number of a shard, the shard,
+	                      the first of its ICMP identifiers and a function
+	                      that sends a result to this process. It is run
+	                      in the worker. Results are pickled, so compact
+	                      bytes are cheapest.
+	:param handle:        A function of the number of a shard and a result,
+	                      run in this process.
+	:param identifiers:   A function of a shard that gives the number of
+	                      ICMP identifiers its worker needs, or None if
+	                      they need none, and work is given None instead.
+	:return:              A list of the exit code of every worker.
+	:raises ValueError:   If there are not enough identifiers free.
+	"""
+
+	context = multiprocessing.get_context( "fork" )
+
+	# Every worker's identifiers are handed out here before any is
+	# forked, so that no two workers share one, and are taken back
+	# once all have finished
+	firsts = [ None ] * len( shards )
+	try:
+		if( identifiers is not None ):
+			for (number, shard) in enumerate( shards ):
+				firsts[number] = transport.identifier( identifiers( shard ) )
+		return _run( context, shards, firsts, work, handle )
+	finally:
+		for first in firsts:
+			if( first is not None ):
+				transport.release( first )
+
+def _run( context, shards, firsts, work, handle ):
+	"""
+	This function forks the workers for run, and waits for them.
+	:param context:   The multiprocessing context the workers are forked by.
+	:param shards:    The shards.
+	:param firsts:    The first ICMP identifier of every shard, or None.
+	:param work:      The work, as given to run.
+	:param handle:    The function results are handed to, as given to run.
+	:return:          A list of the exit code of every worker.
+	"""
+
+	# Output held by this process must not be written again by the workers
+	sys.stdout.flush()
+	sys.stderr.flush()
+
+	pipes = dict()
+	workers = list()
+	for (number, shard) in enumerate( shards ):
+		(receive, send) = context.Pipe( duplex=False )
+		worker = context.Process( target=_worker,
+		 args=( work, number, shard, firsts[number], send ), daemon=True )
+		worker.start()
+		send.close()
+		pipes[receive] = number
+		workers.append( worker )
+
+	# Ctrl+C reaches the workers too, and they are left to finish
+	previous = signal.signal( signal.SIGINT, signal.SIG_IGN )
+	try:
+		while( len( pipes ) > 0 ):
+			for receive in multiprocessing.connection.wait( list( pipes ) ):
+				try:
+					result = receive.recv()
+				except EOFError:
+					del pipes[receive]
+					receive.close()
+					continue
+				handle( pipes[receive], result )
+	finally:
+		for worker in workers:
+			worker.join()
+		signal.signal( signal.SIGINT, previous )
+
+	return [ worker.exitcode for worker in workers ]
+
+def _worker( work, number, shard, first, send ):
+	"""
+	This function runs in a worker process, and closes its end of the
+	pipe once its work is done, which tells the parent it has finished.
+	:param work:     The work, as given to run.
+	:param number:   The number of the shard.
+	:param shard:    The shard.
+	:param first:    The first of the shard's ICMP identifiers, or None.
+	:param send:     The worker's end of the pipe.
+	:return:         None
+	"""
+
+	try:
+		work( number, shard, first, send.send )
+	except KeyboardInterrupt:
+		pass
+	finally:
+		send.close()
@@ -3,272 +3,734 @@ __author__ = Kyle McGlynn 11/12/2017
 """
 
 import socket
+import icmp
+import resolver
+import probe
+import transport
+import output
+import exporter
+import shard
+import netsim
 import sys
 import time
 import math
+import selectors
+import bisect
+import rttstats
 
-def _traceroute( destination, n, q, s ):
+# The number of answered or lost probes a Tracer remembers
+_MEMORY = 1024
+
+class Tracer:
+	"""
+	This class traces the route to destinations for programs that use
+	traceroute as a library. Its socket, and the resolver's cache of
+	names, are kept from one trace to the next, so tracing many
+	destinations costs no more than the probes themselves. Each trace
+	is a generator of the hops of the route, as output.Hop records.
+
+	Every probe carries a sequence number of its own, and an answer is
+	matched to the probe it is about: an echo reply by its sequence
+	number, and a Time Exceeded or Destination Unreachable error by the
+	echo request it quotes. Up to a window of probes, for increasing
+	ttls, are outstanding at once, so a whole trace takes about one
+	round trip to the farthest hop plus the timeout, rather than the
+	timeout of every silent hop in turn. An answer that arrives after
+	its probe timed out is recognized as late and ignored.
+	"""
+
+	def __init__( self, probes=3, hops=30, timeout=1, names=None, window=1, pause=0,
+	 ident=None ):
+		"""
+		This function opens the socket, a raw socket if the process may
+		open one and otherwise an ICMP datagram socket that is told of
+		Time Exceeded errors.
+		:param probes:    The number of probes sent to each hop.
+		:param hops:      The largest number of hops to trace.
+		:param timeout:   The number of seconds to wait for each probe.
+		:param names:     A resolver.ReverseResolver used to name the hops,
+		                  or None to leave them unnamed.
+		:param window:    The largest number of probes outstanding at once.
+		                  One probes the hops one probe at a time.
+		:param pause:     The least number of seconds between two probes,
+		                  to stay under the rate at which routers send
+		                  ICMP errors.
+		:param ident:     The ICMP identifier of the probes, from
+		                  transport.identifier, which the caller gives
+		                  back, or None to be handed one of the tracer's
+		                  own that close gives back.
+		:raises PermissionError:   If neither kind of socket is allowed.
+		"""
+
+		self.probes = probes
+		self.hops = hops
+		self.names = names
+		self.window = window
+		self.pause = pause
+
+		# Probes are waited for by the table rather than by the socket
+		self._socket = transport.openSocket( errors=True )
+		self._socket.setblocking( False )
+		self._selector = selectors.DefaultSelector()
+		self._selector.register( self._socket, selectors.EVENT_READ )
+		self._datagram = transport.isDatagram( self._socket )
+
+		# Answers are only taken for probes still outstanding, so few
+		# finished probes need to be remembered, however long it runs
+		self._table = probe.InFlight( timeout, _MEMORY )
+		self._ring = transport.BufferRing()
+
+		# Have the kernel stamp when each reply arrives
+		transport.enableTimestamps( self._socket )
+
+		# Probes have an identifier no other tracer or pinger uses, and
+		# the kernel drops the replies and errors meant for the others
+		self._owned = ident is None
+		self.ident = transport.identifier() if ident is None else ident
+		transport.attachFilter( self._socket, self.ident, self.ident )
+
+		# The sequence number of the last probe sent, and the ttl the
+		# socket is set to
+		self._sequence = 0
+		self._ttl = None
+
+		# The number of probes sent
+		self.sent = 0
+
+	def __enter__( self ):
+		"""
+		This function lets the tracer be used in a with statement.
+		:return:   The tracer.
+		"""
+
+		return self
+
+	def __exit__( self, kind, value, traceback ):
+		"""
+		This function closes the tracer at the end of a with statement.
+		:return:   None
+		"""
+
+		self.close()
+
+	def close( self ):
+		"""
+		This function closes the socket, and gives back its identifier
+		if it is the tracer's own.
+		:return:   None
+		"""
+
+		if( self._socket.fileno() < 0 ):
+			return
+		self._selector.close()
+		self._socket.close()
+		if( self._owned ):
+			transport.release( self.ident )
+
+	def trace( self, destination ):
+		"""
+		This function sends probes with an increasing ttl until the
+		destination answers or the largest number of hops is reached.
+		:param destination:   The destination, either an IPv4 address or
+		                      web URL.
+		:return:              A generator of the output.Hop of every hop,
+		                      in order, as each is traced.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		destIPv4 = socket.gethostbyname( destination )
+		yield from self.probe( destIPv4, range( 1, self.hops + 1 ) )
+
+	def probe( self, destIPv4, ttls, window=None ):
+		"""
+		This function probes the hops with the given ttls, in the order
+		given, leaving out those beyond the destination once it has
+		answered. Closing the generator early abandons the probes still
+		outstanding, whose answers are then ignored.
+		:param destIPv4:   The IPv4 address of the destination.
+		:param ttls:       The ttls to probe, with no ttl twice.
+		:param window:     The largest number of probes outstanding at
+		                   once, if not the tracer's.
+		:return:           A generator of the output.Hop of every hop, in
+		                   the order of the ttls, as each is probed.
+		"""
+
+		ttls = list( ttls )
+		if( window is None ):
+			window = self.window
+
+		# The state of the trace: for every hop, the rtt of each probe
+		# and the last router that answered, and for every outstanding
+		# probe, by sequence number, its hop and position
+		trace = { "destination": destIPv4, "rtts": dict(), "senders": dict(),
+		 "owners": dict(), "last": self.hops }
+
+		# The index of the hop of the next probe to send and its
+		# position, the index of the hop to yield next, and when the
+		# next probe may be sent
+		(index, position) = ( 0, 0 )
+		shown = 0
+		nextSend = 0
+
+		while( shown < len( ttls ) ):
+
+			# Send probes while the window has room, leaving out the hops
+			# beyond the destination once it has answered
+			now = time.perf_counter()
+			while( index < len( ttls ) and len( trace["owners"] ) < window and
+			 now >= nextSend ):
+				if( ttls[index] > trace["last"] ):
+					(index, position) = ( index + 1, 0 )
+					continue
+				self._send( trace, ttls[index], position )
+				nextSend = now + self.pause
+				position += 1
+				if( position == self.probes ):
+					(index, position) = ( index + 1, 0 )
+				if( self.pause > 0 ):
+					break
+
+			# Yield every hop, in order, whose probes have all been
+			# answered or lost
+			while( shown < index ):
+				hop = ttls[shown]
+				if( hop <= trace["last"] ):
+					if( any( owner[0] == hop for owner in trace["owners"].values() ) ):
+						break
+					rtts = trace["rtts"].pop( hop )
+					yield _hop( hop, trace["senders"].pop( hop, "" ), rtts, self.names )
+				shown += 1
+			while( shown < len( ttls ) and ttls[shown] > trace["last"] ):
+				shown += 1
+			if( shown == len( ttls ) ):
+				break
+
+			# Sleep until an answer arrives, a probe times out or the next
+			# probe may be sent
+			wake = [ self._table.nextDeadline() ]
+			if( index < len( ttls ) and len( trace["owners"] ) < window ):
+				wake.append( nextSend )
+			wake = [ moment for moment in wake if moment is not None ]
+			timeout = None
+			if( len( wake ) > 0 ):
+				timeout = max( min( wake ) - time.perf_counter(), 0 )
+			if( len( self._selector.select( timeout ) ) > 0 ):
+				self._ring.drain( self._socket,
+				 lambda packet, nbytes, address, received:
+				 self._answer( trace, packet, nbytes, address, received ) )
+
+			# Probes whose time is up are lost
+			for (key, seq) in self._table.expire( time.perf_counter() ):
+				trace["owners"].pop( seq, None )
+
+	def doubletree( self, destination, stops ):
+		"""
+		This function traces the route to a destination as Doubletree
+		does, for tracing many destinations from the same place. Probing
+		starts part way along the route, at the ttl the stop set chooses,
+		and goes forward from there until the destination answers. If
+		none of those hops is known to the stop set, it then goes
+		backward, one hop at a time, until it reaches one that is. The
+		hops before the first hop known are copied from the route that
+		found it, with the round trip times measured then. The route is
+		then added to the stop set.
+		:param destination:   The destination, either an IPv4 address or
+		                      web URL.
+		:param stops:         The StopSet shared by the traces.
+		:return:              A list of the output.Hop of every hop, in order.
+		:raises socket.gaierror:   If the destination cannot be resolved.
+		"""
+
+		destIPv4 = socket.gethostbyname( destination )
+		start = min( stops.start(), self.hops )
+
+		# Forward, until the destination answers
+		forward = list( self.probe( destIPv4, range( start, self.hops + 1 ) ) )
+		known = _known( stops, forward )
+
+		# Backward, until a hop that is already known
+		backward = list()
+		if( known is None ):
+			hops = self.probe( destIPv4, range( start - 1, 0, -1 ), self.probes )
+			for hop in hops:
+				backward.append( hop )
+				known = _known( stops, [ hop ] )
+				if( known is not None ):
+					break
+			hops.close()
+
+		# The hops before those probed
+		first = forward[0].hop if len( backward ) == 0 else backward[-1].hop
+		prefix = list()
+		if( known is not None ):
+			prefix = [ hop for hop in known if hop.hop < first ]
+
+		# The destination may be nearer than the hop probing started at
+		route = prefix + backward[::-1] + forward
+		for (k, hop) in enumerate( route ):
+			if( hop.address == destIPv4 ):
+				route = route[:k+1]
+				break
+
+		stops.add( route )
+		return route
+
+	def _send( self, trace, ttl, position ):
+		"""
+		This function sends one probe, with a sequence number of its own.
+		:param trace:      The state of the trace.
+		:param ttl:        The ttl of the probe, which is its hop.
+		:param position:   The position of the probe among those of its hop.
+		:return:           None
+		"""
+
+		if( ttl != self._ttl ):
+			self._socket.setsockopt( socket.SOL_IP, socket.IP_TTL, ttl )
+			self._ttl = ttl
+		if( position == 0 ):
+			trace["rtts"][ttl] = [ None ] * self.probes
+
+		seq = self._sequence = ( self._sequence + 1 ) & 0xffff
+		packet = icmp.echoRequest( 32, seq, self.ident )
+		sent = probe.stamp()
+		transport.send( self._socket, packet, trace["destination"] )
+		self._table.add( 0, seq, sent )
+		trace["owners"][seq] = ( ttl, position )
+		self.sent += 1
+
+	def _answer( self, trace, packet, nbytes, address, received ):
+		"""
+		This function matches one packet to the probe it answers, and
+		ends the route at the hop of a probe the destination answered.
+		:param trace:      The state of the trace.
+		:param packet:     A memoryview of the packet.
+		:param nbytes:     The length of the packet.
+		:param address:    The address of the sender.
+		:param received:   When the packet arrived, as taken by probe.elapsed.
+		:return:           None
+		"""
+
+		reply = icmp.parseReply( packet, nbytes )
+		if( reply is None ):
+			return
+		(icmpType, code, ident, seq, ttl, size) = reply
+		sender = address[0]
+
+		# The address the probe answered was sent to
+		if( icmpType == icmp.ECHO_REPLY ):
+			destination = sender
+		elif( icmpType == icmp.TIME_EXCEEDED or icmpType == icmp.DEST_UNREACHABLE ):
+			quote = icmp.parseQuote( packet, nbytes )
+			if( quote is None ):
+				return
+			(destination, ident, seq) = quote
+		else:
+			return
+
+		# The kernel sets the identifier of a datagram socket's requests
+		if( not self._datagram and ident != self.ident ):
+			return
+		owner = trace["owners"].get( seq )
+		if( owner is None or destination != trace["destination"] ):
+			return
+
+		(status, rtt) = self._table.match( 0, seq, received )
+		if( status != probe.REPLY and status != probe.REORDERED ):
+			return
+		del trace["owners"][seq]
+
+		(hop, position) = owner
+		trace["rtts"][hop][position] = rtt
+		trace["senders"][hop] = sender
+
+		# Start looking up the hop's name
+		if( self.names is not None ):
+			self.names.lookup( sender )
+
+		# No hop lies beyond the destination
+		if( icmpType != icmp.TIME_EXCEEDED ):
+			trace["last"] = min( trace["last"], hop )
+
+class StopSet:
+	"""
+	This class keeps the hops already found by the traces from one
+	place, each by its address and ttl along with the route that led to
+	it, so that Tracer.doubletree can stop probing once a trace reaches
+	a hop that is already known. The routes from one place mostly share
+	their first hops, which are then only probed once.
+	"""
+
+	def __init__( self, chance=0.05 ):
+		"""
+		This function creates an empty stop set.
+		:param chance:   The largest share of destinations that the ttl
+		                 traces start at should reach, as they are then
+		                 probed beyond.
+		"""
+
+		self.chance = chance
+
+		# ( address, ttl ) -> the output.Hop of every hop of the route up
+		# to and including it
+		self._prefixes = dict()
+
+		# The length of every route added, sorted
+		self._lengths = list()
+
+	def __len__( self ):
+		"""
+		This function counts the hops known.
+		:return:   The number of ( address, ttl ) pairs known.
+		"""
+
+		return len( self._prefixes )
+
+	def add( self, hops ):
+		"""
+		This function adds every hop of a route that was answered and is
+		not known yet.
+		:param hops:   The output.Hop of every hop of the route, in order,
+		               from the first.
+		:return:       None
+		"""
+
+		hops = tuple( hops )
+		for (k, hop) in enumerate( hops ):
+			if( hop.address is not None ):
+				self._prefixes.setdefault( ( hop.address, hop.hop ), hops[:k+1] )
+		if( len( hops ) > 0 ):
+			bisect.insort( self._lengths, len( hops ) )
+
+	def prefix( self, address, ttl ):
+		"""
+		This function finds the route to a hop that is already known.
+		:param address:   The IPv4 address of the hop.
+		:param ttl:       The ttl it was found at.
+		:return:          A tuple of the output.Hop of every hop up to and
+		                  including it, or None if it is not known.
+		"""
+
+		return self._prefixes.get( ( address, ttl ) )
+
+	def start( self ):
+		"""
+		This function chooses the ttl traces start at: the one before the
+		length of route that only the chance share of the routes so far
+		are as short as, so that few probes reach the destination early.
+		:return:   The ttl, one while no route is known.
+		"""
+
+		if( len( self._lengths ) == 0 ):
+			return 1
+		length = self._lengths[ int( self.chance * ( len( self._lengths ) - 1 ) ) ]
+		return max( length - 1, 1 )
+
+def _known( stops, hops ):
+	"""
+	This function finds the first of some hops that a stop set knows.
+	:param stops:   The StopSet.
+	:param hops:    The output.Hop of the hops.
+	:return:        The route to the hop, from StopSet.prefix, or None if
+	                none of the hops is known.
+	"""
+	
+	for hop in hops:
+		if( hop.address is not None ):
+			known = stops.prefix( hop.address, hop.hop )
+			if( known is not None ):
+				return known
+	return None
+
+def _traceroute( destinations, n, q, N, z, D, sink, metrics ):
 	"""
-	This function opens a raw socket, sends ICMP echo requests, modifies
-	the ttl for every hop, and eventually either exceeds the maximum number
-	of hops or arrives at the target destination.
+	This function traces the route to each destination in turn with a
+	Tracer, which sends ICMP echo requests, modifies the ttl for every
+	hop, and eventually either exceeds the maximum number of hops or
+	arrives at the target destination.
+	:param destinations:   The destinations, either IPv4 addresses or web URLs.
+	:param n:              Print IPv4 addresses as numeric rather than numeric
+	                       and symbolic.
+	:param q:              The number of packets sent per ttl. Default value is 3.
+	:param N:              The number of probes outstanding at once.
+	:param z:              The least number of milliseconds between probes.
+	:param D:              Stop probing each route at the hops found by
+	                       the routes before it.
+	:param sink:           The output sink each hop is written to.
+	:param metrics:        An exporter.Exporter the routes are served through
+	                       as they are traced, or None.
+	:return:               None
+	"""
+	
+	tracer = _open( n, q, N, z )
+	stops = StopSet() if D else None
+	
+	# Look up the IPv4 address of every destination at once, so the later
+	# ones are known by the time their turn comes
+	lookups = _lookups( destinations )
+	
+	try:
+		for (position, destination) in enumerate( destinations ):
+			destIPv4 = lookups.wait( position )
+			if( destIPv4 is None ):
+				_report( sink, metrics, destination, None, list() )
+				continue
+			_report( sink, metrics, destination, destIPv4, _route( tracer, stops, destIPv4 ) )
+	except KeyboardInterrupt:
+		pass
+	lookups.save()
+	sink.close()
+	tracer.close()
+
+def _traceContinuous( destination, n, q, N, z, C, sink, metrics ):
+	"""
+	This function traces the route to one destination over and over, in
+	rounds that start every C seconds, as mtr does, until Ctrl+C. Each
+	hop keeps rolling statistics of its last probes, which are written
+	once a round, and the route is served with the same probes.
 	:param destination:   The destination, either an IPv4 address or web URL.
 	:param n:             Print IPv4 addresses as numeric rather than numeric
 	                      and symbolic.
-	:param q:             The number of packets sent per ttl. Default value is 3.
-	:param s:             Print a summary of how many packets were not answered
-	                      for each hop.
+	:param q:             The number of probes sent to each hop per round.
+	:param N:             The number of probes outstanding at once.
+	:param z:             The least number of milliseconds between probes.
+	:param C:             The number of seconds between the starts of rounds.
+	                      A round that takes longer is followed at once.
+	:param sink:          The output sink the statistics are written to.
+	:param metrics:       An exporter.Exporter the route is served through,
+	                      or None.
 	:return:              None
 	"""
 	
-	# Open the socket
-	send = socket.socket( socket.AF_INET, socket.SOCK_RAW, 1 )
-	send.settimeout( 1 )
-		
-	# IPv4 address of destination
-	try:
-		destIPv4 = socket.gethostbyname( destination )
-	except socket.gaierror:
-		print( "Cannot handle \"host\" cmdline arg '" + destination + "' ")
-		sys.exit(0)
-	
-	# First line of output
-	print( "traceroute to " + destination + " (" + destIPv4 + "), " + 
-	str( 30 ) + " hops max, " + str( 60 ) + " byte packets")
-	
-	# IPv4 address of the sender of the received packet
-	senderIPv4 = ""
+	lookups = _lookups( [ destination ] )
+	destIPv4 = lookups.wait( 0 )
+	lookups.save()
 	
-	# Keep track of the number of hops
-	counter = 0
+	# The first line of output, or the error if the destination is unknown
+	_report( sink, metrics, destination, destIPv4, list() )
+	if( destIPv4 is None ):
+		return
 	
-	# Current hop's rtt
-	rtts = list()
+	tracer = _open( n, q, N, z )
 	
-	# Build packet
-	packet = _icmp( 32, 1 )
+	# ttl -> [ address, name, rttstats.Rolling ] of every hop seen. A hop
+	# that did not answer in a round keeps the address it had.
+	hops = dict()
+	nextRound = time.perf_counter()
 	
 	try:
-		
-		# Continue until we reach the destination OR max hops is reached.
-		while( senderIPv4 != destIPv4 and counter < 30 ):
-			
-			# Reset to blank in case a server isn't set up to respond
-			senderIPv4 = "" 
-			source = ""
+		while( True ):
+			for hop in tracer.probe( destIPv4, range( 1, tracer.hops + 1 ) ):
+				entry = hops.setdefault( hop.hop, [ None, None, rttstats.Rolling() ] )
+				if( hop.address is not None ):
+					entry[0:2] = [ hop.address, hop.name ]
+				for rtt in hop.rtts:
+					entry[2].add( rtt )
+				sink.statistics( output.statistics( hop.hop, *entry ) )
 			
-			# Set the ttl
-			send.setsockopt( socket.SOL_IP, socket.IP_TTL, counter + 1)
-					
-			# Send and receive packets
-			for i in range( 0, q ):
-				
-				# Start time for rtt calculation
-				start = time.time()
-				
-				# Send the packet
-				send.sendto( packet, ( destIPv4, 80 ) )
-				
-				# Get the packet
-				try:
-					arr = bytearray( 1000 )
-					(nBytes, (senderIPv4, port) ) = send.recvfrom_into( arr )
-					rtts.append( str( ( time.time() - start ) * 1000 ) )
-				except socket.timeout:
-					rtts.append( "*" )
-						
-			# Process results
-			_processResults( counter + 1, senderIPv4, rtts, n, s )
-			counter += 1
-			rtts = list()
+			if( metrics is not None ):
+				metrics.route( destination, destIPv4, [ output.Hop( ttl, address, name,
+				 stats.rtts() ) for (ttl, (address, name, stats)) in sorted( hops.items() ) ] )
+			sink.writer.flush()
 			
+			# Rounds missed by one that took too long are not made up
+			nextRound += C
+			now = time.perf_counter()
+			if( nextRound <= now ):
+				nextRound = now
+			time.sleep( nextRound - now )
 	except KeyboardInterrupt:
-		sys.exit(0)
+		pass
+	sink.close()
+	tracer.close()
 
-		
-def _processResults( number, ipv4, rtts, n, s ):
+def _traceSharded( destinations, P, n, q, N, z, D, sink, metrics ):
+	"""
+	This function traces the routes to many destinations at once,
+	spreading them over P worker processes that each trace their share
+	in turn with a Tracer of their own. The hops of each route are sent
+	back to this process once it is traced, and the routes are written
+	in the order the destinations were given.
+	:param destinations:   The destinations, either IPv4 addresses or web URLs.
+	:param P:              The number of worker processes.
+	:param n:              Print IPv4 addresses as numeric rather than numeric
+	                       and symbolic.
+	:param q:              The number of packets sent per ttl.
+	:param N:              The number of probes outstanding at once, in
+	                       each process.
+	:param z:              The least number of milliseconds between probes.
+	:param D:              Stop probing each route at the hops found by
+	                       the routes before it in the same process.
+	:param sink:           The output sink each hop is written to.
+	:param metrics:        An exporter.Exporter the routes are served through,
+	                       or None.
+	:return:               None
 	"""
-	This function processes the packets returned for one hop. 
-	It calculates the time and, is option s is true, the percentage
-	of packet loss.
-	:param number:   The numbered hop that was just tested
-	:param ipv4:     The IPv4 address of the hop
-	:param rtts:     An array of rtts times for each probe 
-	:param n:        If true, the IPv4 of the hop is displayed 
-	                 as numeric only, rather than numeric and symbolic
-	:param s:        If true, the percentage of lost packets is displayed
-	:return:         None
-	"""	
-	
-	# If ipv4 is the empty string, than the 
-	# machine for this hop did not respond to
-	# the probes
-	if( ipv4 == "" ):
-		output = str(number) + "  "
-	
-	# If n is true, only print the numeric value
-	elif n :
-		output = str(number) + "  " + ipv4 + " "
 	
-	else:
-		
-		# Symbolic name of this IPv4 address
-		source = ""
-		try:
-			(source, aliaslist, ipaddrlist) = socket.gethostbyaddr( ipv4 )
-		except socket.herror:
-			source = ipv4
-		output = str(number) + "  "  + source + "  " + "(" + ipv4 + ")  "
+	# The routes traced but not yet written, by position, and the
+	# position of the next to write
+	routes = dict()
+	written = { "next": 0 }
 	
-	# Number of packets lost this round
-	numberLost = 0
-		
-	# For every rtt value
-	for i in rtts:
+	def collect( number, result ):
+		routes[ result[0] ] = result
 		
-		# If '*', add it to output
-		if( i == "*" ):
-			output += i + " "
-			numberLost += 1
-			
-		# Format the time	
-		else:
-			value = float( i )
-			output += "{:4.3f}".format( value ) + " ms "
-	
-	# If the -S option was selected
-	if s:
-		percent = (numberLost / len(rtts)) * 100
-		output += " (" + "{:.0f}".format( percent ) + "% loss)"
-	print( output )
-		
-def _icmp( size, count ):
+		# Write every route whose turn has come
+		while( written["next"] in routes ):
+			(position, destination, destIPv4, hops) = routes.pop( written["next"] )
+			_report( sink, metrics, destination, destIPv4, hops )
+			written["next"] += 1
+	
+	# Each worker is handed an identifier for its tracer
+	shard.run( shard.split( list( enumerate( destinations ) ), P ),
+	 lambda number, part, first, ship: _traceShard( part, first, n, q, N, z, D, ship ),
+	 collect, lambda part: 1 )
+	
+	# Routes after one that was cut short by Ctrl+C are written last
+	for position in sorted( routes ):
+		(position, destination, destIPv4, hops) = routes[position]
+		_report( sink, metrics, destination, destIPv4, hops )
+	sink.close()
+
+def _traceShard( part, first, n, q, N, z, D, ship ):
 	"""
-	This function assembles an ICMP echo request packet with the given
-	amount of data and the given sequence number.
-	:param size:    The amount of data sent in the echo request.
-	:param count:   The sequence number of this particular echo request.
-	:return:        A bytearray representation of this echo request packet.
+	This function traces the routes of one worker's share of the
+	destinations, and sends each back to the parent once it is traced.
+	:param part:   The destinations of the share, each with its position
+	               in the list of all destinations.
+	:param first:  The ICMP identifier of the share's probes.
+	:param n:      Print IPv4 addresses as numeric rather than numeric
+	               and symbolic.
+	:param q:      The number of packets sent per ttl.
+	:param N:      The number of probes outstanding at once.
+	:param z:      The least number of milliseconds between probes.
+	:param D:      Stop probing each route at the hops found by the
+	               routes before it.
+	:param ship:   A function that sends a result to the parent.
+	:return:       None
 	"""
 	
-	# The bytearray representing this echo request packet.
-	icmpHeader = bytearray( 8 + size )
-	
-	# Echo type
-	icmpHeader[0] = 8 
-	
-	# Code is zero
-	icmpHeader[1] = 0
-	
-	# Checksum starts as zero
-	icmpHeader[2] = 0
-	icmpHeader[3] = 0
-	
-	# Identifier is zero
-	icmpHeader[4] = 0
-	icmpHeader[5] = 0
-	
-	# Sequence number is zero
-	binary = _pad( bin(count)[2:], 16 )	
-	icmpHeader[6] = int( binary[:8], 2 )
-	icmpHeader[7] = int( binary[8:], 2 )
-    
-    # Send 56 bytes of ones as data
-	total = size + 8
-	for i in range(8, total):
-		icmpHeader[i] = 1
-	
-	# Compute the 16-bit one's compliment of this packet.
-	(icmpHeader[2], icmpHeader[3]) = _compute_checksum( icmpHeader )
+	tracer = _open( n, q, N, z, first )
+	stops = StopSet() if D else None
+	lookups = _lookups( [ destination for (position, destination) in part ] )
+	for (number, (position, destination)) in enumerate( part ):
+		destIPv4 = lookups.wait( number )
+		if( destIPv4 is None ):
+			ship( ( position, destination, None, list() ) )
+			continue
+		ship( ( position, destination, destIPv4, list( _route( tracer, stops, destIPv4 ) ) ) )
+	lookups.save()
+	tracer.close()
 
-	return icmpHeader
-	
-def _compute_checksum( header ):
+def _route( tracer, stops, destIPv4 ):
 	"""
-	This function computes the sixteen bit one's compliment of the
-	given bytearray.
-	:param header:   A bytearray object for which we want to calculate
-	                 the sixteen bit one's compliment.
-	:return:         The bytes representing the sixteen bit checksum.
+	This function traces the route to one destination.
+	:param tracer:     The Tracer.
+	:param stops:      The StopSet shared by the routes, or None to probe
+	                   every hop of every route.
+	:param destIPv4:   The IPv4 address of the destination.
+	:return:           The output.Hop of every hop, or a generator of them
+	                   as they are traced.
 	"""
 	
-	# Take the sum
-	total = _sixteenBitSum( header )
-	
-	# Convert to binary
-	binary = bin( total )
-    
-    # Remove '0b'
-	binarySub = binary[2:]
-	
-	length = len( binarySub )
-
-	if length < 16:
-		binarySub = '00' + binarySub
-
-	else:
-    
-		
-		while( len( binarySub ) != 16 ):
-			
-			# If this is zero, then we don't need to pad 
-			rem = len( binarySub ) % 4
-			for i in range( 0, rem ):
-				binarySub = '0' + binarySub
-		
-			# Position of first sixteen bits
-			begin = len( binarySub ) - 16 + 1
-		
-			# Get the carry and right hand side
-			carry = int( binarySub[0:begin], 2 )
-			right = int( binarySub[begin:], 2 )
+	if( stops is None ):
+		return tracer.trace( destIPv4 )
+	return tracer.doubletree( destIPv4, stops )
 
-			binarySub = bin( carry + right )[2:]
+def _lookups( destinations ):
+	"""
+	This function starts looking up the IPv4 address of every
+	destination, many at a time, keeping them from one run to the next.
+	:param destinations:   The destinations, either IPv4 addresses or web URLs.
+	:return:               The resolver.ForwardResolver, on which the
+	                       address of each destination is waited for by its
+	                       position in the list.
+	"""
 	
-	# Flip every bit using XOR		
-	binarySub = bin(int( binarySub, 2 ) ^ 65535)[2:]
-	first = int( binarySub[0:8], 2)
-	second = int( binarySub[8:], 2)
-
-	return ( first, second )
+	lookups = resolver.ForwardResolver( path=resolver.cachePath() )
+	lookups.submit( destinations )
+	return lookups
 
-def _sixteenBitSum( arr ):
+def _open( n, q, N, z, ident=None ):
 	"""
-	This function computes the sixteen bit sum of the given
-	bytearray.
-	:param arr:   The bytearray object for which we want
-	              to calculate the sixteen bit sum.
-	:return:      The sixteen bit sum.
+	This function opens a Tracer, a datagram socket that is told of Time
+	Exceeded errors if raw sockets need privileges the process lacks.
+	:param n:       Print IPv4 addresses as numeric rather than numeric
+	                and symbolic.
+	:param q:       The number of packets sent per ttl.
+	:param N:       The number of probes outstanding at once.
+	:param z:       The least number of milliseconds between probes.
+	:param ident:   The ICMP identifier of the probes, or None for the
+	                Tracer to be handed one of its own.
+	:return:        The Tracer.
 	"""
 	
-	total = 0
-	length = len( arr )
-	for i in range( 0, length, 2 ):
-		left = _pad( bin(arr[i])[2:], 8 )
-		right = _pad( bin(arr[i+1])[2:], 8 )
-		concat = left + right
-		total += int( concat, 2 )
-	return total
+	# Names of hops are looked up in the background while probing
+	names = None
+	if( not n ):
+		names = resolver.ReverseResolver()
+	
+	try:
+		return Tracer( q, names=names, window=N, pause=z / 1000, ident=ident )
+	except PermissionError:
+		sys.exit( "traceroute: raw sockets need root, and ICMP datagram sockets "
+		 "are not allowed by net.ipv4.ping_group_range" )
 
-def _pad( string, length ):
+def _report( sink, metrics, destination, destIPv4, hops ):
 	"""
-	This function pads the left side of the given binary string 
-	with zeros until the length of the string is equal to the
-	length specified.
-	:param string:   The binary string to pad.
-	:param length:   The desired length of the padded string.
-	:return:         The padded string.
+	This function writes the route to one destination.
+	:param sink:          The output sink each hop is written to.
+	:param metrics:       An exporter.Exporter the route is served through,
+	                      or None.
+	:param destination:   The destination, as given by the user.
+	:param destIPv4:      The IPv4 address of the destination, or None if
+	                      it could not be resolved.
+	:param hops:          The output.Hop of every hop, or a generator of
+	                      them as they are traced.
+	:return:              None
 	"""
 	
-	diff = length - len(string)
-	for i in range(0,diff):
-		string = '0' + string
-	return string
-
+	if( destIPv4 is None ):
+		sink.writer.flush()
+		print( "Cannot handle \"host\" cmdline arg '" + destination + "' ", file=sys.stderr )
+		return
+	
+	# First line of output
+	sink.comment( "traceroute to " + destination + " (" + destIPv4 + "), " + 
+	str( 30 ) + " hops max, " + str( 60 ) + " byte packets")
+	
+	traced = list()
+	for hop in hops:
+		sink.hop( hop )
+		traced.append( hop )
+		if( metrics is not None ):
+			metrics.route( destination, destIPv4, traced )
+		
+def _hop( number, ipv4, rtts, names ):
+	"""
+	This function processes the packets returned for one hop.
+	:param number:   The numbered hop that was just tested
+	:param ipv4:     The IPv4 address of the hop, or the empty string
+	                 if no probe was answered
+	:param rtts:     An array of rtts times for each probe, with None
+	                 for each probe that was not answered
+	:param names:    A resolver.ReverseResolver used to name the hop,
+	                 or None to leave it unnamed, rather than numeric
+	                 and symbolic. A hop whose name is not known yet
+	                 is also unnamed.
+	:return:         The output.Hop.
+	"""	
+	
+	# Symbolic name of this IPv4 address, if it is known yet
+	source = None
+	if( ipv4 != "" and names is not None ):
+		source = names.lookup( ipv4 )
+	
+	return output.Hop( number, ipv4 if ipv4 != "" else None, source, rtts )
+		
 def _parse( strArr ):
 	"""
 	This funciton parses the array of inputs to the ping program 
-	for different possible options and the destination.
+	for different possible options and the destinations.
 	:param strArr:   The array of inputs to the ping program.
 	:return:         The specified settings for this particular
 	                 execution of the ping program.
@@ -286,18 +748,45 @@ def _parse( strArr ):
 	# Print a summary of how many probes were not answered for each hop
 	s = False
 	
-	# Destination of the ICMP echo request packets.
-	addr = ""
+	# Stop probing each route at the hops found by the routes before it
+	D = False
 	
-	# Process options before address
-	(addr, pointer, n, q, s) = _processOptions( 0, strArr, n, q, s )
-
-	# Process options after address
-	(bull, pointer, n, q, s) = _processOptions( pointer, strArr, n, q, s )	
+	# The format of the output, one of output.FORMATS
+	o = "text"
+	
+	# The TCP port to serve metrics on, or the empty string to serve none
+	M = ""
+	
+	# The number of processes the destinations are spread over
+	P = "1"
+	
+	# A file describing a simulated network to probe instead of the
+	# real one, or the empty string to probe the real one
+	E = ""
+	
+	# The number of probes outstanding at once, for increasing ttls
+	N = "1"
+	
+	# The least number of milliseconds between two probes
+	z = "0"
+	
+	# The number of seconds between rounds of probes to every hop, or the
+	# empty string to trace the route once
+	C = ""
+	
+	# Destinations of the ICMP echo request packets.
+	destinations = list()
+	
+	# Options and destinations may appear in any order
+	while( pointer < len( strArr ) ):
+		(addr, pointer, n, q, s, D, o, M, P, E, N, z, C) = _processOptions( pointer, strArr,
+		 n, q, s, D, o, M, P, E, N, z, C )
+		if( addr != "" ):
+			destinations.append( addr )
 
-	return (addr, n, q, s)
+	return (destinations, n, q, s, D, o, M, P, E, N, z, C)
 		
-def _processOptions( index, strArr, n, q, s ):
+def _processOptions( index, strArr, n, q, s, D, o, M, P, E, N, z, C ):
 	"""
 	This function processes the array of ping program inputs for
 	various options and their values. This function ends when
@@ -310,13 +799,24 @@ def _processOptions( index, strArr, n, q, s ):
 	:param q:        The number of packets sent per ttl. Default value is 3.
 	:param s:        Print a summary of how many packets were not answered
 	                 for each hop.
+	:param D:        Stop probing each route at the hops found by the
+	                 routes before it.
+	:param o:        The format of the output.
+	:param M:        The TCP port to serve metrics on.
+	:param P:        The number of processes the destinations are
+	                 spread over.
+	:param E:        The file describing a simulated network.
+	:param N:        The number of probes outstanding at once.
+	:param z:        The least number of milliseconds between probes.
+	:param C:        The number of seconds between rounds of probes.
 	:return: 		 Part of the specified settings for this particular
 	                 execution of the ping program. 	  
 	"""
 	
 	# Possible options
-	valueLess = [ "-n", "-S" ]
+	valueLess = [ "-n", "-S", "-D" ]
 	valued = [ "-q" ]
+	named = [ "-o", "-M", "-P", "-E", "-N", "-z", "-C" ]
 	
 	# Number of arguments
 	length = len( strArr )
@@ -337,7 +837,7 @@ def _processOptions( index, strArr, n, q, s ):
 				location = valueLess.index( strArr[pointer] )
 				
 				# Assess validity of value
-				( n, q, s ) = _chooseOption( valueLess[location], True, n, q, s )
+				( n, q, s, D ) = _chooseOption( valueLess[location], True, n, q, s, D )
 				pointer += 1
 				
 			else:
@@ -345,6 +845,26 @@ def _processOptions( index, strArr, n, q, s ):
 				
 		# Thrown by options.index when we reach the destination		
 		except ValueError:
+			
+			# Options whose value is a name
+			if( strArr[pointer] in named and pointer + 1 < length ):
+				if( strArr[pointer] == "-o" ):
+					o = strArr[pointer+1]
+				elif( strArr[pointer] == "-M" ):
+					M = strArr[pointer+1]
+				elif( strArr[pointer] == "-P" ):
+					P = strArr[pointer+1]
+				elif( strArr[pointer] == "-N" ):
+					N = strArr[pointer+1]
+				elif( strArr[pointer] == "-z" ):
+					z = strArr[pointer+1]
+				elif( strArr[pointer] == "-C" ):
+					C = strArr[pointer+1]
+				else:
+					E = strArr[pointer+1]
+				pointer += 2
+				continue
+			
 			try:
 				
 				# If this doesn't fail, it is a valued option
@@ -354,16 +874,16 @@ def _processOptions( index, strArr, n, q, s ):
 				value = int(strArr[pointer+1])
 				
 				# Assess validity of value
-				( n, q, s ) = _chooseOption( valued[location], value, n, q, s )
+				( n, q, s, D ) = _chooseOption( valued[location], value, n, q, s, D )
 				pointer += 2
 				
 			except ValueError:
 				flag = False
 				addr = strArr[pointer]
-				return ( addr, pointer + 1, n, q, s )
-	return ( "", pointer, n, q, s  )	
+				return ( addr, pointer + 1, n, q, s, D, o, M, P, E, N, z, C )
+	return ( "", pointer, n, q, s, D, o, M, P, E, N, z, C )	
 	
-def _chooseOption( option, value, n, q, s ):
+def _chooseOption( option, value, n, q, s, D ):
 	"""
 	This function validates the value of a discovered option.
 	:param option:   The option whose value we want to validate.
@@ -373,24 +893,29 @@ def _chooseOption( option, value, n, q, s ):
 	:param q:        The number of packets sent per ttl. Default value is 3.
 	:param s:        Print a summary of how many packets were not answered
 	                 for each hop.
+	:param D:        Stop probing each route at the hops found by the
+	                 routes before it.
 	:return: 		 Part of the specified settings for this particular
 	                 execution of the ping program. 
 	"""
 	
 	if( option == "-n" ):
-		return ( value, q, s )
+		return ( value, q, s, D )
 			
 	elif( option == "-q" ):
 		try:
 			q = int(value)
 			if ( q <= 0 or q > 10 ): 
 				sys.exit( "no more than 10 probes per hop")
-			return ( n, value, s )
+			return ( n, value, s, D )
 		except ValueError:
 			sys.exit( "Cannot handle '-q' option with arg '" + str(value) + "'"  )
 			
+	elif( option == "-S" ):
+		return ( n, q, value, D )
+			
 	else:
-		return ( n, q, value)
+		return ( n, q, s, value )
 
 
 def main():
@@ -398,14 +923,69 @@ def main():
 	The main function. It first checks to make that the user has
 	entered more than just the name of the program. If more has
 	been entered, the input is processed. If the input is succesfully
-	processed, then the traceroute program can start.
+	processed, then the traceroute program can start. Several
+	destinations are traced one after another, unless -P spreads them
+	over several processes. -N probes that many hops at once, and -D
+	stops probing each route once it reaches hops already found. -C
+	traces one destination over and over, keeping statistics of each hop.
 	"""
 	
+	usage = ( "Usage: traceroute [-q nqueries] [-n] [-S] [-D] [-o text|json|csv|binary] " +
+	 "[-M port] [-P processes] [-E networkfile] [-N squeries] [-z sendwait] [-C interval] " +
+	 "destination [destination ...]" )
+	
 	if( len(sys.argv[1:]) == 0 ):
-		print("Usage: traceroute [-q nqueries] [-n] [-S] destination")
+		print( usage )
 	else:
-		(destination, n, q, s ) = _parse( sys.argv[1:] )
-		_traceroute( destination, n, q, s )
+		(destinations, n, q, s, D, o, M, P, E, N, z, C) = _parse( sys.argv[1:] )
+		if( len( destinations ) == 0 ):
+			print( usage )
+			return
+		if( o not in output.FORMATS ):
+			sys.exit( "traceroute: unknown output format " + o )
+		if( not P.isdigit() or int( P ) <= 0 ):
+			sys.exit( "traceroute: bad number of processes " + P )
+		if( not N.isdigit() or int( N ) <= 0 ):
+			sys.exit( "traceroute: bad number of simultaneous probes " + N )
+		if( not z.isdigit() ):
+			sys.exit( "traceroute: bad wait between probes " + z )
+		if( C != "" ):
+			try:
+				interval = float( C )
+			except ValueError:
+				interval = 0
+			if( not interval > 0 ):
+				sys.exit( "traceroute: bad interval between rounds " + C )
+			if( len( destinations ) > 1 or D ):
+				sys.exit( "traceroute: -C traces one destination, without -D" )
+		
+		# Probe a simulated network if -E is given
+		if( E != "" ):
+			try:
+				transport.simulate( netsim.Network.load( E ) )
+			except ( OSError, ValueError ) as error:
+				sys.exit( "traceroute: cannot read network file " + E + ": " + str( error ) )
+		
+		# The route is also served over HTTP if -M is given
+		metrics = None
+		if( M != "" ):
+			if( not M.isdigit() or int( M ) <= 0 or int( M ) > 65535 ):
+				sys.exit( "traceroute: bad metrics port " + M )
+			try:
+				metrics = exporter.Exporter( int( M ) )
+			except OSError as error:
+				sys.exit( "traceroute: cannot serve metrics on port " + M + ": " +
+				 str( error.strerror ) )
+		
+		# Many destinations may be spread over several processes
+		sink = output.sink( o, hopLoss=s, live=( C != "" and sys.stdout.isatty() ) )
+		if( C != "" ):
+			_traceContinuous( destinations[0], n, q, int( N ), int( z ), float( C ), sink,
+			 metrics )
+		elif( int( P ) > 1 and len( destinations ) > 1 ):
+			_traceSharded( destinations, int( P ), n, q, int( N ), int( z ), D, sink, metrics )
+		else:
+			_traceroute( destinations, n, q, int( N ), int( z ), D, sink, metrics )
 	
 if __name__ == "__main__":
     main()
@@ -0,0 +1,574 @@
+"""
+Sending and receiving ICMP packets on behalf of ping and traceroute.
+"""
+
+import ctypes
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+# Asks the kernel to stamp every received packet with the time it
+# arrived, in nanoseconds. Not every Python names this option.
+SO_TIMESTAMPNS = getattr( socket, "SO_TIMESTAMPNS", 35 )
+
+# The struct timespec carried by the stamp: seconds and nanoseconds
+_TIMESPEC = struct.Struct( "@ll" )
+
+# Ask the kernel for the ttl of every packet received, and for the ICMP
+# errors caused by the packets sent, on an ICMP datagram socket. Not
+# every Python names these options.
+IP_RECVTTL = getattr( socket, "IP_RECVTTL", 12 )
+IP_RECVERR = getattr( socket, "IP_RECVERR", 11 )
+MSG_ERRQUEUE = getattr( socket, "MSG_ERRQUEUE", 0x2000 )
+
+# The ttl of a packet is an int
+_TTL = struct.Struct( "@i" )
+
+# An ICMP error (struct sock_extended_err): errno, where it came from,
+# ICMP type and code, padding, info and data, followed by the address
+# of the router that sent it (struct sockaddr_in): family, port and
+# address
+_EXTENDED_ERROR = struct.Struct( "@IBBBBII" )
+_OFFENDER = struct.Struct( "@HH4s" )
+SO_EE_ORIGIN_ICMP = 2
+
+# The IPv4 header put in front of the packets of an ICMP datagram
+# socket, which arrive without one: version and header length, type
+# of service, total length, ID, fragment offset, ttl, protocol,
+# checksum, source and destination
+_IP_HEADER = struct.Struct( "!BBHHHBBH4s4s" )
+
+# Room for the stamp in the ancillary data of a received packet, and
+# on an ICMP datagram socket for the ttl and any ICMP error as well
+ANCILLARY_SIZE = 0
+DATAGRAM_ANCILLARY_SIZE = 0
+if( hasattr( socket, "CMSG_SPACE" ) ):
+	ANCILLARY_SIZE = socket.CMSG_SPACE( _TIMESPEC.size )
+	DATAGRAM_ANCILLARY_SIZE = ( ANCILLARY_SIZE + socket.CMSG_SPACE( _TTL.size ) +
+	 socket.CMSG_SPACE( _EXTENDED_ERROR.size + _OFFENDER.size ) )
+
+# The number of ICMP identifiers, which are sixteen bits long
+IDENTIFIERS = 0x10000
+
+# The ranges of identifiers handed out in this process and not yet
+# taken back, as the number of identifiers in each keyed by the first,
+# and the lock they are handed out under. A forked child keeps the
+# ranges of its parent, which the parent goes on using, but not the
+# state of the lock.
+_held = dict()
+_holding = threading.Lock()
+
+# Attaches a classic BPF program to a socket. Not every Python names
+# this option.
+SO_ATTACH_FILTER = getattr( socket, "SO_ATTACH_FILTER", 26 )
+
+# A BPF instruction (struct sock_filter): opcode, jump offsets if true
+# and if false, and constant
+_INSTRUCTION = struct.Struct( "=HBBI" )
+
+# The BPF program (struct sock_fprog): length and address of the instructions
+_PROGRAM = struct.Struct( "@HP" )
+
+# BPF opcodes, from linux/filter.h
+_LDX_MSH = 0xb1    # X = 4 * ( packet[k] & 0xf )
+_LDB_IND = 0x50    # A = packet[X + k]
+_LDH_IND = 0x48    # A = packet[X + k : X + k + 2]
+_AND = 0x54        # A &= k
+_LSH = 0x64        # A <<= k
+_ADD_X = 0x0c      # A += X
+_TAX = 0x07        # X = A
+_JEQ = 0x15        # A == k
+_JGE = 0x35        # A >= k
+_JGT = 0x25        # A > k
+_RET = 0x06        # accept k bytes of the packet
+
+# The simulated network sockets are opened on instead of the host's,
+# if one is set by simulate
+_network = None
+
+def simulate( network ):
+	"""
+	This function has openSocket open sockets on a simulated network
+	rather than the host's, so that ping and traceroute can be run, and
+	load tested, without root or a network.
+	:param network:   A netsim.Network, or None for the host's network.
+	:return:          None
+	"""
+
+	global _network
+	_network = network
+
+def openSocket( errors=False ):
+	"""
+	This function opens a socket to send ICMP echo requests on. A raw
+	socket is used if the process may open one, which takes root or
+	CAP_NET_RAW. Otherwise an ICMP datagram socket is used, which Linux
+	allows to the groups in net.ipv4.ping_group_range. The kernel then
+	chooses the identifier of the requests and hands the socket only
+	the replies to its own requests, so many unprivileged processes
+	can ping at once without seeing each other's traffic.
+	:param errors:   If true, a datagram socket also receives the ICMP
+	                 errors, such as Time Exceeded, caused by its
+	                 requests. A raw socket always does.
+	:return:         The socket. Use isDatagram to tell which it is.
+	                 On a simulated network, a netsim.Socket that behaves
+	                 as a raw socket.
+	"""
+
+	if( _network is not None ):
+		return _network.socket()
+
+	try:
+		return socket.socket( socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP )
+	except PermissionError:
+		pass
+
+	sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP )
+
+	# Have the kernel choose the identifier now rather than on the first send
+	sock.bind( ( "0.0.0.0", 0 ) )
+
+	# Packets arrive without their IPv4 header, so ask for the ttl
+	sock.setsockopt( socket.SOL_IP, IP_RECVTTL, 1 )
+	if( errors ):
+		sock.setsockopt( socket.SOL_IP, IP_RECVERR, 1 )
+	return sock
+
+def isDatagram( sock ):
+	"""
+	This function tells an ICMP datagram socket from a raw one.
+	:param sock:   The socket, from openSocket.
+	:return:       True for a datagram socket, False for a raw one.
+	"""
+
+	return sock.type == socket.SOCK_DGRAM
+
+def send( sock, packet, address ):
+	"""
+	This function sends a packet. A datagram socket that receives ICMP
+	errors reports an error about an earlier packet by failing the next
+	send, without sending it, so the packet is then sent again.
+	:param sock:      The socket, from openSocket.
+	:param packet:    The packet.
+	:param address:   The IPv4 address to send it to.
+	:return:          None
+	"""
+
+	try:
+		sock.sendto( packet, ( address, 0 ) )
+	except OSError:
+		if( not isDatagram( sock ) ):
+			raise
+		sock.sendto( packet, ( address, 0 ) )
+
+def identifier( count=1 ):
+	"""
+	This function hands out ICMP identifiers, so that pingers and
+	tracers running at once, in this process or in others, can tell
+	their replies apart. The range handed out starts at the process ID,
+	as iputils does, is moved down if it would wrap around, and is
+	moved on past any identifiers this process still holds. It is held
+	until given to release.
+	:param count:   The number of consecutive identifiers wanted.
+	:return:        The first identifier.
+	:raises ValueError:   If more identifiers are wanted than are free.
+	"""
+
+	if( count > IDENTIFIERS ):
+		raise ValueError( "no more than " + str( IDENTIFIERS ) + " identifiers" )
+
+	seed = min( os.getpid() & 0xffff, IDENTIFIERS - count )
+	with _holding:
+		# The free gaps between the ranges held, in order
+		gaps = list()
+		end = 0
+		for first in sorted( _held ):
+			gaps.append( ( end, first ) )
+			end = first + _held[first]
+		gaps.append( ( end, IDENTIFIERS ) )
+
+		# Take room in the first gap with any from the seed on, or
+		# failing that in the first gap with any below the seed
+		gaps.sort( key=lambda gap: gap[1] - count < seed )
+		for (low, high) in gaps:
+			first = min( max( seed, low ), high - count )
+			if( first >= low ):
+				_held[first] = count
+				return first
+
+	raise ValueError( "fewer than " + str( count ) + " identifiers are free" )
+
+def release( first ):
+	"""
+	This function takes back a range of identifiers handed out by
+	identifier, once nothing is sent or received with them any more.
+	:param first:   The first identifier of the range.
+	:return:        None
+	"""
+
+	with _holding:
+		_held.pop( first, None )
+
+def _forked():
+	"""
+	This function gives a forked child a lock of its own, as the
+	parent's may have been held by another thread when it forked.
+	:return:   None
+	"""
+
+	global _holding
+	_holding = threading.Lock()
+
+if( hasattr( os, "register_at_fork" ) ):
+	os.register_at_fork( after_in_child=_forked )
+
+def echoFilter( first, last ):
+	"""
+	This function builds a classic BPF program for a raw ICMP socket that
+	accepts echo replies whose identifier lies in the given range, along
+	with Time Exceeded and Destination Unreachable messages that quote an
+	echo request with such an identifier. Everything else, such as other
+	processes' replies and, on loopback, our own echo requests, is
+	dropped by the kernel before it is queued on the socket.
+	:param first:   The lowest identifier to accept.
+	:param last:    The highest identifier to accept.
+	:return:        A list of ( opcode, jump if true, jump if false,
+	                constant ) instructions. Jumps count the instructions
+	                to skip.
+	"""
+
+	return [
+		# X = length of the IP header, A = ICMP type
+		( _LDX_MSH, 0, 0, 0 ),
+		( _LDB_IND, 0, 0, 0 ),
+		( _JEQ, 2, 0, 0 ),                      # echo reply
+		( _JEQ, 4, 0, 11 ),                     # time exceeded
+		( _JEQ, 3, 14, 3 ),                     # destination unreachable
+
+		# Echo reply: the identifier must be ours
+		( _LDH_IND, 0, 0, 4 ),
+		( _JGE, 0, 12, first ),
+		( _JGT, 11, 10, last ),
+
+		# Error: X = length of both IP headers, skipping the ICMP
+		# header in between, and the quoted packet must be our request
+		( _LDB_IND, 0, 0, 8 ),
+		( _AND, 0, 0, 0x0f ),
+		( _LSH, 0, 0, 2 ),
+		( _ADD_X, 0, 0, 0 ),
+		( _TAX, 0, 0, 0 ),
+		( _LDB_IND, 0, 0, 8 ),
+		( _JEQ, 0, 4, 8 ),
+		( _LDH_IND, 0, 0, 12 ),
+		( _JGE, 0, 2, first ),
+		( _JGT, 1, 0, last ),
+
+		# Accept the whole packet, or none of it
+		( _RET, 0, 0, 0x40000 ),
+		( _RET, 0, 0, 0 ) ]
+
+def attachFilter( sock, first, last ):
+	"""
+	This function has the kernel drop every packet on a raw ICMP socket
+	that is not meant for the given range of identifiers, as described
+	by echoFilter, so that the process only wakes for its own traffic.
+	:param sock:    The raw socket.
+	:param first:   The lowest identifier to accept.
+	:param last:    The highest identifier to accept.
+	:return:        True if the filter was attached, False otherwise, in
+	                which case every packet still has to be checked.
+	                Nothing is attached to a datagram socket, which only
+	                receives its own traffic already.
+	"""
+
+	if( isDatagram( sock ) ):
+		return False
+
+	program = echoFilter( first, last )
+	code = ctypes.create_string_buffer( _INSTRUCTION.size * len( program ) )
+	for (k, instruction) in enumerate( program ):
+		_INSTRUCTION.pack_into( code, k * _INSTRUCTION.size, *instruction )
+
+	# The kernel copies the instructions before setsockopt returns
+	try:
+		sock.setsockopt( socket.SOL_SOCKET, SO_ATTACH_FILTER,
+		 _PROGRAM.pack( len( program ), ctypes.addressof( code ) ) )
+	except OSError:
+		return False
+
+	# Discard whatever was queued before the filter was in place
+	try:
+		while( True ):
+			sock.recv( 1, socket.MSG_DONTWAIT )
+	except ( BlockingIOError, InterruptedError, socket.timeout ):
+		pass
+	return True
+
+def enableTimestamps( sock ):
+	"""
+	This function asks the kernel to stamp every packet the socket
+	receives with the time it arrived.
+	:param sock:   The socket.
+	:return:       True if the kernel agreed, False otherwise, in which
+	               case receive never returns a stamp.
+	"""
+
+	if( ANCILLARY_SIZE == 0 or not hasattr( sock, "recvmsg_into" ) ):
+		return False
+	try:
+		sock.setsockopt( socket.SOL_SOCKET, SO_TIMESTAMPNS, 1 )
+		return True
+	except OSError:
+		return False
+
+def receive( sock, buffer ):
+	"""
+	This function receives one packet into the given buffer, along with
+	the kernel's stamp of when it arrived, if there is one.
+	:param sock:     The socket.
+	:param buffer:   A bytearray or memoryview to receive the packet into.
+	:return:         A tuple of the number of bytes received, the address
+	                 of the sender, and the time the packet arrived in
+	                 nanoseconds since the epoch, or None if the kernel did
+	                 not stamp it. The packet starts with its IPv4 header
+	                 whichever kind of socket it came from: see
+	                 receiveDatagram.
+	"""
+
+	if( isDatagram( sock ) ):
+		if( sock.gettimeout() ):
+			return _receiveDatagramWaiting( sock, buffer )
+		return receiveDatagram( sock, buffer )
+	return _receiveRaw( sock, buffer )
+
+def _receiveDatagramWaiting( sock, buffer ):
+	"""
+	This function receives one packet from an ICMP datagram socket that
+	has a timeout. An error waiting to be read keeps such a socket ready
+	while an ordinary receive finds nothing, and the socket module would
+	try the receive again and again until the timeout passes, spinning
+	the processor. So the wait is done here, and the receive is not
+	allowed to wait.
+	:param sock:     The ICMP datagram socket.
+	:param buffer:   A bytearray or memoryview to receive the packet into.
+	:return:         The same as receive.
+	:raises socket.timeout:   If nothing arrives in time.
+	"""
+
+	timeout = sock.gettimeout()
+	deadline = time.monotonic() + timeout
+	while( True ):
+		remaining = deadline - time.monotonic()
+		if( remaining <= 0 or len( select.select( [ sock ], [], [], remaining )[0] ) == 0 ):
+			raise socket.timeout( "timed out" )
+
+		# Errors that are not ICMP errors are skipped
+		sock.settimeout( 0 )
+		try:
+			return receiveDatagram( sock, buffer )
+		except BlockingIOError:
+			continue
+		finally:
+			sock.settimeout( timeout )
+
+def _receiveRaw( sock, buffer ):
+	"""
+	This function receives one packet from a raw socket, as described
+	by receive.
+	:param sock:     The raw socket.
+	:param buffer:   A bytearray or memoryview to receive the packet into.
+	:return:         The same as receive.
+	"""
+
+	if( ANCILLARY_SIZE == 0 or not hasattr( sock, "recvmsg_into" ) ):
+		(nbytes, address) = sock.recvfrom_into( buffer )
+		return ( nbytes, address, None )
+
+	(nbytes, ancdata, flags, address) = sock.recvmsg_into( [buffer], ANCILLARY_SIZE )
+	(stamp, ttl, error) = _ancillary( ancdata )
+	return ( nbytes, address, stamp )
+
+def receiveDatagram( sock, buffer ):
+	"""
+	This function receives one packet from an ICMP datagram socket. Such
+	packets arrive without their IPv4 header, so one is made up in front
+	of the packet from its sender and the ttl the kernel reports, and
+	the packet can be parsed as if it had come from a raw socket. The
+	header's ID and checksum are zero.
+
+	If the socket receives ICMP errors, and one has arrived, the error
+	is made up in the same way instead: an IPv4 header from the router
+	that sent it, an ICMP header of its type and code, and the echo
+	request it was sent about, behind an IPv4 header to its destination.
+	:param sock:     The ICMP datagram socket.
+	:param buffer:   A bytearray or memoryview to receive the packet into.
+	:return:         The same as receive, where the number of bytes and
+	                 the sender are those of the made up packet.
+	"""
+
+	view = memoryview( buffer )
+	try:
+		(nbytes, ancdata, flags, address) = sock.recvmsg_into( [ view[_IP_HEADER.size:] ],
+		 DATAGRAM_ANCILLARY_SIZE )
+	except ( InterruptedError, socket.timeout ):
+		raise
+	except OSError:
+		# The kernel reports the arrival of an error as a failure to
+		# receive. Errors that arrive together are only reported once,
+		# so a non-blocking socket with nothing else to read checks for
+		# more, as they keep the socket readable until they are read.
+		return _receiveError( sock, view )
+
+	(stamp, ttl, error) = _ancillary( ancdata )
+	_IP_HEADER.pack_into( view, 0, 0x45, 0, _IP_HEADER.size + nbytes, 0, 0,
+	 ttl or 0, socket.IPPROTO_ICMP, 0, socket.inet_aton( address[0] ), bytes( 4 ) )
+	return ( _IP_HEADER.size + nbytes, address, stamp )
+
+def _receiveError( sock, view ):
+	"""
+	This function receives one ICMP error from the error queue of an
+	ICMP datagram socket, as described by receiveDatagram.
+	:param sock:   The ICMP datagram socket.
+	:param view:   A memoryview to receive the error into.
+	:return:       The same as receive.
+	"""
+
+	# The request the error is about goes behind both made up IPv4
+	# headers and the ICMP header
+	offset = 2 * _IP_HEADER.size + 8
+	(nbytes, ancdata, flags, address) = sock.recvmsg_into( [ view[offset:] ],
+	 DATAGRAM_ANCILLARY_SIZE, MSG_ERRQUEUE )
+
+	# Errors raised by the host itself, such as a packet too large to
+	# send, are not ICMP errors and are skipped
+	(stamp, ttl, error) = _ancillary( ancdata )
+	if( error is None ):
+		raise BlockingIOError( "no ICMP error" )
+	(icmpType, code, offender) = error
+
+	_IP_HEADER.pack_into( view, 0, 0x45, 0, offset + nbytes, 0, 0, 0,
+	 socket.IPPROTO_ICMP, 0, offender, bytes( 4 ) )
+	view[_IP_HEADER.size:_IP_HEADER.size + 8] = bytes( [ icmpType, code ] ) + bytes( 6 )
+	_IP_HEADER.pack_into( view, _IP_HEADER.size + 8, 0x45, 0, _IP_HEADER.size + nbytes,
+	 0, 0, 0, socket.IPPROTO_ICMP, 0, bytes( 4 ), socket.inet_aton( address[0] ) )
+	return ( offset + nbytes, ( socket.inet_ntoa( offender ), 0 ), stamp )
+
+def _ancillary( ancdata ):
+	"""
+	This function picks what is wanted out of the ancillary data of a
+	received packet.
+	:param ancdata:   The ancillary data, as returned by recvmsg_into.
+	:return:          A tuple of the kernel's stamp of when the packet
+	                  arrived in nanoseconds since the epoch, the ttl of
+	                  the packet, and for an ICMP error a tuple of its
+	                  type, code and the packed address of the router
+	                  that sent it. Each is None if it was not given.
+	"""
+
+	stamp = None
+	ttl = None
+	error = None
+	for (level, kind, data) in ancdata:
+		if( level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and
+		 len( data ) >= _TIMESPEC.size ):
+			(seconds, nanoseconds) = _TIMESPEC.unpack_from( data )
+			stamp = seconds * 1000000000 + nanoseconds
+		elif( level == socket.SOL_IP and kind == socket.IP_TTL and
+		 len( data ) >= _TTL.size ):
+			(ttl,) = _TTL.unpack_from( data )
+		elif( level == socket.SOL_IP and kind == IP_RECVERR and
+		 len( data ) >= _EXTENDED_ERROR.size + _OFFENDER.size ):
+			(errno, origin, icmpType, code, pad, info, value) = _EXTENDED_ERROR.unpack_from( data )
+			(family, port, offender) = _OFFENDER.unpack_from( data, _EXTENDED_ERROR.size )
+			if( origin == SO_EE_ORIGIN_ICMP ):
+				error = ( icmpType, code, offender )
+	return ( stamp, ttl, error )
+
+class BufferRing:
+	"""
+	This class receives packets into buffers allocated once, up front,
+	rather than into a new bytearray for every packet. Each time the
+	socket is found readable, every packet waiting on it is read in
+	batches of up to one packet per buffer, with each packet stamped
+	as it is read, before any of them is handled. Counters of how many
+	packets each wakeup found show how far behind the reader is.
+	"""
+
+	def __init__( self, count=64, size=576 ):
+		"""
+		This function allocates the buffers.
+		:param count:   The number of buffers, and so the largest number
+		                of packets read in one batch.
+		:param size:    The size of each buffer, in bytes. Longer packets
+		                are cut short. 576 bytes holds the replies to echo
+		                requests of the default size along with any ICMP
+		                error with the header it quotes.
+		"""
+
+		self.size = size
+		self._buffers = [ bytearray( size ) for i in range( count ) ]
+		self._views = [ memoryview( buffer ) for buffer in self._buffers ]
+
+		# The length, sender and arrival stamp of each packet in the batch
+		self._lengths = [ 0 ] * count
+		self._addresses = [ None ] * count
+		self._stamps = [ None ] * count
+
+		# The number of times drain was called, the number of packets it
+		# read, and the most packets read in one call
+		self.wakeups = 0
+		self.datagrams = 0
+		self.largest = 0
+
+	def drain( self, sock, handle ):
+		"""
+		This function reads every packet waiting on a non-blocking socket
+		and passes each one to the given function. A packet's memoryview
+		is reused by the next batch, so it must not be kept once the
+		function returns.
+		:param sock:     The socket, which must not block.
+		:param handle:   A function called as handle( packet, nbytes,
+		                 address, received ) for every packet, where packet
+		                 is a memoryview of its buffer, nbytes the length of
+		                 the packet, and received a tuple of
+		                 time.perf_counter_ns() when it was read and the
+		                 kernel's stamp of when it arrived, as taken by
+		                 probe.elapsed.
+		:return:         The number of packets read.
+		"""
+
+		read = receiveDatagram if isDatagram( sock ) else _receiveRaw
+		views = self._views
+		lengths = self._lengths
+		addresses = self._addresses
+		stamps = self._stamps
+
+		total = 0
+		full = True
+		while( full ):
+
+			# Read a batch, stopping early when the socket runs dry
+			batch = 0
+			for view in views:
+				try:
+					(nbytes, address, kernel) = read( sock, view )
+				except ( BlockingIOError, InterruptedError ):
+					break
+				lengths[batch] = nbytes
+				addresses[batch] = address
+				stamps[batch] = ( time.perf_counter_ns(), kernel )
+				batch += 1
+			full = batch == len( views )
+
+			# Then handle it
+			for k in range( batch ):
+				handle( views[k], lengths[k], addresses[k], stamps[k] )
+			total += batch
+
+		self.wakeups += 1
+		self.datagrams += total
+		self.largest = max( self.largest, total )
+		return total